@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The application modules import each other as top-level modules from src/.
+_SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _SRC_DIR not in sys.path:
+    sys.path.insert(0, _SRC_DIR)
@@ -0,0 +1,293 @@
+"""
+Reproducible benchmarks for ingest, reclustering, retrieval and summary streaming.
+
+    python -m benchmarks.run --scales 1k,10k --queries 200 --out bench_results.json
+
+Each scale runs in a fresh working directory so runs never touch ./data.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from benchmarks import synthetic
+from benchmarks.stub_server import run_stub_server, SUMMARIZATION_AGENT_ID
+
+CONCURRENCY = 16  # client threads for the micro-batched search measurement
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+
+def _parse_scale(value: str) -> int:
+    value = value.strip().lower()
+    if value in SCALES:
+        return SCALES[value]
+    return int(value)
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _percentile(values: list, q: float) -> float:
+    return float(np.percentile(np.asarray(values) * 1000.0, q)) if values else 0.0
+
+
+def _in_child(target, *args) -> dict:
+    """Runs target in a fresh process so its peak RSS is measured in isolation."""
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_child_main, args=(queue, target, args))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+
+def _child_main(queue, target, args):
+    try:
+        queue.put(target(*args))
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def _ingest(workdir: str, ndjson_path: str, n: int, encode_workers: int = 0) -> dict:
+    os.chdir(workdir)
+    from faiss_updater import update_faiss_with_new_data
+    from embedder import get_encoder
+
+    if encode_workers <= 1:
+        get_encoder()  # exclude model load time from throughput; worker start-up is part of parallel mode
+    start = time.perf_counter()
+    new_count, total = update_faiss_with_new_data(ndjson_path, encode_workers=encode_workers)
+    elapsed = time.perf_counter() - start
+    return {
+        "records": n,
+        "encode_workers": encode_workers,
+        "new": new_count,
+        "total": total,
+        "seconds": elapsed,
+        "records_per_sec": n / elapsed if elapsed else 0.0,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _recluster(workdir: str) -> dict:
+    os.chdir(workdir)
+    from cluster_manager import recluster_and_update_indices
+    from embedding_store import open_embedding_store
+
+    embeddings = open_embedding_store().open_memmap()
+    start = time.perf_counter()
+    recluster_and_update_indices(embeddings)
+    return {
+        "vectors": len(embeddings),
+        "seconds": time.perf_counter() - start,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _search(workdir: str, queries: list, top_k: int) -> dict:
+    os.chdir(workdir)
+    import faiss
+    from utils.config import config
+    from retriever import IncidentRetriever
+    from batcher import QueryBatcher
+    from embedding_store import open_embedding_store
+    from metadata_store import open_metadata_store
+
+    config.QUERY_CACHE_PERSIST = False
+    # Measures the ANN index alone: token matches fused into codes and host names would inflate recall.
+    config.LEXICAL_SEARCH = False
+    retriever = IncidentRetriever()
+    retriever.search("warm up", top_k)
+
+    latencies = []
+    cluster_numbers = []
+    for q in queries:
+        start = time.perf_counter()
+        results, _ = retriever.search(q, top_k)
+        latencies.append(time.perf_counter() - start)
+        cluster_numbers.append(list(results["Number"]) if not results.empty else [])
+
+    start = time.perf_counter()
+    retriever.search_many([q + " (batch)" for q in queries], top_k)
+    batch_seconds = time.perf_counter() - start
+
+    # Concurrent callers through the micro-batcher, as the search service sees them.
+    batcher = QueryBatcher(retriever_getter=lambda: retriever)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        list(pool.map(lambda q: batcher.search(q + " (concurrent)", top_k), queries))
+    concurrent_seconds = time.perf_counter() - start
+
+    # Exact global search over the stored vectors is the recall reference.
+    embeddings = open_embedding_store().open_memmap()
+    exact = faiss.IndexFlatL2(embeddings.shape[1])
+    for i in range(0, len(embeddings), 10_000):
+        exact.add(np.ascontiguousarray(embeddings[i:i + 10_000], dtype=np.float32))
+    query_vecs = retriever.model.encode(queries, convert_to_numpy=True).astype(np.float32)
+    _, exact_ids = exact.search(query_vecs, top_k)
+    metadata = open_metadata_store()
+    recalls = []
+    for ids, got in zip(exact_ids, cluster_numbers):
+        expected = set(metadata.fetch([i for i in ids if i >= 0])["Number"])
+        recalls.append(len(expected & set(got)) / max(len(expected), 1))
+
+    return {
+        "queries": len(queries),
+        "top_k": top_k,
+        "p50_ms": _percentile(latencies, 50),
+        "p99_ms": _percentile(latencies, 99),
+        "mean_ms": float(np.mean(latencies) * 1000.0) if latencies else 0.0,
+        "search_many_qps": len(queries) / batch_seconds if batch_seconds else 0.0,
+        "concurrent_qps": len(queries) / concurrent_seconds if concurrent_seconds else 0.0,
+        "concurrency": CONCURRENCY,
+        "batcher": batcher.stats(),
+        f"recall_at_{top_k}": float(np.mean(recalls)) if recalls else 0.0,
+        "nprobe": int(retriever.index.nprobe),
+        "nlist": int(retriever.index.nlist),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _enrich(workdir: str, raw_path: str, n: int) -> dict:
+    from utils.config import config
+    from json_creator import iter_ndjson
+    from enrichment import enrich_to_ndjson
+
+    out_path = os.path.join(workdir, "data", "enriched.ndjson")
+    with run_stub_server() as (url, server):
+        start = time.perf_counter()
+        stats = enrich_to_ndjson(iter_ndjson(raw_path), out_path, ai_agent_id="bench", endpoint=url, total_records=n)
+        elapsed = time.perf_counter() - start
+    return {
+        "records": n,
+        "seconds": elapsed,
+        "records_per_sec": n / elapsed if elapsed else 0.0,
+        "requests": server.requests,
+        "request_bytes": server.bytes_received,
+        "batch_size": config.ENRICH_BATCH_SIZE,
+        "batch_tokens": config.ENRICH_BATCH_TOKENS,
+        "gzip": config.ENRICH_GZIP,
+        "max_workers": config.ENRICH_MAX_WORKERS,
+        "stats": stats,
+        "out_path": out_path,
+    }
+
+
+def _summary_latency(top_k: int, latency: float = 0.3, chunk_delay: float = 0.02) -> dict:
+    """Time to the first summary text, streamed vs blocking, against the stub's simulated generation."""
+    from utils.config import config
+    from http_client import get_summarized_output, stream_summarized_output
+
+    config.SUMMARY_CACHE_ENABLED = False
+    records = list(synthetic.generate_incidents(top_k))
+    with run_stub_server(latency=latency, chunk_delay=chunk_delay) as (url, _):
+        start = time.perf_counter()
+        get_summarized_output(records, ai_agent_id=SUMMARIZATION_AGENT_ID, endpoint=url)
+        blocking = time.perf_counter() - start
+
+        start = time.perf_counter()
+        first = None
+        for _ in stream_summarized_output(records, ai_agent_id=SUMMARIZATION_AGENT_ID, endpoint=url):
+            if first is None:
+                first = time.perf_counter() - start
+        streamed = time.perf_counter() - start
+    return {"blocking_seconds": blocking, "stream_first_chunk_seconds": first, "stream_total_seconds": streamed}
+
+
+def run_scale(n: int, n_queries: int, top_k: int, enrich_rate: float, encode_workers: int = 0) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"bench_{n}_")
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    # Module loggers write to ./data, so import them from inside the scratch directory.
+    os.chdir(workdir)
+    from utils.config import config
+    from json_creator import write_ndjson
+
+    raw_path = os.path.join(workdir, "data", "raw.ndjson")
+    write_ndjson(synthetic.generate_incidents(n), raw_path)
+
+    print(f"[{n}] enrichment via stub server...", flush=True)
+    config.ENRICH_RATE_PER_SEC = enrich_rate
+    config.ENRICH_BURST = max(config.ENRICH_BURST, int(enrich_rate))
+    enrich = _enrich(workdir, raw_path, n)
+    enriched_path = enrich.pop("out_path")
+
+    print(f"[{n}] ingest...", flush=True)
+    ingest = _in_child(_ingest, workdir, enriched_path, n, encode_workers)
+    print(f"[{n}] recluster...", flush=True)
+    recluster = _in_child(_recluster, workdir)
+    print(f"[{n}] search...", flush=True)
+    search = _in_child(_search, workdir, synthetic.generate_queries(n_queries), top_k)
+    summary = _summary_latency(top_k)
+
+    return {"scale": n, "workdir": workdir, "enrich": enrich, "ingest": ingest, "recluster": recluster,
+            "search": search, "summary": summary}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return "unknown"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="1k,10k", help="comma-separated: 1k,10k,100k,1m or raw counts")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--enrich-rate", type=float, default=1000.0, help="token bucket rate against the stub")
+    parser.add_argument("--encode-workers", type=int, default=0, help="encoder processes for ingest (0: in-process)")
+    parser.add_argument("--out", default="bench_results.json")
+    args = parser.parse_args(argv)
+
+    from utils.config import config
+
+    out_path = os.path.abspath(args.out)
+    cwd = os.getcwd()
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {
+                "MODEL_NAME": config.MODEL_NAME,
+                "EMBEDDING_BACKEND": config.EMBEDDING_BACKEND,
+                "INDEX_TYPE": config.INDEX_TYPE,
+                "NPROBE": config.NPROBE,
+                "RERANK": config.RERANK,
+                "EMBED_CHUNK_SIZE": config.EMBED_CHUNK_SIZE,
+                "ENCODE_SHARD_SIZE": config.ENCODE_SHARD_SIZE,
+                "PARALLEL_EMBED_CHUNK_SIZE": config.PARALLEL_EMBED_CHUNK_SIZE,
+            },
+        },
+        "results": [],
+    }
+    for scale in args.scales.split(","):
+        try:
+            report["results"].append(run_scale(_parse_scale(scale), args.queries, args.top_k, args.enrich_rate,
+                                               args.encode_workers))
+        finally:
+            os.chdir(cwd)
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(f"Wrote {out_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
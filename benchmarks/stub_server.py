@@ -0,0 +1,136 @@
+import gzip
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+SUMMARIZATION_AGENT_ID = "stub-summarizer"
+STREAM_CHUNK_CHARS = 16  # summary text per streamed event
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """
+    Mimics the agent endpoint. Enrichment requests get their records echoed back under
+    agent_response.insidents, cut to max_incidents to imitate truncated agent output;
+    requests for SUMMARIZATION_AGENT_ID get a canned summary. The summary is "generated"
+    at chunk_delay seconds per STREAM_CHUNK_CHARS: requests with "stream": true receive
+    it as server-sent {"delta": ...} events as it is produced, others after all of it.
+    truncate_stream drops the closing [DONE] and the last half of the summary;
+    empty_summary answers summarization with no agent_response. Requests whose 1-based
+    number is in fail_requests are answered with fail_status. Gzip bodies are accepted.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, chunks: list):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        events = [f"data: {json.dumps({'delta': chunk})}\n\n" for chunk in chunks]
+        if self.server.truncate_stream:
+            chunks = chunks[:len(chunks) // 2]
+            events = events[:len(chunks)]
+        else:
+            events.append("data: [DONE]\n\n")
+        for i, event in enumerate(events):
+            if i < len(chunks):
+                time.sleep(self.server.chunk_delay)
+            data = event.encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        server = self.server
+        raw = self._read_body()
+        with server.lock:
+            server.requests += 1
+            server.bytes_received += len(raw)
+            request_number = server.requests
+        if self.headers.get("Content-Encoding") == "gzip":
+            raw = gzip.decompress(raw)
+        body = json.loads(raw)
+
+        if server.latency:
+            time.sleep(server.latency)
+        if request_number in server.fail_requests:
+            self._send_json(server.fail_status, {"success": False, "error": "stub failure"})
+            return
+        if server.error_rate and random.random() < server.error_rate:
+            self._send_json(503, {"success": False, "error": "stub overloaded"})
+            return
+
+        records = json.loads(body.get("user_query") or "[]")
+        if body.get("ai_agent_id") == SUMMARIZATION_AGENT_ID:
+            if server.empty_summary:
+                self._send_json(200, {"success": True, "data": {"responses": {}}})
+                return
+            text = json.dumps(_summary_for(records))
+            chunks = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+            if body.get("stream"):
+                self._send_stream(chunks)
+                return
+            time.sleep(server.chunk_delay * len(chunks))
+            agent_response = json.loads(text)
+        else:
+            agent_response = json.dumps({"insidents": records[:server.max_incidents]})
+        self._send_json(200, {"success": True, "data": {"responses": {"agent_response": agent_response}}})
+
+
+def _summary_for(records: list) -> dict:
+    return {
+        "incident_numbers": [r.get("Number") for r in records],
+        "overview": f"{len(records)} related incidents.",
+        "common_reasons": sorted({r.get("Resolution notes", "")[:60] for r in records})[:3],
+        "suggested_resolutions": ["Restart the affected service.", "Check recent changes."],
+        "key_takeaways": "Synthetic summary from the stub server.",
+    }
+
+
+@contextmanager
+def run_stub_server(latency: float = 0.0, error_rate: float = 0.0, max_incidents: int = None,
+                    chunk_delay: float = 0.0, truncate_stream: bool = False, empty_summary: bool = False,
+                    fail_requests=(), fail_status: int = 503):
+    """
+    Runs the stub on a free local port and yields (url, server); server.requests and
+    server.bytes_received count calls and request body bytes.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.max_incidents = max_incidents
+    server.chunk_delay = chunk_delay
+    server.truncate_stream = truncate_stream
+    server.empty_summary = empty_summary
+    server.fail_requests = set(fail_requests)
+    server.fail_status = fail_status
+    server.requests = 0
+    server.bytes_received = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/", server
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,63 @@
+import random
+from typing import Iterator
+
+SERVICES = [
+    "VPN", "Outlook", "SAP", "Oracle DB", "SharePoint", "Jenkins", "Citrix", "Active Directory",
+    "Kubernetes", "Payroll portal", "Printer", "Wi-Fi", "Teams", "ServiceNow", "Salesforce",
+]
+SYMPTOMS = [
+    "is down", "is very slow", "times out", "login fails", "returns error {code}", "keeps disconnecting",
+    "cannot be reached from {host}", "shows a blank page", "rejects valid credentials", "hangs on startup",
+]
+ERROR_CODES = [
+    "ORA-01017", "ORA-12541", "0x80070005", "0x800CCC0E", "HTTP 503", "HTTP 401", "ERR_CONNECTION_RESET",
+    "KRB5KDC_ERR_PREAUTH_FAILED", "SSL_ERROR_SYSCALL", "E1001",
+]
+CAUSES = [
+    "expired certificate on {host}", "disk full on {host}", "password expired for the service account",
+    "stale DNS record for {host}", "network switch port flapping", "license server unreachable",
+    "memory leak in the application pool", "firewall rule removed during change window",
+]
+FIXES = [
+    "Renewed the certificate and restarted the service.", "Cleared old logs and extended the volume.",
+    "Reset the service account password and updated the vault.", "Flushed DNS and corrected the record.",
+    "Replaced the faulty cable and re-enabled the port.", "Restarted the license service.",
+    "Recycled the application pool and applied the vendor patch.", "Restored the firewall rule.",
+]
+
+
+def _host(rng: random.Random) -> str:
+    return f"{rng.choice(['srv', 'db', 'app', 'web', 'vpn'])}-{rng.choice(['prd', 'uat', 'dev'])}-{rng.randint(1, 99):02d}"
+
+
+def generate_incidents(n: int, seed: int = 42) -> Iterator[dict]:
+    """Yields n synthetic incidents with the columns of a ServiceNow export."""
+    rng = random.Random(seed)
+    for i in range(n):
+        host = _host(rng)
+        code = rng.choice(ERROR_CODES)
+        service = rng.choice(SERVICES)
+        symptom = rng.choice(SYMPTOMS).format(code=code, host=host)
+        cause_idx = rng.randrange(len(CAUSES))
+        short = f"{service} {symptom}"
+        yield {
+            "Number": f"INC{i:08d}",
+            "Short description": short,
+            "Description": (
+                f"User reports that {service} {symptom}. Affected host {host}. "
+                f"Error shown: {code}. Impact: {rng.choice(['single user', 'team', 'whole site'])}."
+            ),
+            "Comments and Work notes": " ".join(
+                f"[{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}] checked {_host(rng)}" for _ in range(rng.randint(1, 6))
+            ),
+            "Resolution notes": f"Root cause: {CAUSES[cause_idx].format(host=host)}. {FIXES[cause_idx]}",
+        }
+
+
+def generate_queries(n: int, seed: int = 7) -> list:
+    """Free-text queries in the style engineers type into the search box."""
+    rng = random.Random(seed)
+    return [
+        f"{rng.choice(SERVICES).lower()} {rng.choice(SYMPTOMS).format(code=rng.choice(ERROR_CODES), host=_host(rng))}"
+        for _ in range(n)
+    ]
@@ -1,19 +1,24 @@
 import streamlit as st
 import os
-import math
 import time
 import traceback
 import pandas as pd
-from json_creator import create_json_from_file
-from http_client import (
-    post_incident_json,
-    extract_incidents_from_response,
-    get_summarized_output,
+from json_creator import create_ndjson_from_file, iter_ndjson, count_ndjson
+from dedup import collapse_ndjson, save_duplicates
+from search_pipeline import (
+    MIN_CONFIDENCE,
+    search_incidents,
+    summarize_results,
+    remote_search_with_summary,
+    stream_search_with_summary,
+    remote_stream_search_with_summary,
 )
+from enrichment import enrich_to_ndjson, count_batches
 from faiss_updater import update_faiss_with_new_data
-from retriever import IncidentRetriever
+from jobs import JobQueue, ensure_worker
 from utils.logger import get_logger
-import json
+from utils.config import config
+from utils.metrics import get_registry, start_metrics_server, write_metrics_file
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -23,10 +28,65 @@ logger = get_logger("app")
 DEFAULT_AI_AGENT_ID = os.getenv("AI_AGENT_ID")
 DEFAULT_SUMMARIZATION_AGENT_ID = os.getenv("SUMMARIZATION_AGENT_ID")
 DEFAULT_ENDPOINT = os.getenv("SAGE_ENDPOINT")
+SEARCH_SERVICE_URL = os.getenv("SEARCH_SERVICE_URL", config.SEARCH_SERVICE_URL)
+
+start_metrics_server()
 
 st.set_page_config(page_title="Incident Search", layout="centered")
 st.title("Incident Resolution Assistant")
 
+def render_summary(agent_response: dict, results: pd.DataFrame):
+    st.subheader("Related Incidents")
+    st.write(", ".join(agent_response.get("incident_numbers", [])))
+    duplicates = [n for members in results.get("duplicate_numbers", []) for n in members]
+    if duplicates:
+        st.caption(f"Near-duplicates of these incidents: {', '.join(duplicates)}")
+    st.subheader("Overview")
+    st.write(agent_response.get("overview", "N/A"))
+    st.subheader("Common Reasons")
+    for reason in agent_response.get("common_reasons", []):
+        st.write(f"- {reason}")
+    st.subheader("Suggested Resolutions")
+    for fix in agent_response.get("suggested_resolutions", []):
+        st.write(f"- {fix}")
+    st.subheader("Key Takeaways")
+    st.write(agent_response.get("key_takeaways", "N/A"))
+
+
+def search_and_stream(query: str):
+    """Shows the retrieved incidents as soon as search returns, then the summary as it streams in."""
+    start = time.perf_counter()
+    if SEARCH_SERVICE_URL:
+        events = remote_stream_search_with_summary(SEARCH_SERVICE_URL, query, 5)
+    else:
+        events = stream_search_with_summary(
+            query, 5, ai_agent_id=DEFAULT_SUMMARIZATION_AGENT_ID, endpoint=DEFAULT_ENDPOINT
+        )
+    results, agent_response, summary_area = None, None, None
+    for kind, payload in events:
+        if kind == "results":
+            results = payload
+            get_registry().observe("search.time_to_results", time.perf_counter() - start)
+            if results.empty:
+                st.info(f"No incidents found with sufficient confidence (>= {MIN_CONFIDENCE:.0f}%).")
+                return
+            st.subheader("Retrieved Incidents")
+            columns = [c for c in ("Number", "Short description", "confidence") if c in results.columns]
+            st.dataframe(results[columns], hide_index=True)
+            summary_area = st.empty()
+            summary_area.caption("Summarizing...")
+        elif kind == "summary" and summary_area is not None:
+            agent_response = payload
+            with summary_area.container():
+                render_summary(agent_response, results)
+    if summary_area is None:
+        return
+    if agent_response:
+        get_registry().observe("search.time_to_summary", time.perf_counter() - start)
+    else:
+        summary_area.warning("No summarized response found.")
+
+
 # Search Section
 st.header("Enter new Incident")
 query = st.text_input("Enter your issue:")
@@ -38,65 +98,58 @@ if st.button("Search"):
 
     else:
         try:
-            retriever = IncidentRetriever()
-            results, distances = retriever.search(query, 5)
-
-            if results.empty:
-                st.info("No matching incidents found.")
-
+            if config.SUMMARY_STREAMING:
+                search_and_stream(query)
             else:
-                # Calculate confidence scores and filter <40%
-                confidence_scores = [(1 / (1 + dist)) * 100 for dist in distances]
-                results["confidence"] = confidence_scores
-                results = results[results["confidence"] >= 40.0].reset_index(drop=True)
-
-                if results.empty:
-                    st.info("No incidents found with sufficient confidence (>= 40%).")
-
+                if SEARCH_SERVICE_URL:
+                    results, agent_response = remote_search_with_summary(SEARCH_SERVICE_URL, query, 5)
                 else:
-                    summary = get_summarized_output(
-                        results.to_dict(orient="records"),
+                    results = search_incidents(query, 5)
+                    agent_response = summarize_results(
+                        results,
                         ai_agent_id= DEFAULT_SUMMARIZATION_AGENT_ID,
-                        configuration_environment="DEV",
                         endpoint= DEFAULT_ENDPOINT,
                     )
-                    # Safely navigate nested JSON
-                    agent_response = (
-                        summary.get("data", {})
-                        .get("responses", {})
-                        .get("agent_response", {})
-                    )
 
-                    if not agent_response:
-                        st.warning("No summarized response found.")
-
-                    else:
-                        st.subheader("Related Incidents")
-                        st.write(", ".join(agent_response.get("incident_numbers", [])))
-                        st.subheader("Overview")
-                        st.write(agent_response.get("overview", "N/A"))
-                        st.subheader("Common Reasons")
-                        for reason in agent_response.get("common_reasons", []):
-                            st.write(f"- {reason}")
-                        st.subheader("Suggested Resolutions")
-                        for fix in agent_response.get("suggested_resolutions", []):
-                            st.write(f"- {fix}")
-                        st.subheader("Key Takeaways")
-                        st.write(agent_response.get("key_takeaways", "N/A"))
+                if results.empty:
+                    st.info(f"No incidents found with sufficient confidence (>= {MIN_CONFIDENCE:.0f}%).")
+
+                elif not agent_response:
+                    st.warning("No summarized response found.")
+
+                else:
+                    render_summary(agent_response, results)
 
         except Exception:
             st.error("Error during search:")
             logger.exception("Search error")
+        write_metrics_file()
 
 # Upload Section
-MAX_BATCH_SIZE = 10
-
 st.header("Upload Monthly Incidents")
 uploaded_file = st.file_uploader(
     "Upload CSV or Excel file", type=["csv", "xlsx", "xls"]
 )
 
-if uploaded_file is not None:
+if uploaded_file is not None and config.BACKGROUND_INGEST:
+
+    # Streamlit reruns the script on every interaction; queue each upload only once.
+    if st.session_state.get("queued_upload") != uploaded_file.file_id:
+        try:
+            os.makedirs(config.JOBS_DIR, exist_ok=True)
+            ext = uploaded_file.name.split(".")[-1].lower()
+            temp_path = os.path.join(config.JOBS_DIR, f"incoming_{uploaded_file.file_id}.{ext}")
+            with open(temp_path, "wb") as f:
+                f.write(uploaded_file.getbuffer())
+            job_id = JobQueue().submit(temp_path)
+            ensure_worker()
+            st.session_state["queued_upload"] = uploaded_file.file_id
+            st.success(f"Upload queued as job {job_id}. You can keep searching while it runs.")
+        except Exception:
+            st.error("Error while queueing the upload:")
+            logger.exception("Upload queueing error")
+
+elif uploaded_file is not None:
 
     try:
         os.makedirs("data", exist_ok=True)
@@ -106,90 +159,64 @@ if uploaded_file is not None:
         with open(temp_path, "wb") as f:
             f.write(uploaded_file.getbuffer())
 
-        st.info("Creating temporary JSON from uploaded file...")
-        temp_json_path = create_json_from_file(temp_path)
-        st.success(f"Temporary JSON created: {temp_json_path}")
-        logger.info("Temporary JSON created at %s", temp_json_path)
+        st.info("Creating temporary NDJSON from uploaded file...")
+        temp_ndjson_path = create_ndjson_from_file(temp_path)
+        st.success(f"Temporary NDJSON created: {temp_ndjson_path}")
+        logger.info("Temporary NDJSON created at %s", temp_ndjson_path)
 
-        with open(temp_json_path, "r", encoding="utf-8") as f:
-            all_incidents = json.load(f)
+        duplicates = []
+        if config.DEDUP_ENABLED:
+            dedup_stats = collapse_ndjson(temp_ndjson_path, duplicates=duplicates)
+            collapsed = dedup_stats["records"] - dedup_stats["representatives"]
+            if collapsed:
+                st.info(f"Collapsed {collapsed} near-duplicate incident(s); only their representatives are enriched.")
 
-        total = len(all_incidents)
-        num_batches = math.ceil(total / MAX_BATCH_SIZE)
+        total = count_ndjson(temp_ndjson_path)
+        num_batches = count_batches(iter_ndjson(temp_ndjson_path))
         st.info(
-            f"Total incidents: {total}. Processing in {num_batches} batch(es) of up to {MAX_BATCH_SIZE} each."
+            f"Total incidents: {total}. Processing in {num_batches} batch(es) of up to {config.ENRICH_BATCH_SIZE} "
+            f"incidents or ~{config.ENRICH_BATCH_TOKENS} tokens each."
         )
-        all_processed_incidents = []
-
-        for i in range(num_batches):
-            batch = all_incidents[i * MAX_BATCH_SIZE : (i + 1) * MAX_BATCH_SIZE]
-            st.write(f"Processing batch {i + 1}/{num_batches} ({len(batch)} items)...")
-            batch_path = os.path.join("data", f"batch_{i + 1}.json")
-
-            with open(batch_path, "w", encoding="utf-8") as bf:
-                json.dump(batch, bf, ensure_ascii=False, indent=2)
-
-            try:
-                response_json = post_incident_json(
-                    json_path=batch_path,
-                    ai_agent_id= DEFAULT_AI_AGENT_ID,
-                    configuration_environment="DEV",
-                    endpoint= DEFAULT_ENDPOINT,
-                )
-                logger.info("Batch %d response: %s", i + 1, response_json)
-                success_flag = response_json.get("success") or (
-                    response_json.get("status") == "success"
-                )
-
-                if not success_flag:
-                    logger.warning(
-                        "Batch %d: Remote endpoint returned success=false: %s",
-                        i + 1,
-                        response_json,
-                    )
-                    st.warning(
-                        f"Batch {i + 1}: Remote endpoint returned success=false. Skipping this batch."
-                    )
-                    continue
-                incidents = extract_incidents_from_response(response_json)
-
-                if incidents:
-                    all_processed_incidents.extend(incidents)
-                    st.success(
-                        f"Batch {i + 1}: Received {len(incidents)} incidents from remote."
-                    )
-                    logger.info(
-                        "Batch %d: Extracted %d incidents", i + 1, len(incidents)
-                    )
-
-                else:
-                    st.warning(f"Batch {i + 1}: No incidents found in remote response.")
-                    logger.warning(
-                        "Batch %d: No incidents found in response: %s",
-                        i + 1,
-                        response_json,
-                    )
-
-            except Exception as e:
-                logger.exception("Batch %d failed: %s", i + 1, e)
-                st.error(f"Batch {i + 1} failed — continuing...")
-                continue
-            time.sleep(3)
+        progress_bar = st.progress(0.0)
+        status_text = st.empty()
+
+        def report_progress(done, _, message):
+            progress_bar.progress(done / num_batches, text=f"Batch {done}/{num_batches}")
+            status_text.write(message)
+
+        processed_path = config.PROCESSED_NDJSON
+        enrich_stats = enrich_to_ndjson(
+            iter_ndjson(temp_ndjson_path),
+            processed_path,
+            ai_agent_id= DEFAULT_AI_AGENT_ID,
+            endpoint= DEFAULT_ENDPOINT,
+            progress_callback=report_progress,
+            total_records=total,
+        )
+        if enrich_stats["cache_hits"]:
+            st.info(
+                f"Enrichment cache: {enrich_stats['cache_hits']} of "
+                f"{enrich_stats['cache_hits'] + enrich_stats['cache_misses']} incidents unchanged since a previous upload."
+            )
+        if enrich_stats["missing"]:
+            st.warning(f"{enrich_stats['missing']} incident(s) were still missing from the agent's responses after retries.")
+        if enrich_stats["rejected"] or enrich_stats["failed"]:
+            st.warning(
+                f"{enrich_stats['rejected']} batch(es) rejected and {enrich_stats['failed']} failed — skipped."
+            )
 
-        if not all_processed_incidents:
+        if not enrich_stats["incidents"]:
             st.error("No incidents successfully processed.")
             logger.error("No batches processed successfully.")
 
         else:
-            processed_path = os.path.join("data", "incidents_from_api.json")
-            with open(processed_path, "w", encoding="utf-8") as f:
-                json.dump(all_processed_incidents, f, ensure_ascii=False, indent=2)
             st.success(
-                f"All batches completed. Total incidents received: {len(all_processed_incidents)}"
+                f"All batches completed. Total incidents received: {enrich_stats['incidents']}"
             )
             logger.info("Saved all incidents to %s", processed_path)
             st.info("Updating FAISS index (this may take a while)...")
             new_count, total_count = update_faiss_with_new_data(processed_path)
+            save_duplicates(duplicates)
             st.success(
                 f"FAISS update complete. Added {new_count} new incidents. Total: {total_count}"
             )
@@ -202,3 +229,25 @@ if uploaded_file is not None:
     except Exception:
         st.error("Error during upload and processing:")
         logger.exception("Upload processing error")
+    write_metrics_file()
+
+if config.BACKGROUND_INGEST:
+    jobs = JobQueue().list_jobs(limit=5)
+    if jobs:
+        st.subheader("Ingest Jobs")
+        st.button("Refresh status")
+        for job in jobs:
+            label = f"Job {job['job_id']}: {job['status']}"
+            if job["status"] == "running" and job["total_batches"]:
+                st.progress(job["batches_done"] / job["total_batches"],
+                            text=f"{label} — {job['stage']}, batch {job['batches_done']}/{job['total_batches']}")
+            else:
+                st.write(f"{label} — {job['message'] or ''}")
+
+if config.METRICS_DEBUG_PANEL:
+    with st.expander("Debug: stage timings"):
+        snapshot = get_registry().snapshot()
+        if snapshot["stages"]:
+            st.dataframe(pd.DataFrame(snapshot["stages"]).round(2), hide_index=True)
+        if snapshot["counters"]:
+            st.dataframe(pd.DataFrame(snapshot["counters"].items(), columns=["event", "count"]), hide_index=True)
@@ -0,0 +1,126 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from utils.logger import get_logger
+from utils.config import config
+from utils.metrics import get_registry, inc
+from retriever import get_retriever
+
+logger = get_logger("batcher")
+
+
+class QueryBatcher:
+    """
+    Coalesces concurrent search() calls into one search_many() call per top_k. A lone caller
+    is dispatched immediately; when other callers are in flight the dispatcher waits
+    up to window_ms for more queries, or until max_batch are queued.
+    """
+
+    def __init__(self, window_ms: float = None, max_batch: int = None, retriever_getter=get_retriever):
+        self.window = (config.BATCH_WINDOW_MS if window_ms is None else window_ms) / 1000.0
+        self.max_batch = max_batch or config.BATCH_MAX_SIZE
+        self._get_retriever = retriever_getter
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._batches = 0
+        self._queries = 0
+        self._max_batch_seen = 0
+        self._max_queue_depth = 0
+        self._batch_sizes = {}
+        self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self._thread.start()
+
+    def search(self, query: str, top_k: int = 5):
+        """Same contract as IncidentRetriever.search(): returns (results, distances)."""
+        future = Future()
+        with self._lock:
+            self._inflight += 1
+        try:
+            self._queue.put((query, top_k, future, time.perf_counter()))
+            with self._lock:
+                self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+            return future.result()
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "batches": self._batches,
+                "queries": self._queries,
+                "mean_batch_size": self._queries / self._batches if self._batches else 0.0,
+                "max_batch_size": self._max_batch_seen,
+                "batch_size_counts": dict(sorted(self._batch_sizes.items())),
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self._max_queue_depth,
+                "inflight": self._inflight,
+                "window_ms": self.window * 1000.0,
+                "max_batch": self.max_batch,
+            }
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        with self._lock:
+            concurrent = self._inflight > 1
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                if concurrent:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # Nobody else is waiting: take whatever is already queued and go.
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            dispatched = time.perf_counter()
+            for _, _, _, enqueued in batch:
+                get_registry().observe("batcher.queue_wait", dispatched - enqueued)
+            self._record(len(batch))
+            # Token matches and their fusion depend on top_k, so each top_k is searched on
+            # its own: a caller gets the same results whatever it was batched with.
+            groups = {}
+            for entry in batch:
+                groups.setdefault(entry[1], []).append(entry)
+            try:
+                retriever = self._get_retriever()
+                for top_k, group in groups.items():
+                    outputs = retriever.search_many([q for q, _, _, _ in group], top_k)
+                    for (_, _, future, _), result in zip(group, outputs):
+                        future.set_result(result)
+            except Exception as e:
+                logger.exception("Batched search of %d queries failed: %s", len(batch), e)
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _record(self, size: int):
+        with self._lock:
+            self._batches += 1
+            self._queries += size
+            self._max_batch_seen = max(self._max_batch_seen, size)
+            self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+        inc("batcher_batches")
+        inc("batcher_queries", size)
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher() -> QueryBatcher:
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = QueryBatcher()
+        return _batcher
@@ -2,11 +2,13 @@ import os
 import json
 import pickle
 import numpy as np
-import pandas as pd
 import faiss
 from sklearn.cluster import MiniBatchKMeans
 from utils.logger import get_logger
+from metadata_store import open_metadata_store
+from generations import GenerationBuilder, generation_path, index_write_lock
 from utils.config import config
+from utils.metrics import span, timed, inc
 
 logger = get_logger("cluster_manager")
 
@@ -21,57 +23,290 @@ def _determine_num_clusters(n_samples: int) -> int:
         return min(config.MAX_CLUSTERS, max(config.MIN_CLUSTERS, n_samples // 500))
 
 
-def recluster_and_update_indices(embeddings: np.ndarray, combined_df: pd.DataFrame):
-    n_samples = len(embeddings)
-    if n_samples == 0:
+def recluster_and_update_indices(embeddings: np.ndarray, builder: GenerationBuilder = None, row_ids=None):
+    """
+    Fits new clusters and writes the cluster model, IVF index and stats into builder.
+    Only row_ids are clustered and indexed; by default the current version of every
+    incident, so rows superseded by a newer version are left out. Without a builder,
+    the result is published as a new generation of its own.
+    """
+    if row_ids is None:
+        row_ids = open_metadata_store().current_row_ids(end=len(embeddings))
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    if len(row_ids) == 0:
         logger.warning("No embeddings available for clustering. Skipping.")
         return
+    if builder is not None:
+        _recluster(embeddings, row_ids, builder)
+        return
+    with index_write_lock():
+        builder = GenerationBuilder()
+        try:
+            _recluster(embeddings, row_ids, builder)
+            builder.publish(len(embeddings))
+        except Exception:
+            builder.discard()
+            raise
+
+
+@timed("recluster.total")
+def _recluster(all_embeddings: np.ndarray, row_ids: np.ndarray, builder: GenerationBuilder):
+    # Without superseded rows the memmap is used as is; otherwise only the current rows are read.
+    if len(row_ids) == len(all_embeddings):
+        embeddings = all_embeddings
+    else:
+        embeddings = np.asarray(all_embeddings[row_ids], dtype=np.float32)
+    n_samples = len(embeddings)
 
     num_clusters = min(_determine_num_clusters(n_samples), n_samples)
     logger.info("Starting reclustering on %d embeddings using %d clusters...", n_samples, num_clusters)
 
-    os.makedirs(config.CLUSTER_FAISS_DIR, exist_ok=True)
-
     kmeans = MiniBatchKMeans(
         n_clusters=num_clusters,
         batch_size=config.BATCH_SIZE,
         random_state=42,
         verbose=0
     )
-    cluster_ids = kmeans.fit_predict(embeddings)
+    with span("recluster.kmeans"):
+        cluster_ids = kmeans.fit_predict(embeddings)
     logger.info("Clustering completed: %d clusters formed.", num_clusters)
 
-    with open(config.CLUSTER_MODEL_FILE, "wb") as f:
+    with open(builder.path("cluster_model"), "wb") as f:
         pickle.dump(kmeans, f)
-    logger.info("Saved MiniBatchKMeans model to %s", config.CLUSTER_MODEL_FILE)
+    logger.info("Saved MiniBatchKMeans model to %s", builder.path("cluster_model"))
 
-    combined_df = combined_df.copy()
-    combined_df["cluster_id"] = cluster_ids
-    combined_df.to_json(config.CLUSTER_ASSIGNMENTS_FILE, orient="records", indent=2, force_ascii=False)
-    logger.info("Saved cluster assignments to %s", config.CLUSTER_ASSIGNMENTS_FILE)
+    # One entry per row of the generation; -1 marks rows that are not indexed.
+    generation_cluster_ids = np.full(len(all_embeddings), -1, dtype=np.int32)
+    generation_cluster_ids[row_ids] = cluster_ids
+    np.save(builder.path("cluster_ids"), generation_cluster_ids)
+    open_metadata_store().set_cluster_ids(row_ids.tolist(), cluster_ids)
 
+    # One IVF index whose coarse quantizer holds the trained centroids replaces the
+    # per-cluster flat indexes; inverted list i contains exactly the members of cluster i.
     dim = embeddings.shape[1]
-    total_saved = 0
-    for cluster in range(num_clusters):
-        cluster_indices = np.where(cluster_ids == cluster)[0]
-        if len(cluster_indices) == 0:
-            continue
-
-        cluster_embeddings = embeddings[cluster_indices].astype(np.float32)
-        cluster_index = faiss.IndexFlatL2(dim)
-        cluster_index.add(cluster_embeddings)
+    quantizer = faiss.IndexFlatL2(dim)
+    quantizer.add(kmeans.cluster_centers_.astype(np.float32))
+    with span("recluster.build_index"):
+        index = _new_ivf_index(quantizer, dim, num_clusters, embeddings)
+        for start in range(0, n_samples, config.BATCH_SIZE):
+            chunk = np.ascontiguousarray(embeddings[start:start + config.BATCH_SIZE], dtype=np.float32)
+            index.add_with_ids(chunk, row_ids[start:start + len(chunk)])
+    with span("index.write"):
+        faiss.write_index(index, builder.path("ivf_index"))
+    builder.info["index"] = _index_info(index)
+    inc("full_reclusters")
+    inc("vectors_indexed", index.ntotal)
+    logger.info("Saved IVF index with %d lists and %d vectors to %s",
+                num_clusters, index.ntotal, builder.path("ivf_index"))
 
-        cluster_path = os.path.join(config.CLUSTER_FAISS_DIR, f"cluster_{cluster}.faiss")
-        faiss.write_index(cluster_index, cluster_path)
-        total_saved += len(cluster_indices)
-        logger.info("Cluster %d: saved %d vectors to %s", cluster, len(cluster_indices), cluster_path)
+    sizes = np.bincount(cluster_ids, minlength=num_clusters)
+    sq_distance_sum = 0.0
+    for start in range(0, n_samples, config.BATCH_SIZE):
+        chunk = np.asarray(embeddings[start:start + config.BATCH_SIZE], dtype=np.float32)
+        diff = chunk - kmeans.cluster_centers_[cluster_ids[start:start + config.BATCH_SIZE]]
+        sq_distance_sum += float((diff * diff).sum())
+    _save_cluster_stats(builder.path("cluster_stats"), {
+        "n_samples": n_samples,
+        "mean_sq_distance": sq_distance_sum / n_samples,
+        "imbalance": _imbalance(sizes),
+        "cluster_sizes": sizes.tolist(),
+        "incremental_count": 0,
+        "incremental_sq_distance_sum": 0.0,
+    })
 
+    _remove_legacy_cluster_indexes()
     logger.info("Reclustering completed — %d clusters updated, %d total vectors processed.",
-                num_clusters, total_saved)
+                num_clusters, index.ntotal)
+
+
+def _new_ivf_index(quantizer, dim: int, nlist: int, embeddings: np.ndarray):
+    """
+    Builds the IVF index for config.INDEX_TYPE over an already populated quantizer.
+    SQ8 and PQ codebooks are trained on a sample of the embeddings; the quantizer is
+    left untouched because it already holds nlist centroids.
+    """
+    index_type = config.INDEX_TYPE
+    n_samples = len(embeddings)
+    if index_type == "pq" and n_samples < 2 ** config.PQ_NBITS:
+        logger.warning("Only %d vectors; too few to train PQ codebooks, using a flat IVF index.", n_samples)
+        index_type = "flat"
+
+    if index_type == "flat":
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_L2)
+        index.is_trained = True
+        return index
+    if index_type == "sq8":
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+    elif index_type == "pq":
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, config.PQ_M, config.PQ_NBITS)
+    else:
+        raise ValueError(f"Unknown INDEX_TYPE {index_type!r}; expected 'flat', 'sq8' or 'pq'")
+
+    rng = np.random.default_rng(42)
+    sample_ids = np.sort(rng.choice(n_samples, size=min(config.INDEX_TRAIN_SAMPLE, n_samples), replace=False))
+    sample = np.ascontiguousarray(embeddings[sample_ids], dtype=np.float32)
+    index.train(sample)
+    logger.info("Trained %s IVF index on %d sample vectors", index_type, len(sample))
+    return index
+
+
+@timed("incremental.total")
+def update_clusters_incremental(
+    builder: GenerationBuilder,
+    embeddings: np.ndarray,
+    row_ids: np.ndarray,
+    removed_row_ids: np.ndarray = None,
+) -> bool:
+    """
+    Assigns the vectors of row_ids (rows of embeddings) to the current generation's
+    centroids and writes the extended IVF index into builder. Rows superseded by a
+    newer version (removed_row_ids) are taken out of the index. Returns False when a
+    full recluster is required instead: missing state, rows that no longer line up
+    with the index, or drift past the configured thresholds.
+    """
+    ivf_path, stats_path = generation_path("ivf_index", builder.parent), generation_path("cluster_stats", builder.parent)
+    ids_path = generation_path("cluster_ids", builder.parent)
+    if not (os.path.exists(ivf_path) and os.path.exists(stats_path) and os.path.exists(ids_path)):
+        logger.info("No existing cluster state; full recluster required.")
+        return False
+
+    with span("index.read"):
+        index = faiss.read_index(ivf_path)
+    stats = _load_cluster_stats(stats_path)
+    generation_cluster_ids = np.load(ids_path)
+    metadata = open_metadata_store()
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    removed_row_ids = np.asarray(removed_row_ids if removed_row_ids is not None else [], dtype=np.int64)
+    n_new, n_removed = len(row_ids), len(removed_row_ids)
+    indexed_rows = len(generation_cluster_ids)
+
+    n_rows = metadata.next_row_id()
+    if (
+        index.ntotal != int((generation_cluster_ids >= 0).sum())
+        or n_rows > len(embeddings)
+        or (n_new and row_ids.min() < indexed_rows)
+        or (n_removed and (generation_cluster_ids[removed_row_ids] < 0).any())
+    ):
+        logger.warning(
+            "Cluster state out of sync (index=%d, cluster ids=%d, rows=%d, new=%d); full recluster required.",
+            index.ntotal, indexed_rows, n_rows, n_new
+        )
+        return False
+
+    if index.ntotal + n_new - n_removed > stats["n_samples"] * config.MAX_INCREMENTAL_GROWTH:
+        logger.info("Corpus grew from %d to %d since the last full fit; full recluster required.",
+                    stats["n_samples"], index.ntotal + n_new - n_removed)
+        return False
+
+    if n_new or n_removed:
+        # Assign through the IVF quantizer so the lists stay exactly aligned with the
+        # centroids; those centroids are the frozen KMeans centers. Vectors are read in
+        # slices, so a large backfill is never held in memory at once.
+        cluster_ids = np.empty(n_new, dtype=np.int64)
+        sq_distance_sum = 0.0
+        for offset, vectors in _iter_rows(embeddings, row_ids):
+            sq_distances, labels = index.quantizer.search(vectors, 1)
+            cluster_ids[offset:offset + len(vectors)] = labels[:, 0]
+            sq_distance_sum += float(sq_distances.sum())
 
+        sizes = np.asarray(stats["cluster_sizes"], dtype=np.int64) + np.bincount(cluster_ids, minlength=index.nlist)
+        if n_removed:
+            sizes -= np.bincount(generation_cluster_ids[removed_row_ids], minlength=index.nlist)
+        incremental_count = stats["incremental_count"] + n_new
+        incremental_sum = stats["incremental_sq_distance_sum"] + sq_distance_sum
 
-def load_cluster_model():
-    if not os.path.exists(config.CLUSTER_MODEL_FILE):
+        drift = (incremental_sum / max(incremental_count, 1)) / max(stats["mean_sq_distance"], 1e-12)
+        imbalance = _imbalance(sizes) / max(stats["imbalance"], 1e-12)
+        logger.info("Incremental clustering drift=%.3f imbalance=%.3f for %d added and %d superseded vectors",
+                    drift, imbalance, n_new, n_removed)
+        if drift > config.DRIFT_THRESHOLD or imbalance > config.IMBALANCE_THRESHOLD:
+            logger.info("Drift past threshold (drift=%.3f/%.3f, imbalance=%.3f/%.3f); full recluster required.",
+                        drift, config.DRIFT_THRESHOLD, imbalance, config.IMBALANCE_THRESHOLD)
+            inc("incremental_drift_fallbacks")
+            return False
+
+        with span("incremental.add"):
+            if n_removed:
+                index.remove_ids(removed_row_ids)
+            for offset, vectors in _iter_rows(embeddings, row_ids):
+                index.add_with_ids(vectors, row_ids[offset:offset + len(vectors)])
+        with span("index.write"):
+            faiss.write_index(index, builder.path("ivf_index"))
+        inc("incremental_updates")
+        inc("vectors_added", n_new)
+        inc("vectors_replaced", n_removed)
+        logger.info("Added %d vectors to IVF index (%d superseded removed, total now: %d)",
+                    n_new, n_removed, index.ntotal)
+
+        stats.update({
+            "cluster_sizes": sizes.tolist(),
+            "incremental_count": incremental_count,
+            "incremental_sq_distance_sum": incremental_sum,
+        })
+        _save_cluster_stats(builder.path("cluster_stats"), stats)
+        metadata.set_cluster_ids(row_ids.tolist(), cluster_ids)
+    generation_cluster_ids = np.concatenate([
+        generation_cluster_ids, np.full(n_rows - indexed_rows, -1, dtype=np.int32)
+    ])
+    generation_cluster_ids[removed_row_ids] = -1
+    generation_cluster_ids[row_ids] = cluster_ids if n_new else []
+    np.save(builder.path("cluster_ids"), generation_cluster_ids)
+    builder.info["index"] = _index_info(index)
+    return True
+
+
+def _iter_rows(embeddings: np.ndarray, row_ids: np.ndarray):
+    """Yields (offset, float32 vectors) for row_ids, BATCH_SIZE rows at a time."""
+    for start in range(0, len(row_ids), config.BATCH_SIZE):
+        ids = row_ids[start:start + config.BATCH_SIZE]
+        yield start, np.ascontiguousarray(embeddings[ids], dtype=np.float32)
+
+
+def _imbalance(sizes: np.ndarray) -> float:
+    sizes = np.asarray(sizes)
+    return float(sizes.max() / max(sizes.mean(), 1e-12)) if len(sizes) else 0.0
+
+
+def _index_info(index) -> dict:
+    return {"type": type(index).__name__, "nlist": int(index.nlist), "ntotal": int(index.ntotal)}
+
+
+def _load_cluster_stats(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_cluster_stats(path: str, stats: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(stats, f)
+
+
+def _remove_legacy_cluster_indexes():
+    if not os.path.isdir(config.CLUSTER_FAISS_DIR):
+        return
+    removed = 0
+    for name in os.listdir(config.CLUSTER_FAISS_DIR):
+        if name.startswith("cluster_") and name.endswith(".faiss"):
+            os.remove(os.path.join(config.CLUSTER_FAISS_DIR, name))
+            removed += 1
+    if not os.listdir(config.CLUSTER_FAISS_DIR):
+        os.rmdir(config.CLUSTER_FAISS_DIR)
+    logger.info("Removed %d legacy per-cluster index files from %s", removed, config.CLUSTER_FAISS_DIR)
+
+
+def load_cluster_model(generation: str = None):
+    path = generation_path("cluster_model", generation)
+    if not os.path.exists(path):
         raise FileNotFoundError("Cluster model not found. Run reclustering first.")
-    with open(config.CLUSTER_MODEL_FILE, "rb") as f:
+    with span("cluster_model.load"), open(path, "rb") as f:
         return pickle.load(f)
+
+
+def load_ivf_index(nprobe: int = None, generation: str = None):
+    path = generation_path("ivf_index", generation)
+    if not os.path.exists(path):
+        raise FileNotFoundError("IVF index not found. Run reclustering first.")
+    with span("index.read"):
+        index = faiss.read_index(path)
+    index.nprobe = min(nprobe or config.NPROBE, index.nlist)
+    return index
@@ -0,0 +1,247 @@
+import os
+import faiss
+import numpy as np
+from typing import Dict, Iterable, Iterator, List
+from utils.logger import get_logger
+from utils.config import config
+from utils.metrics import span, inc
+from embedder import get_encoder
+from metadata_store import open_metadata_store
+from generations import index_write_lock
+from json_creator import iter_ndjson, write_ndjson
+
+logger = get_logger("dedup")
+
+
+def _raw_text(record: dict) -> str:
+    return f"{record.get('Short description') or ''} {record.get('Description') or ''}".strip()
+
+
+def _chunks(records: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    chunk = []
+    for rec in records:
+        chunk.append(rec)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_collapsed(records: Iterable[dict], stats: Dict = None, duplicates: List[dict] = None) -> Iterator[dict]:
+    """
+    Yields one representative per group of near-duplicate raw incidents, so only
+    representatives are enriched and indexed. A record is a duplicate when its raw
+    text embedding lies within DEDUP_MAX_DISTANCE (squared L2) of an indexed incident's
+    raw text embedding or of an earlier representative in the same upload. Nothing is
+    written here: duplicates is extended with one entry per collapsed record and one
+    per representative, carrying its raw text, to be passed to save_duplicates() once
+    the upload is indexed. stats is updated in place.
+    """
+    if stats is None:
+        stats = {}
+    if duplicates is None:
+        duplicates = []
+    for key in ("records", "representatives", "duplicates_in_upload", "duplicates_of_indexed"):
+        stats.setdefault(key, 0)
+
+    model = get_encoder(config.DEDUP_BACKEND)
+    metadata = open_metadata_store()
+    index = _read_dedup_index()
+    if index is None and metadata.count():
+        with index_write_lock():
+            index = _read_dedup_index() or _build_dedup_index(model, metadata)
+    radius = config.DEDUP_MAX_DISTANCE
+    upload_reps = None
+    upload_rep_numbers = []
+
+    for chunk in _chunks(records, config.EMBED_CHUNK_SIZE):
+        stats["records"] += len(chunk)
+        # Incidents that are already indexed under their own Number go through the normal update path.
+        known = metadata.get_row_ids([rec.get("Number") for rec in chunk])
+        candidates = [rec for rec in chunk if rec.get("Number") and rec["Number"] not in known]
+        passthrough = [rec for rec in chunk if not (rec.get("Number") and rec["Number"] not in known)]
+        yield from passthrough
+        stats["representatives"] += len(passthrough)
+        duplicates.extend(_representative(rec) for rec in passthrough if rec.get("Number"))
+        if not candidates:
+            continue
+
+        with span("dedup.encode"):
+            vectors = np.ascontiguousarray(
+                model.encode([_raw_text(rec) for rec in candidates], convert_to_numpy=True, show_progress_bar=False),
+                dtype=np.float32,
+            )
+        if upload_reps is None:
+            upload_reps = faiss.IndexFlatL2(vectors.shape[1])
+            if index is not None and index.d != vectors.shape[1]:
+                logger.warning("%s holds %d-d vectors but the encoder returns %d-d; not matching against it.",
+                               config.DEDUP_INDEX_FILE, index.d, vectors.shape[1])
+                index = None
+
+        # Nearest earlier match for each candidate, from the index and from this upload's representatives.
+        best = [(None, np.inf, None)] * len(candidates)
+        with span("dedup.range_search"):
+            sources = [("duplicates_of_indexed", index, None), ("duplicates_in_upload", upload_reps, upload_rep_numbers)]
+            for origin, source, numbers in sources:
+                if source is None or source.ntotal == 0:
+                    continue
+                lims, distances, labels = source.range_search(vectors, radius)
+                if numbers is None:
+                    numbers = _numbers_for_rows(metadata, labels)
+                else:
+                    numbers = dict(enumerate(numbers))
+                for i in range(len(candidates)):
+                    for d, label in zip(distances[lims[i]:lims[i + 1]], labels[lims[i]:lims[i + 1]]):
+                        number = numbers.get(int(label))
+                        if number and d < best[i][1]:
+                            best[i] = (number, float(d), origin)
+            in_chunk = faiss.IndexFlatL2(vectors.shape[1])
+            in_chunk.add(vectors)
+            lims, distances, labels = in_chunk.range_search(vectors, radius)
+
+        collapsed = []
+        repeated = []
+        new_rep_positions = []
+        for i, rec in enumerate(candidates):
+            number, distance, origin = best[i]
+            # Earlier representatives of the same chunk are not in upload_reps yet.
+            for d, j in zip(distances[lims[i]:lims[i + 1]], labels[lims[i]:lims[i + 1]]):
+                if j < i and j in new_rep_positions and d < distance:
+                    number, distance, origin = candidates[j]["Number"], float(d), "duplicates_in_upload"
+            if number == rec["Number"]:
+                repeated.append(rec)
+                yield rec  # repeated within the upload; the indexer treats it as an update
+                continue
+            if number is None:
+                new_rep_positions.append(i)
+                yield rec
+                continue
+            collapsed.append({"number": rec["Number"], "representative": number, "distance": distance})
+            stats[origin] += 1
+
+        if new_rep_positions:
+            upload_reps.add(vectors[new_rep_positions])
+            upload_rep_numbers.extend(candidates[i]["Number"] for i in new_rep_positions)
+        stats["representatives"] += len(new_rep_positions)
+        # A former duplicate that no longer matches anything is indexed under its own Number.
+        duplicates.extend(_representative(candidates[i]) for i in new_rep_positions)
+        duplicates.extend(_representative(rec) for rec in repeated)
+        duplicates.extend(collapsed)
+        inc("dedup_records", len(candidates))
+        inc("dedup_collapsed", len(collapsed))
+
+    logger.info("Near-duplicate collapsing: %s", stats)
+
+
+def _numbers_for_rows(metadata, row_ids) -> dict:
+    row_ids = sorted({int(r) for r in row_ids if r >= 0})
+    if not row_ids:
+        return {}
+    records = metadata.fetch(row_ids, include_row_id=True)
+    return dict(zip(records["row_id"], records["Number"])) if not records.empty else {}
+
+
+def _representative(record: dict) -> dict:
+    return {"number": record["Number"], "representative": None, "text": _raw_text(record)}
+
+
+def _read_dedup_index():
+    if not os.path.exists(config.DEDUP_INDEX_FILE):
+        return None
+    with span("dedup.index_read"):
+        return faiss.read_index(config.DEDUP_INDEX_FILE)
+
+
+def _write_dedup_index(index):
+    tmp_path = config.DEDUP_INDEX_FILE + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, config.DEDUP_INDEX_FILE)
+
+
+def _add_raw_texts(index, model, metadata, texts: Dict[str, str]):
+    """
+    Stores the raw text vectors of indexed incidents under their current row id,
+    replacing the vectors of their earlier versions. Returns the (possibly new) index
+    and the number of vectors added.
+    """
+    # Records without raw text would all collapse onto one empty-text vector.
+    rows = metadata.get_row_ids([n for n, text in texts.items() if text])
+    if index is not None:
+        present = set(faiss.vector_to_array(index.id_map).tolist())
+        rows = {n: r for n, r in rows.items() if r not in present}
+    if not rows:
+        return index, 0
+    with span("dedup.encode"):
+        vectors = np.ascontiguousarray(
+            model.encode([texts[n] for n in rows], convert_to_numpy=True, show_progress_bar=False),
+            dtype=np.float32,
+        )
+    if index is None:
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(vectors.shape[1]))
+    superseded = metadata.superseded_row_ids(list(rows))
+    if superseded:
+        index.remove_ids(np.asarray(superseded, dtype=np.int64))
+    index.add_with_ids(vectors, np.asarray(list(rows.values()), dtype=np.int64))
+    return index, len(rows)
+
+
+def _build_dedup_index(model, metadata):
+    """Raw-text vectors for every indexed incident, for incidents indexed before the dedup index existed."""
+    row_ids = metadata.current_row_ids()
+    logger.info("Building %s from %d indexed incidents", config.DEDUP_INDEX_FILE, len(row_ids))
+    index = None
+    for start in range(0, len(row_ids), config.EMBED_CHUNK_SIZE):
+        records = metadata.fetch(row_ids[start:start + config.EMBED_CHUNK_SIZE]).to_dict(orient="records")
+        index, _ = _add_raw_texts(index, model, metadata, {rec["Number"]: _raw_text(rec) for rec in records})
+    if index is not None:
+        _write_dedup_index(index)
+    return index
+
+
+def save_duplicates(duplicates: Iterable[dict]) -> int:
+    """
+    Records the near-duplicates collected by iter_collapsed() whose representative is
+    indexed, releases former duplicates that were indexed under their own Number, and
+    adds the raw text of indexed representatives to the dedup index. Entries whose
+    incident did not make it into the index (e.g. its enrichment batch failed) are
+    dropped, so they are collapsed again on the next upload instead of pointing at an
+    incident search cannot return. Returns the number of duplicates recorded.
+    """
+    metadata = open_metadata_store()
+    model = get_encoder(config.DEDUP_BACKEND)
+    recorded = dropped = 0
+    with index_write_lock():
+        index = _read_dedup_index() or _build_dedup_index(model, metadata)
+        added = 0
+        for chunk in _chunks(duplicates, config.EMBED_CHUNK_SIZE):
+            collapsed = [d for d in chunk if d.get("representative")]
+            released = [d["number"] for d in chunk if not d.get("representative")]
+            indexed = metadata.get_row_ids([d["representative"] for d in collapsed] + released)
+            rows = [(d["number"], d["representative"], d["distance"]) for d in collapsed if d["representative"] in indexed]
+            metadata.remove_duplicates([n for n in released if n in indexed])
+            if rows:
+                metadata.add_duplicates(rows)
+            recorded += len(rows)
+            dropped += len(collapsed) - len(rows)
+
+            texts = {d["number"]: d["text"] for d in chunk if d.get("text") is not None and d["number"] in indexed}
+            if texts:
+                index, n = _add_raw_texts(index, model, metadata, texts)
+                added += n
+        if added:
+            _write_dedup_index(index)
+    if dropped:
+        logger.warning("Dropped %d near-duplicate(s) whose representative was not indexed", dropped)
+    logger.info("Recorded %d near-duplicate(s)", recorded)
+    return recorded
+
+
+def collapse_ndjson(in_path: str, out_path: str = None, duplicates: List[dict] = None) -> Dict:
+    """
+    Rewrites an NDJSON file of raw incidents with near-duplicates removed; returns the
+    stats. duplicates is extended as by iter_collapsed().
+    """
+    stats = {}
+    write_ndjson(iter_collapsed(iter_ndjson(in_path), stats, duplicates), out_path or in_path)
+    return stats
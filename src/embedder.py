@@ -0,0 +1,164 @@
+import os
+import sys
+import argparse
+import threading
+import multiprocessing as mp
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from utils.logger import get_logger
+from utils.config import config
+
+logger = get_logger("embedder")
+
+BACKENDS = ("torch", "onnx", "int8")
+
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+def load_encoder(backend: str = None) -> SentenceTransformer:
+    """
+    Builds the sentence encoder for the given backend:
+      torch - the reference PyTorch model
+      onnx  - ONNX Runtime inference (requires optimum[onnxruntime])
+      int8  - PyTorch with dynamically int8-quantized Linear layers
+    """
+    backend = backend or config.EMBEDDING_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend!r}; expected one of {BACKENDS}")
+
+    if backend == "onnx":
+        model = SentenceTransformer(config.MODEL_NAME, device="cpu", backend="onnx", trust_remote_code=True)
+    else:
+        model = SentenceTransformer(config.MODEL_NAME, device="cpu", trust_remote_code=True)
+        if backend == "int8":
+            import torch
+            torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    logger.info("Loaded %s encoder for %s", backend, config.MODEL_NAME)
+    return model
+
+
+def get_encoder(backend: str = None) -> SentenceTransformer:
+    """Process-wide encoder per backend; the model does not depend on the index files."""
+    backend = backend or config.EMBEDDING_BACKEND
+    with _encoders_lock:
+        if backend not in _encoders:
+            _encoders[backend] = load_encoder(backend)
+        return _encoders[backend]
+
+
+_worker_model = None
+
+
+def _init_worker(backend: str, threads: int):
+    global _worker_model
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_model = load_encoder(backend)
+
+
+def _encode_shard(texts: list) -> np.ndarray:
+    return np.asarray(_worker_model.encode(texts, convert_to_numpy=True, show_progress_bar=False), dtype=np.float32)
+
+
+class ParallelEncoder:
+    """
+    Encodes across a pool of worker processes, each with its own copy of the model and
+    an even share of the CPU threads. Texts are sorted by length before being cut into
+    shards of shard_size, so each shard pads to similar lengths; results come back in
+    input order. The pool starts on the first encode() and stops on close().
+    """
+
+    def __init__(self, workers: int = None, backend: str = None, shard_size: int = None):
+        self.workers = workers or config.ENCODE_WORKERS
+        self.backend = backend or config.EMBEDDING_BACKEND
+        self.shard_size = shard_size or config.ENCODE_SHARD_SIZE
+        self._pool = None
+
+    def encode(self, texts, convert_to_numpy: bool = True, show_progress_bar: bool = False, **kwargs) -> np.ndarray:
+        texts = list(texts)
+        if self._pool is None:
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+            # spawn: forking a process with an initialized torch runtime can deadlock.
+            self._pool = mp.get_context("spawn").Pool(
+                self.workers, initializer=_init_worker, initargs=(self.backend, threads)
+            )
+            logger.info("Started %d encoder processes (%d threads each)", self.workers, threads)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        # Small inputs are still spread over every worker.
+        shard_size = max(1, min(self.shard_size, -(-len(texts) // self.workers)))
+        shards = [order[i:i + shard_size] for i in range(0, len(order), shard_size)]
+        embeddings = None
+        for shard, vectors in zip(shards, self._pool.imap(_encode_shard, ([texts[i] for i in s] for s in shards))):
+            if embeddings is None:
+                embeddings = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            embeddings[shard] = vectors
+        return embeddings
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def check_backend_parity(texts: list, backend: str, reference: np.ndarray = None) -> dict:
+    """
+    Encodes texts with the given backend and reports cosine similarity against reference
+    embeddings (the torch backend when none are given).
+    """
+    if reference is None:
+        reference = get_encoder("torch").encode(texts, convert_to_numpy=True)
+    candidate = get_encoder(backend).encode(texts, convert_to_numpy=True)
+
+    ref = reference / np.maximum(np.linalg.norm(reference, axis=1, keepdims=True), 1e-12)
+    cand = candidate / np.maximum(np.linalg.norm(candidate, axis=1, keepdims=True), 1e-12)
+    cosines = (ref * cand).sum(axis=1)
+
+    report = {
+        "backend": backend,
+        "n": len(texts),
+        "mean_cosine": float(cosines.mean()),
+        "min_cosine": float(cosines.min()),
+        "max_drift": float(1.0 - cosines.min()),
+        "passed": bool(cosines.min() >= config.PARITY_MIN_COSINE),
+    }
+    logger.info("Parity check: %s", report)
+    return report
+
+
+def _sample_stored(sample_size: int):
+    # Local imports: faiss_updater imports this module.
+    from faiss_updater import _get_text_for_embedding
+    from embedding_store import open_embedding_store
+    from metadata_store import open_metadata_store
+
+    store = open_embedding_store()
+    rng = np.random.default_rng(42)
+    row_ids = np.sort(rng.choice(store.count, size=min(sample_size, store.count), replace=False))
+    records = open_metadata_store().fetch(row_ids).to_dict(orient="records")
+    return [_get_text_for_embedding(rec) for rec in records], store.read_rows(row_ids)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check embedding backend parity against stored embeddings.")
+    parser.add_argument("--backend", default=config.EMBEDDING_BACKEND, choices=BACKENDS)
+    parser.add_argument("--sample", type=int, default=200, help="number of stored incidents to re-encode")
+    args = parser.parse_args(argv)
+
+    texts, reference = _sample_stored(args.sample)
+    if not texts:
+        print("No stored embeddings to compare against.")
+        return 1
+    report = check_backend_parity(texts, args.backend, reference)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    return 0 if report["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import os
+import struct
+import numpy as np
+from utils.logger import get_logger
+from utils.config import config
+
+logger = get_logger("embedding_store")
+
+# Fixed-size header followed by count * dim little-endian float32 values.
+MAGIC = b"IRAEMB01"
+HEADER_FORMAT = "<8sIQ64s"
+HEADER_SIZE = 128
+
+
+class EmbeddingStore:
+    """
+    Float32 matrix on disk that grows by appending. Rows are written before the header
+    count is bumped, so a crash mid-append leaves the previous count intact and the torn
+    tail is truncated by the next append. Rows are appended before their metadata is
+    committed; ingest truncates rows the metadata store never recorded. Existing rows
+    are never rewritten: a changed incident is appended as a new row.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or config.EMBEDDINGS_STORE_FILE
+        self.dim = 0
+        self.count = 0
+        self.model_name = ""
+        if os.path.exists(self.path):
+            self._read_header()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _read_header(self):
+        with open(self.path, "rb") as f:
+            raw = f.read(HEADER_SIZE)
+        magic, dim, count, model_name = struct.unpack_from(HEADER_FORMAT, raw)
+        if magic != MAGIC:
+            raise ValueError(f"Not an embedding store: {self.path}")
+        self.dim = dim
+        self.count = count
+        self.model_name = model_name.rstrip(b"\0").decode("utf-8")
+
+    def _write_header(self, f):
+        header = struct.pack(HEADER_FORMAT, MAGIC, self.dim, self.count, self.model_name.encode("utf-8")[:64])
+        f.seek(0)
+        f.write(header.ljust(HEADER_SIZE, b"\0"))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def create(self, dim: int, model_name: str):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.dim = dim
+        self.count = 0
+        self.model_name = model_name
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            self._write_header(f)
+        os.replace(tmp_path, self.path)
+        logger.info("Created embedding store %s (dim=%d, model=%s)", self.path, dim, model_name)
+
+    def append(self, vectors: np.ndarray, model_name: str = None) -> tuple:
+        """Appends rows in place and returns the (start, end) row range they occupy."""
+        vectors = np.ascontiguousarray(vectors, dtype="<f4")
+        if vectors.ndim != 2:
+            raise ValueError("Expected a 2-D array of embeddings")
+        if not self.exists():
+            self.create(vectors.shape[1], model_name or config.MODEL_NAME)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Embedding dim {vectors.shape[1]} does not match store dim {self.dim}")
+        if model_name and model_name != self.model_name:
+            raise ValueError(f"Embeddings from {model_name} cannot be appended to a {self.model_name} store")
+
+        start = self.count
+        with open(self.path, "r+b") as f:
+            f.truncate(HEADER_SIZE + start * self.dim * 4)
+            f.seek(0, os.SEEK_END)
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+            self.count = start + len(vectors)
+            self._write_header(f)
+        logger.info("Appended %d embeddings to %s (total now: %d)", len(vectors), self.path, self.count)
+        return start, self.count
+
+    def truncate(self, count: int):
+        """Drops rows from count onwards; the bytes are reclaimed by the next append."""
+        if count > self.count:
+            raise ValueError(f"Cannot truncate a store with {self.count} rows to {count}")
+        with open(self.path, "r+b") as f:
+            self.count = count
+            self._write_header(f)
+        logger.info("Truncated %s to %d embeddings", self.path, count)
+
+    def open_memmap(self, mode: str = "r") -> np.ndarray:
+        """Maps the stored rows without reading them into memory."""
+        if not self.exists() or self.count == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.path, dtype="<f4", mode=mode, offset=HEADER_SIZE, shape=(self.count, self.dim))
+
+    def read_rows(self, row_ids) -> np.ndarray:
+        return np.asarray(self.open_memmap()[np.asarray(row_ids, dtype=np.int64)], dtype=np.float32)
+
+
+def open_embedding_store() -> EmbeddingStore:
+    """Opens the configured store, rebuilding it from the legacy records on first use."""
+    store = EmbeddingStore()
+    if not store.exists() and os.path.exists(config.EMBEDDINGS_FILE):
+        _migrate_legacy(store)
+    return store
+
+
+def _migrate_legacy(store: EmbeddingStore):
+    # Local imports: faiss_updater imports this module.
+    from faiss_updater import _get_text_for_embedding
+    from embedder import get_encoder
+    from metadata_store import open_metadata_store
+
+    # Rows of embeddings.npy do not reliably line up with clustered_incidents.json (updated
+    # incidents moved, repeated ones were embedded twice), so the imported records are
+    # re-embedded in row id order instead of copying the legacy vectors.
+    metadata = open_metadata_store()
+    n_rows = metadata.next_row_id()
+    logger.info("Migrating legacy embeddings: re-embedding %d imported records; %s is not read.",
+                n_rows, config.EMBEDDINGS_FILE)
+    model = get_encoder()
+    tmp = EmbeddingStore(store.path + ".migrating")
+    for start in range(0, n_rows, config.EMBED_CHUNK_SIZE):
+        row_ids = list(range(start, min(start + config.EMBED_CHUNK_SIZE, n_rows)))
+        records = metadata.fetch(row_ids)
+        if len(records) != len(row_ids):  # fetch() skips ids it cannot find
+            raise RuntimeError(f"Metadata rows {row_ids[0]}-{row_ids[-1]} are not contiguous; cannot migrate")
+        texts = [_get_text_for_embedding(rec) for rec in records.to_dict(orient="records")]
+        tmp.append(model.encode(texts, convert_to_numpy=True, show_progress_bar=False), config.MODEL_NAME)
+    if tmp.exists():
+        os.replace(tmp.path, store.path)
+        store._read_header()
+    logger.info("Migration complete; %s can be removed.", config.EMBEDDINGS_FILE)
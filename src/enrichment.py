@@ -0,0 +1,350 @@
+import os
+import json
+import math
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from http_client import (
+    post_incident_records,
+    extract_incidents_from_response,
+    DEFAULT_AI_AGENT_ID,
+    DEFAULT_ENDPOINT,
+)
+from enrichment_cache import get_enrichment_cache, split_cached
+from utils.logger import get_logger
+from utils.config import config
+from utils.metrics import inc
+
+logger = get_logger("enrichment")
+
+_TRUNCATION_MARKER = "\n[...]\n"
+_MIN_FIELD_CHARS = 200
+
+
+class TokenBucket:
+    """Blocking token bucket: allows bursts of `capacity` requests and `rate` requests/second sustained."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+def _post_batch(batch: List[dict], bucket: TokenBucket, ai_agent_id: str, endpoint: str) -> Optional[List[dict]]:
+    bucket.acquire()
+    response_json = post_incident_records(
+        batch,
+        ai_agent_id=ai_agent_id,
+        configuration_environment="DEV",
+        endpoint=endpoint,
+        compress=config.ENRICH_GZIP,
+    )
+    success_flag = response_json.get("success") or (
+        response_json.get("status") == "success"
+    )
+    if not success_flag:
+        logger.warning("Remote endpoint returned success=false: %s", response_json)
+        return None
+    return extract_incidents_from_response(response_json) or []
+
+
+def _missing_records(sent: List[dict], incidents: List[dict]) -> List[dict]:
+    returned = {incident.get("Number") for incident in incidents}
+    return [rec for rec in sent if rec.get("Number") and rec["Number"] not in returned]
+
+
+def _enrich_batch(batch: List[dict], bucket: TokenBucket, ai_agent_id: str, endpoint: str) -> Optional[List[dict]]:
+    """
+    Enriches one batch. Records whose Number is absent from the response (truncated
+    agent output) are re-sent on their own, in sub-batches halved on every round. A
+    failed retry does not fail the batch: the incidents received so far are returned
+    and the Numbers still missing are logged.
+    """
+    incidents = _post_batch(batch, bucket, ai_agent_id, endpoint)
+    if incidents is None:
+        return None
+    missing = _missing_records(batch, incidents)
+    size = len(batch)
+    for _ in range(config.ENRICH_MISSING_RETRIES):
+        if not missing:
+            break
+        size = max(1, min(size, len(missing)) // 2)
+        logger.warning("%d of %d incidents missing from the response; retrying them in batches of %d",
+                       len(missing), len(batch), size)
+        inc("enrich_missing_retries", len(missing))
+        still_missing = []
+        for sub_batch in _iter_batches(missing, size):
+            try:
+                retried = _post_batch(sub_batch, bucket, ai_agent_id, endpoint) or []
+            except Exception as e:
+                logger.warning("Retry of %d missing incidents failed: %s", len(sub_batch), e)
+                inc("enrich_missing_retry_errors")
+                retried = []
+            incidents.extend(retried)
+            still_missing.extend(_missing_records(sub_batch, retried))
+        missing = still_missing
+    if missing:
+        logger.warning("%d incidents still missing after retries: %s",
+                       len(missing), ", ".join(rec["Number"] for rec in missing))
+    return incidents
+
+
+def estimate_tokens(record: dict) -> int:
+    """Rough token count of a record as sent: about 4 bytes of JSON per token."""
+    return len(json.dumps(record, ensure_ascii=False)) // 4 + 1
+
+
+def _fit_record(record: dict, max_tokens: int) -> dict:
+    """Shortens the longest text fields, keeping their head and tail, until the record fits max_tokens."""
+    record = dict(record)
+    fields = [f for f, v in record.items() if f != "Number" and isinstance(v, str)]
+    while fields and estimate_tokens(record) > max_tokens:
+        longest = max(fields, key=lambda f: len(record[f]))
+        text = record[longest]
+        keep = len(text) - (estimate_tokens(record) - max_tokens) * 4 - len(_TRUNCATION_MARKER)
+        keep = max(keep, _MIN_FIELD_CHARS)
+        if keep >= len(text) - len(_TRUNCATION_MARKER):
+            break
+        head = keep * 2 // 3
+        record[longest] = text[:head] + _TRUNCATION_MARKER + text[len(text) - (keep - head):]
+    return record
+
+
+def pack_batches(records: Iterable[dict], max_records: int = None, max_tokens: int = None,
+                 count_only: bool = False) -> Iterator[List[dict]]:
+    """
+    Groups records into request batches of up to max_tokens estimated tokens and
+    max_records records. Records over ENRICH_RECORD_MAX_TOKENS have their long fields
+    shortened first. Deterministic for a given input, so batch indexes can be checkpointed.
+    count_only packs without recording metrics, for a pass that only counts batches.
+    """
+    max_records = max_records or config.ENRICH_BATCH_SIZE
+    max_tokens = max_tokens or config.ENRICH_BATCH_TOKENS
+    batch, batch_tokens = [], 0
+    for rec in records:
+        tokens = estimate_tokens(rec)
+        if tokens > config.ENRICH_RECORD_MAX_TOKENS:
+            rec = _fit_record(rec, config.ENRICH_RECORD_MAX_TOKENS)
+            tokens = estimate_tokens(rec)
+            if not count_only:
+                inc("enrich_records_truncated")
+        if batch and (len(batch) >= max_records or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(rec)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def count_batches(records: Iterable[dict], max_records: int = None) -> int:
+    return sum(1 for _ in pack_batches(records, max_records, count_only=True))
+
+
+def _merge_cached(batch: List[dict], keys: List[str], cached: Dict[str, dict], fresh: List[dict]):
+    """Cached and freshly enriched incidents in input order; returns (incidents, new cache entries)."""
+    fresh_by_number = {}
+    for incident in fresh:
+        fresh_by_number.setdefault(incident.get("Number"), []).append(incident)
+    incidents, new_entries = [], {}
+    for rec, key in zip(batch, keys):
+        if key in cached:
+            incidents.append(cached[key])
+        elif fresh_by_number.get(rec.get("Number")):
+            incident = fresh_by_number[rec.get("Number")].pop(0)
+            incidents.append(incident)
+            new_entries[key] = incident
+    # Incidents the agent returned under a Number that was not sent are passed through uncached.
+    incidents.extend(incident for leftover in fresh_by_number.values() for incident in leftover)
+    return incidents, new_entries
+
+
+def _iter_batches(records: Iterable[dict], batch_size: int) -> Iterator[List[dict]]:
+    batch = []
+    for rec in records:
+        batch.append(rec)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_enriched_batches(
+    records: Iterable[dict],
+    ai_agent_id: str = DEFAULT_AI_AGENT_ID,
+    endpoint: str = DEFAULT_ENDPOINT,
+    batch_size: int = None,
+    max_workers: int = None,
+    stats: Dict = None,
+) -> Iterator[Tuple[int, Optional[List[dict]], str]]:
+    """Packs records with pack_batches() and enriches them with enrich_batches()."""
+    yield from enrich_batches(pack_batches(records, batch_size), ai_agent_id, endpoint, max_workers, stats)
+
+
+def enrich_batches(
+    batches: Iterable[List[dict]],
+    ai_agent_id: str = DEFAULT_AI_AGENT_ID,
+    endpoint: str = DEFAULT_ENDPOINT,
+    max_workers: int = None,
+    stats: Dict = None,
+) -> Iterator[Tuple[int, Optional[List[dict]], str]]:
+    """
+    Sends batches to the enrichment agent concurrently and rate-limited, and yields
+    (batch_index, incidents, message) as batches complete. incidents is None for a failed
+    or rejected batch. Batches are pulled lazily and at most 2 * max_workers are in
+    flight, so memory stays flat for any input size. Records found in the enrichment
+    cache are not sent; a batch made only of cached records makes no request. stats is
+    updated in place.
+    """
+    max_workers = max_workers or config.ENRICH_MAX_WORKERS
+    bucket = TokenBucket(config.ENRICH_RATE_PER_SEC, config.ENRICH_BURST)
+    if stats is None:
+        stats = {}
+    for key in ("batches", "succeeded", "rejected", "failed", "incidents", "missing", "cache_hits", "cache_misses"):
+        stats.setdefault(key, 0)
+    cache = get_enrichment_cache() if config.ENRICHMENT_CACHE_ENABLED else None
+
+    logger.info("Enriching records with %d workers", max_workers)
+    batches = enumerate(batches)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="enrich") as pool:
+        pending = {}
+
+        def submit_next() -> bool:
+            item = next(batches, None)
+            if item is None:
+                return False
+            i, batch = item
+            stats["batches"] += 1
+            keys, cached, uncached = split_cached(cache, batch, ai_agent_id)
+            stats["cache_hits"] += len(batch) - len(uncached)
+            stats["cache_misses"] += len(uncached)
+            inc("enrichment_cache_hits", len(batch) - len(uncached))
+            inc("enrichment_cache_misses", len(uncached))
+            if uncached:
+                future = pool.submit(_enrich_batch, uncached, bucket, ai_agent_id, endpoint)
+            else:
+                future = Future()
+                future.set_result([])
+            pending[future] = (i, batch, keys, cached)
+            return True
+
+        while len(pending) < 2 * max_workers and submit_next():
+            pass
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i, batch, keys, cached = pending.pop(future)
+                try:
+                    incidents = future.result()
+                except Exception as e:
+                    logger.exception("Batch %d failed: %s", i + 1, e)
+                    stats["failed"] += 1
+                    yield i, None, f"Batch {i + 1} failed"
+                else:
+                    if incidents is None:
+                        stats["rejected"] += 1
+                        yield i, None, f"Batch {i + 1}: remote endpoint returned success=false"
+                    else:
+                        fresh = len(incidents)
+                        incidents, new_entries = _merge_cached(batch, keys, cached, incidents)
+                        if cache is not None and new_entries:
+                            cache.put_many(new_entries)
+                        stats["succeeded"] += 1
+                        stats["incidents"] += len(incidents)
+                        stats["missing"] += len(_missing_records(batch, incidents))
+                        if not incidents:
+                            logger.warning("Batch %d: No incidents found in remote response.", i + 1)
+                        message = f"Batch {i + 1}: received {fresh} incidents"
+                        if cached:
+                            message += f", {len(cached)} from cache"
+                        yield i, incidents, message
+                submit_next()
+
+    looked_up = stats["cache_hits"] + stats["cache_misses"]
+    logger.info("Enrichment finished: %s (cache hit rate %.0f%%)", stats,
+                100.0 * stats["cache_hits"] / looked_up if looked_up else 0.0)
+
+
+def enrich_records(
+    records: Iterable[dict],
+    ai_agent_id: str = DEFAULT_AI_AGENT_ID,
+    endpoint: str = DEFAULT_ENDPOINT,
+    batch_size: int = None,
+    max_workers: int = None,
+    progress_callback: Callable[[int, Optional[int], str], None] = None,
+    total_records: int = None,
+) -> Tuple[List[dict], Dict]:
+    """
+    Enriches records and returns the incidents in input order plus per-run stats.
+    progress_callback(done, total, message) is invoked from the calling thread after
+    each batch finishes; total is None when the record count is not known up front.
+    """
+    stats = {}
+    results = {}
+    total = _total_batches(records, total_records, batch_size)
+    for done, (i, incidents, message) in enumerate(
+        iter_enriched_batches(records, ai_agent_id, endpoint, batch_size, max_workers, stats), start=1
+    ):
+        if incidents:
+            results[i] = incidents
+        if progress_callback:
+            progress_callback(done, max(total, done) if total else total, message)
+
+    # Keep the input order regardless of completion order.
+    all_incidents = [incident for i in sorted(results) for incident in results[i]]
+    return all_incidents, stats
+
+
+def enrich_to_ndjson(
+    records: Iterable[dict],
+    out_path: str,
+    ai_agent_id: str = DEFAULT_AI_AGENT_ID,
+    endpoint: str = DEFAULT_ENDPOINT,
+    batch_size: int = None,
+    max_workers: int = None,
+    progress_callback: Callable[[int, Optional[int], str], None] = None,
+    total_records: int = None,
+) -> Dict:
+    """Streaming variant of enrich_records(): incidents are appended to out_path as batches complete."""
+    stats = {}
+    total = _total_batches(records, total_records, batch_size)
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        for done, (i, incidents, message) in enumerate(
+            iter_enriched_batches(records, ai_agent_id, endpoint, batch_size, max_workers, stats), start=1
+        ):
+            for incident in incidents or []:
+                out.write(json.dumps(incident, ensure_ascii=False))
+                out.write("\n")
+            if progress_callback:
+                progress_callback(done, max(total, done) if total else total, message)
+    os.replace(tmp_path, out_path)
+    return stats
+
+
+def _total_batches(records, total_records: Optional[int], batch_size: Optional[int]) -> Optional[int]:
+    if total_records is None and hasattr(records, "__len__"):
+        total_records = len(records)
+    if total_records is None:
+        return None
+    if isinstance(records, list):
+        return count_batches(records, batch_size)
+    # Streamed input: a lower bound, since token packing can close batches early.
+    return math.ceil(total_records / (batch_size or config.ENRICH_BATCH_SIZE))
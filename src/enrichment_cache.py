@@ -0,0 +1,171 @@
+"""
+On-disk cache of enrichment agent output, keyed by the content of each input record
+and the agent id, so re-uploaded incidents that have not changed are not sent again.
+
+    python enrichment_cache.py stats
+    python enrichment_cache.py compact [--max-age-days 30] [--max-entries N]
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from typing import Dict, Iterable, List, Optional
+from utils.logger import get_logger
+from utils.config import config
+from json_creator import REQUIRED_COLUMNS
+
+logger = get_logger("enrichment_cache")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS enrichments (
+    key TEXT PRIMARY KEY,
+    number TEXT,
+    incident TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_enrichments_accessed ON enrichments(accessed_at);
+"""
+
+
+def enrichment_key(record: dict, ai_agent_id: str) -> str:
+    """Hash of the fields sent to the agent plus the agent id; any edit is a miss."""
+    fields = {field: record.get(field) for field in REQUIRED_COLUMNS}
+    canonical = json.dumps({"agent": ai_agent_id, "record": fields}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class EnrichmentCache:
+    """
+    Enriched incidents by input-record key. Entries are never invalidated by updates,
+    since a changed record has a different key; compact() bounds age, count and size.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or config.ENRICHMENT_CACHE_FILE
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, dict]:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        with self._lock, self._conn:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for key, incident in self._conn.execute(
+                    f"SELECT key, incident FROM enrichments WHERE key IN ({placeholders})", chunk
+                ):
+                    found[key] = json.loads(incident)
+            hits = list(found)
+            for i in range(0, len(hits), 500):
+                chunk = hits[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                self._conn.execute(f"UPDATE enrichments SET accessed_at = ? WHERE key IN ({placeholders})", [now, *chunk])
+        return found
+
+    def put_many(self, entries: Dict[str, dict]):
+        now = time.time()
+        rows = []
+        for key, incident in entries.items():
+            payload = json.dumps(incident, ensure_ascii=False)
+            rows.append((key, incident.get("Number"), payload, len(payload), now, now))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO enrichments (key, number, incident, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total_size, oldest = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(created_at) FROM enrichments"
+            ).fetchone()
+        return {
+            "entries": count,
+            "bytes": total_size,
+            "file_bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            "oldest_age_days": (time.time() - oldest) / 86400 if oldest else None,
+        }
+
+    def compact(self, max_age: float = None, max_entries: int = None, max_bytes: int = None) -> int:
+        """Drops entries older than max_age seconds, then least recently used ones over the limits, and vacuums."""
+        max_age = config.ENRICHMENT_CACHE_TTL if max_age is None else max_age
+        max_entries = config.ENRICHMENT_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        max_bytes = config.ENRICHMENT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        with self._lock:
+            with self._conn:
+                removed = self._conn.execute(
+                    "DELETE FROM enrichments WHERE created_at < ?", (time.time() - max_age,)
+                ).rowcount
+                count, total_size = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM enrichments"
+                ).fetchone()
+                evicted = []
+                for key, size in self._conn.execute("SELECT key, size FROM enrichments ORDER BY accessed_at"):
+                    if count <= max_entries and total_size <= max_bytes:
+                        break
+                    evicted.append(key)
+                    count -= 1
+                    total_size -= size
+                for i in range(0, len(evicted), 500):
+                    chunk = evicted[i:i + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    self._conn.execute(f"DELETE FROM enrichments WHERE key IN ({placeholders})", chunk)
+            self._conn.execute("VACUUM")
+        logger.info("Compacted enrichment cache: %d expired, %d evicted (LRU)", removed, len(evicted))
+        return removed + len(evicted)
+
+
+def split_cached(cache: Optional[EnrichmentCache], records: List[dict], ai_agent_id: str):
+    """Returns (keys, cached incidents by key, records that still need the agent)."""
+    keys = [enrichment_key(rec, ai_agent_id) for rec in records]
+    cached = cache.get_many(keys) if cache is not None else {}
+    missing = [rec for rec, key in zip(records, keys) if key not in cached]
+    return keys, cached, missing
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_enrichment_cache() -> EnrichmentCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EnrichmentCache()
+        return _cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and compact the enrichment cache.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="show entry count and size")
+    compact = sub.add_parser("compact", help="evict old and least recently used entries, then vacuum")
+    compact.add_argument("--max-age-days", type=float, default=None)
+    compact.add_argument("--max-entries", type=int, default=None)
+    compact.add_argument("--max-bytes", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    cache = get_enrichment_cache()
+    if args.command == "compact":
+        max_age = args.max_age_days * 86400 if args.max_age_days is not None else None
+        removed = cache.compact(max_age, args.max_entries, args.max_bytes)
+        print(f"removed {removed} entries")
+    print(json.dumps(cache.stats(), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
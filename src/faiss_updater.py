@@ -1,12 +1,19 @@
 import os
+import sys
 import json
+import argparse
 import numpy as np
-import pandas as pd
-import faiss
-from sentence_transformers import SentenceTransformer
+from typing import Iterable, Iterator, List, Union
 from utils.logger import get_logger
-from cluster_manager import recluster_and_update_indices
+from embedder import get_encoder, ParallelEncoder
+from embedding_store import EmbeddingStore, open_embedding_store
+from metadata_store import open_metadata_store, content_hash, record_hash
+from summary_cache import get_summary_cache
+from json_creator import iter_ndjson
+from cluster_manager import recluster_and_update_indices, update_clusters_incremental
+from generations import GenerationBuilder, generation_path, index_write_lock, read_manifest
 from utils.config import config
+from utils.metrics import span, timed, inc
 
 logger = get_logger("faiss_updater")
 
@@ -18,77 +25,209 @@ def _get_text_for_embedding(record: dict) -> str:
     return f"{sd} {desc}".strip()
 
 
-def update_faiss_with_new_data(new_json_path: str):
-    
-    model = SentenceTransformer(config.MODEL_NAME, device="cpu", trust_remote_code=True)
-
-    # Load existing data
-    if os.path.exists(config.DATA_FILE):
-        with open(config.DATA_FILE, "r", encoding="utf-8") as f:
-            existing = json.load(f)
-        logger.info("Loaded existing data: %d records", len(existing))
-    else:
-        existing = []
-        logger.info("No existing data file found; starting fresh.")
-
-    # Load new data
-    with open(new_json_path, "r", encoding="utf-8") as f:
-        new_data = json.load(f)
-    logger.info("Loaded new data: %d records", len(new_data))
-
-    combined_df = pd.DataFrame(existing + new_data)
-    before = len(combined_df)
-    if "Number" in combined_df.columns:
-        combined_df.drop_duplicates(subset=["Number"], keep="last", inplace=True)
-    after = len(combined_df)
-    logger.info("Deduplicated dataset: before=%d after=%d removed=%d", before, after, before - after)
-
-    os.makedirs(os.path.dirname(config.DATA_FILE), exist_ok=True)
-    combined_df.to_json(config.DATA_FILE, orient="records", indent=2, force_ascii=False)
-    logger.info("Saved combined incidents to %s", config.DATA_FILE)
-
-    existing_numbers = {rec.get("Number") for rec in existing}
-    new_records = [rec for rec in new_data if rec.get("Number") not in existing_numbers]
-    logger.info("Found %d brand new incidents to embed", len(new_records))
-
-    if os.path.exists(config.EMBEDDINGS_FILE):
-        existing_embeddings = np.load(config.EMBEDDINGS_FILE)
-        logger.info("Loaded existing embeddings: shape=%s", existing_embeddings.shape)
-    else:
-        existing_embeddings = np.zeros((0, 384), dtype=np.float32)  # 384 is MiniLM-L6-v2 output dim
-        logger.info("No existing embeddings file found; starting with empty array.")
-
-    if new_records:
-        texts = [_get_text_for_embedding(rec) for rec in new_records]
-        logger.info("Encoding %d new records...", len(texts))
-        new_embeddings = model.encode(texts, convert_to_numpy=True, show_progress_bar=True)
-        dim = new_embeddings.shape[1]
-
-        all_embeddings = np.vstack([existing_embeddings, new_embeddings]) #stack vertically
-        np.save(config.EMBEDDINGS_FILE, all_embeddings)
-        logger.info("Saved updated embeddings: total=%d vectors", len(all_embeddings))
-
-        if os.path.exists(config.INDEX_FILE):
-            index = faiss.read_index(config.INDEX_FILE)
-            logger.info("Loaded existing FAISS index with %d vectors", index.ntotal)
-        else:
-            index = faiss.IndexFlatL2(dim)
-            logger.info("Created new FAISS index.")
-
-        index.add(np.array(new_embeddings, dtype=np.float32))
-        faiss.write_index(index, config.INDEX_FILE)
-        logger.info(
-            "Appended %d new vectors to FAISS index (total now: %d, dim: %d)",
-            len(new_embeddings),
-            index.ntotal,
-            dim,
+def _iter_input_records(new_data) -> Iterator[dict]:
+    if not isinstance(new_data, str):
+        return iter(new_data)
+    if new_data.endswith((".ndjson", ".jsonl")):
+        return iter_ndjson(new_data)
+    with open(new_data, "r", encoding="utf-8") as f:
+        return iter(json.load(f))
+
+
+def _iter_chunks(records: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    chunk = []
+    for rec in records:
+        chunk.append(rec)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@index_write_lock()
+@timed("ingest.total")
+def update_faiss_with_new_data(new_data: Union[str, Iterable[dict]], incremental: bool = None,
+                               encode_workers: int = None):
+    """
+    Ingests enriched incidents from a JSON/NDJSON path or any iterable of records.
+    Records are processed in chunks of EMBED_CHUNK_SIZE, so memory does not grow with
+    the size of the upload. With more than one encode worker, chunks of
+    PARALLEL_EMBED_CHUNK_SIZE are encoded by a ParallelEncoder process pool, for large
+    backfills. Returns (new incidents added, total incidents).
+    """
+    if incremental is None:
+        incremental = config.INCREMENTAL_CLUSTERING
+    if encode_workers is None:
+        encode_workers = config.ENCODE_WORKERS
+    parallel = encode_workers > 1
+    chunk_size = config.PARALLEL_EMBED_CHUNK_SIZE if parallel else config.EMBED_CHUNK_SIZE
+
+    with span("encoder.load"):
+        model = ParallelEncoder(encode_workers) if parallel else get_encoder()
+    metadata = open_metadata_store()
+    logger.info("Loaded metadata store: %d existing records", metadata.count())
+
+    store = open_embedding_store()
+    if store.exists() and store.model_name != config.MODEL_NAME:
+        raise ValueError(
+            f"Embedding store was built with {store.model_name}, but MODEL_NAME is {config.MODEL_NAME}"
         )
-    else:
-        logger.info("No new records found. Skipping embedding and FAISS update.")
-        all_embeddings = existing_embeddings
-
-    logger.info("Starting reclustering process with %d total embeddings...", len(all_embeddings))
-    recluster_and_update_indices(all_embeddings, combined_df)
-    logger.info("Reclustering completed successfully.")
-
-    return len(new_records), len(combined_df)
+    if store.count > metadata.next_row_id():
+        # Vectors appended by an ingest that died before its metadata commit; nothing references them.
+        logger.warning("Embedding store has %d rows the metadata store never recorded; truncating them.",
+                       store.count - metadata.next_row_id())
+        store.truncate(metadata.next_row_id())
+    elif store.count < metadata.next_row_id():
+        raise RuntimeError(
+            f"Embedding store ({store.count} rows) and metadata store "
+            f"({metadata.next_row_id()} rows) are out of sync"
+        )
+    logger.info("Opened embedding store: %d vectors (dim=%d)", store.count, store.dim)
+    # Rows past the published generation (e.g. from a crashed update) are indexed as new.
+    manifest = read_manifest()
+    indexed_rows = manifest["n_rows"] if manifest else store.count
+
+    # The embedding store already holds the exact vectors; a separate flat index over
+    # the same data is no longer kept.
+    if os.path.exists(config.INDEX_FILE):
+        os.remove(config.INDEX_FILE)
+        logger.info("Removed redundant global FAISS index %s", config.INDEX_FILE)
+
+    return _ingest_chunks(new_data, model, parallel, chunk_size, incremental, metadata, store, indexed_rows)
+
+
+def _ingest_chunks(new_data, model, parallel: bool, chunk_size: int, incremental: bool, metadata,
+                   store: EmbeddingStore, indexed_rows: int):
+    total_in = 0
+    total_new = 0
+    total_updated = 0
+    total_reembedded = 0
+    total_unchanged = 0
+    try:
+        for chunk in _iter_chunks(_iter_input_records(new_data), chunk_size):
+            total_in += len(chunk)
+
+            # Later rows win when the upload repeats a Number, as with drop_duplicates(keep="last").
+            # Repeats across chunks are compared with the version the earlier chunk stored.
+            deduped = {}
+            for i, rec in enumerate(chunk):
+                deduped[rec.get("Number") or ("__row", i)] = rec
+            chunk = list(deduped.values())
+
+            with span("ingest.classify"):
+                known = metadata.get_hashes([rec.get("Number") for rec in chunk])
+            new_records, reembed, metadata_only = [], {}, {}
+            for rec in chunk:
+                if rec.get("Number") not in known:
+                    new_records.append(rec)
+                    continue
+                row_id, old_content_hash, old_record_hash = known[rec["Number"]]
+                if old_record_hash == record_hash(rec):
+                    total_unchanged += 1
+                elif old_content_hash == content_hash(_get_text_for_embedding(rec)):
+                    metadata_only[row_id] = (rec, old_content_hash)
+                else:
+                    reembed[row_id] = rec
+
+            if metadata_only or reembed:
+                get_summary_cache().invalidate_numbers(
+                    rec["Number"] for rec in [*(r for r, _ in metadata_only.values()), *reembed.values()]
+                )
+                total_updated += len(metadata_only) + len(reembed)
+
+            # Rows are never rewritten, so a generation keeps the records and vectors it
+            # was built from: a changed incident is stored as a new row and the published
+            # generation goes on reading the old one.
+            if metadata_only:
+                with span("ingest.store"):
+                    start_row, _ = store.append(store.read_rows(list(metadata_only)), config.MODEL_NAME)
+                    metadata.replace_records(
+                        list(metadata_only), [rec for rec, _ in metadata_only.values()], start_row,
+                        [c_hash for _, c_hash in metadata_only.values()],
+                    )
+
+            records_to_embed = new_records + list(reembed.values())
+            if not records_to_embed:
+                continue
+
+            texts = [_get_text_for_embedding(rec) for rec in records_to_embed]
+            hashes = [content_hash(t) for t in texts]
+            logger.info("Encoding %d new and %d changed records...", len(new_records), len(reembed))
+            with span("ingest.encode"):
+                embeddings = model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+            inc("vectors_encoded", len(texts))
+
+            n_new = len(new_records)
+            with span("ingest.store"):
+                if n_new:
+                    start_row, _ = store.append(embeddings[:n_new], config.MODEL_NAME)
+                    metadata.insert_records(new_records, start_row, hashes[:n_new])
+                    total_new += n_new
+                if reembed:
+                    start_row, _ = store.append(embeddings[n_new:], config.MODEL_NAME)
+                    metadata.replace_records(list(reembed), list(reembed.values()), start_row, hashes[n_new:])
+                    total_reembedded += len(reembed)
+    finally:
+        if parallel:
+            model.close()
+
+    logger.info(
+        "Loaded new data: %d records (%d new, %d updated, %d re-embedded, %d unchanged)",
+        total_in, total_new, total_updated, total_reembedded, total_unchanged,
+    )
+    inc("ingest_records", total_in)
+    inc("ingest_records_new", total_new)
+    inc("ingest_records_updated", total_updated)
+    inc("ingest_records_unchanged", total_unchanged)
+
+    if store.count == indexed_rows and os.path.exists(generation_path("ivf_index")):
+        logger.info("No new or changed records. Skipping FAISS update.")
+        return total_new, metadata.count()
+    logger.info("Saved updated embeddings: total=%d vectors", store.count)
+
+    # Everything past the published generation goes into the next one, including rows
+    # left by an update that crashed before publishing.
+    added_row_ids = np.array(metadata.current_row_ids(indexed_rows), dtype=np.int64)
+    superseded_row_ids = np.array(metadata.superseded_since(indexed_rows), dtype=np.int64)
+
+    # Memory-mapped, so neither path holds a second copy of the corpus in RAM.
+    all_embeddings = store.open_memmap()
+    builder = GenerationBuilder()
+    try:
+        if incremental and update_clusters_incremental(builder, all_embeddings, added_row_ids, superseded_row_ids):
+            logger.info("Incremental clustering completed for %d added and %d superseded vectors.",
+                        len(added_row_ids), len(superseded_row_ids))
+        else:
+            if incremental:
+                inc("incremental_fallbacks")
+            logger.info("Starting reclustering process with %d total embeddings...", len(all_embeddings))
+            recluster_and_update_indices(all_embeddings, builder)
+            logger.info("Reclustering completed successfully.")
+        builder.publish(store.count)
+    except Exception:
+        builder.discard()
+        raise
+
+    return total_new, metadata.count()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest enriched incidents, e.g. to backfill history in parallel.")
+    parser.add_argument("path", help="enriched incidents as JSON or NDJSON")
+    parser.add_argument("--workers", type=int, default=None, help="encoder processes (default ENCODE_WORKERS)")
+    parser.add_argument("--chunk-size", type=int, default=None, help="records encoded and stored per chunk")
+    parser.add_argument("--full-recluster", action="store_true", help="skip incremental clustering")
+    args = parser.parse_args(argv)
+
+    if args.chunk_size:
+        config.EMBED_CHUNK_SIZE = config.PARALLEL_EMBED_CHUNK_SIZE = args.chunk_size
+    new_count, total_count = update_faiss_with_new_data(
+        args.path, incremental=False if args.full_recluster else None, encode_workers=args.workers
+    )
+    print(f"Added {new_count} new incidents. Total: {total_count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
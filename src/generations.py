@@ -0,0 +1,298 @@
+"""
+Index generations. Every rebuild writes its IVF index, cluster model, cluster stats
+and per-row cluster ids into a fresh data/generations/<id>/ directory with a manifest,
+and is published by atomically replacing data/CURRENT. Readers load one generation and
+keep it for their lifetime.
+
+The embedding store and metadata are shared by all generations and grow by row id, so a
+manifest pins how many rows belong to its generation instead of copying them. Rows are
+never rewritten: a changed incident is stored as a new row and the version it replaces
+stays behind for older generations, so each generation reads exactly what it indexed.
+
+    python generations.py list
+    python generations.py gc
+    python generations.py export /path/to/replica/data
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Optional
+from utils.logger import get_logger
+from utils.config import config
+from embedding_store import EmbeddingStore, open_embedding_store
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialized within one process
+    fcntl = None
+
+logger = get_logger("generations")
+
+GENERATION_FILES = {
+    "ivf_index": "clusters.ivf.faiss",
+    "cluster_model": "cluster_model.pkl",
+    "cluster_stats": "cluster_stats.json",
+    "cluster_ids": "cluster_ids.npy",
+}
+MANIFEST_FILE = "manifest.json"
+
+# Directories without a manifest are rebuilds that never published; they are only
+# removed once they are clearly abandoned.
+_ABANDONED_AFTER = 3600
+
+_index_thread_lock = threading.Lock()
+
+
+@contextmanager
+def index_write_lock():
+    """Serializes index updates across threads and processes (UI, service workers, job worker)."""
+    with _index_thread_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(config.INDEX_LOCK_FILE) or ".", exist_ok=True)
+        with open(config.INDEX_LOCK_FILE, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _legacy_paths() -> dict:
+    return {
+        "ivf_index": config.IVF_INDEX_FILE,
+        "cluster_model": config.CLUSTER_MODEL_FILE,
+        "cluster_stats": config.CLUSTER_STATS_FILE,
+        # Cluster ids lived only in the metadata store before generations.
+        "cluster_ids": os.path.join(config.DATA_DIR, GENERATION_FILES["cluster_ids"]),
+    }
+
+
+def current_generation() -> Optional[str]:
+    try:
+        with open(config.CURRENT_GENERATION_FILE, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def generation_dir(gen_id: str) -> str:
+    return os.path.join(config.GENERATIONS_DIR, gen_id)
+
+
+def generation_path(name: str, gen_id: str = None) -> str:
+    """Path of a generation file; before the first generation, the pre-generation file path."""
+    gen_id = gen_id or current_generation()
+    if gen_id is None:
+        return _legacy_paths()[name]
+    return os.path.join(generation_dir(gen_id), GENERATION_FILES[name])
+
+
+def read_manifest(gen_id: str = None) -> Optional[dict]:
+    gen_id = gen_id or current_generation()
+    if gen_id is None:
+        return None
+    with open(os.path.join(generation_dir(gen_id), MANIFEST_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _fsync_path(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # directories cannot be fsynced on every platform
+    finally:
+        os.close(fd)
+
+
+class GenerationBuilder:
+    """A generation being written. Readers cannot see it until publish()."""
+
+    def __init__(self):
+        self.parent = current_generation()
+        self.gen_id = f"{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:8]}"
+        self.dir = generation_dir(self.gen_id)
+        self.info = {}
+        os.makedirs(self.dir)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.dir, GENERATION_FILES[name])
+
+    def inherit(self, *names):
+        """Hard-links files that this rebuild did not rewrite from the parent generation."""
+        for name in names:
+            src, dst = generation_path(name, self.parent), self.path(name)
+            if os.path.exists(dst) or not os.path.exists(src):
+                continue
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+
+    def publish(self, n_rows: int) -> str:
+        self.inherit(*GENERATION_FILES)
+        store = open_embedding_store()
+        files = {}
+        for name, filename in GENERATION_FILES.items():
+            path = self.path(name)
+            if os.path.exists(path):
+                _fsync_path(path)
+                files[name] = {"file": filename, "bytes": os.path.getsize(path)}
+        manifest = {
+            "generation": self.gen_id,
+            "parent": self.parent,
+            "created_at": time.time(),
+            "n_rows": int(n_rows),
+            "embedding_store": {"dim": store.dim, "model_name": store.model_name},
+            "files": files,
+            **self.info,
+        }
+        manifest_path = os.path.join(self.dir, MANIFEST_FILE)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync_path(self.dir)
+
+        tmp_path = config.CURRENT_GENERATION_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.gen_id)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, config.CURRENT_GENERATION_FILE)
+        _fsync_path(os.path.dirname(config.CURRENT_GENERATION_FILE) or ".")
+        logger.info("Published generation %s (%d rows, parent %s)", self.gen_id, n_rows, self.parent)
+
+        if self.parent is None:
+            _remove_pre_generation_files()
+        gc_generations()
+        return self.gen_id
+
+    def discard(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def _remove_pre_generation_files():
+    for path in [*_legacy_paths().values(), config.INDEX_VERSION_FILE]:
+        if os.path.exists(path):
+            os.remove(path)
+            logger.info("Removed %s; it now lives in the generation directory.", path)
+
+
+def list_generations() -> list:
+    if not os.path.isdir(config.GENERATIONS_DIR):
+        return []
+    return sorted(os.listdir(config.GENERATIONS_DIR))
+
+
+def gc_generations(keep: int = None) -> list:
+    """Removes all but the newest `keep` published generations; CURRENT is always kept."""
+    keep = config.KEEP_GENERATIONS if keep is None else keep
+    current = current_generation()
+    published = [g for g in list_generations() if os.path.exists(os.path.join(generation_dir(g), MANIFEST_FILE))]
+    kept = set(published[-keep:]) if keep > 0 else set()
+    kept.add(current)
+    doomed = [g for g in published if g not in kept]
+    for gen_id in list_generations():
+        path = generation_dir(gen_id)
+        if gen_id not in published and time.time() - os.path.getmtime(path) > _ABANDONED_AFTER:
+            doomed.append(gen_id)
+    for gen_id in doomed:
+        shutil.rmtree(generation_dir(gen_id), ignore_errors=True)
+    if doomed:
+        logger.info("Removed %d old generation(s): %s", len(doomed), doomed)
+    return doomed
+
+
+def export_snapshot(dest_dir: str, gen_id: str = None) -> dict:
+    """
+    Writes a self-contained copy of a generation (the current one by default) for a
+    read-only replica: the generation directory, CURRENT, and the embedding store and
+    metadata cut at the generation's row count. dest_dir takes the place of the
+    replica's data directory.
+    """
+    with index_write_lock():
+        gen_id = gen_id or current_generation()
+        if gen_id is None:
+            raise FileNotFoundError("No published generation to export.")
+        manifest = read_manifest(gen_id)
+        n_rows = manifest["n_rows"]
+
+        dest_generations = os.path.join(dest_dir, os.path.relpath(config.GENERATIONS_DIR, config.DATA_DIR))
+        shutil.copytree(generation_dir(gen_id), os.path.join(dest_generations, gen_id), dirs_exist_ok=True)
+
+        source = open_embedding_store()
+        vectors = source.open_memmap()[:n_rows]
+        target = EmbeddingStore(os.path.join(dest_dir, os.path.relpath(config.EMBEDDINGS_STORE_FILE, config.DATA_DIR)))
+        target.create(source.dim, source.model_name)
+        for start in range(0, n_rows, config.BATCH_SIZE):
+            target.append(vectors[start:start + config.BATCH_SIZE])
+
+        db_path = os.path.join(dest_dir, os.path.relpath(config.METADATA_DB_FILE, config.DATA_DIR))
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        src_conn = sqlite3.connect(config.METADATA_DB_FILE)
+        dst_conn = sqlite3.connect(db_path)
+        try:
+            src_conn.backup(dst_conn)
+            with dst_conn:
+                dst_conn.execute("DELETE FROM incidents WHERE row_id >= ?", (n_rows,))
+                tables = {r[0] for r in dst_conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                if "superseded" in tables:
+                    # Versions replaced after this generation are the ones it holds.
+                    dst_conn.execute(
+                        "INSERT INTO incidents (row_id, number, cluster_id, record, content_hash, record_hash) "
+                        "SELECT row_id, number, cluster_id, record, content_hash, record_hash FROM superseded "
+                        "WHERE row_id < ? AND superseded_by >= ?", (n_rows, n_rows),
+                    )
+                    dst_conn.execute("DELETE FROM superseded WHERE row_id >= ? OR superseded_by >= ?",
+                                     (n_rows, n_rows))
+                if "incidents_fts" in tables:
+                    dst_conn.execute("DELETE FROM incidents_fts WHERE rowid >= ?", (n_rows,))
+        finally:
+            src_conn.close()
+            dst_conn.close()
+
+        with open(os.path.join(dest_dir, os.path.relpath(config.CURRENT_GENERATION_FILE, config.DATA_DIR)), "w",
+                  encoding="utf-8") as f:
+            f.write(gen_id)
+    logger.info("Exported generation %s (%d rows) to %s", gen_id, n_rows, dest_dir)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect, clean up and export index generations.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="list generations, newest last")
+    gc = sub.add_parser("gc", help="remove old generations")
+    gc.add_argument("--keep", type=int, default=None)
+    export = sub.add_parser("export", help="copy a generation for a read-only replica")
+    export.add_argument("dest")
+    export.add_argument("--generation", default=None, help="generation id (default: current)")
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        current = current_generation()
+        for gen_id in list_generations():
+            published = os.path.exists(os.path.join(generation_dir(gen_id), MANIFEST_FILE))
+            rows = read_manifest(gen_id)["n_rows"] if published else "incomplete"
+            print(f"{'*' if gen_id == current else ' '} {gen_id} {rows}")
+    elif args.command == "gc":
+        with index_write_lock():
+            gc_generations(args.keep)
+    else:
+        export_snapshot(args.dest, args.generation)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
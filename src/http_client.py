@@ -1,8 +1,16 @@
 import json
 import os
+import gzip
+import time
+import random
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from utils.logger import get_logger
-from typing import Optional, List, Dict
+from utils.config import config
+from summary_cache import get_summary_cache
+from utils.metrics import span, inc, get_registry
+from typing import Iterator, Optional, List, Dict, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -19,40 +27,132 @@ DEFAULT_AI_AGENT_ID = os.getenv("AI_AGENT_ID")
 DEFAULT_SUMMARIZATION_AGENT_ID = os.getenv("SUMMARIZATION_AGENT_ID")
 DEFAULT_TIMEOUT = 60  
 
-def post_incident_json(
-    json_path: str,
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Shared keep-alive session, sized for the enrichment worker pool."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(config.ENRICH_MAX_WORKERS, 10))
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def _retry_delay(attempt: int, resp: Optional[requests.Response]) -> float:
+    if resp is not None:
+        retry_after = resp.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), config.HTTP_BACKOFF_MAX)
+    delay = config.HTTP_BACKOFF_BASE * (2 ** attempt)
+    return min(delay * random.uniform(0.5, 1.0), config.HTTP_BACKOFF_MAX)
+
+
+def _post_with_retry(endpoint: str, body: dict, timeout: int, compress: bool = False) -> Dict:
+    """
+    POSTs body and returns the parsed JSON, backing off exponentially on 429/5xx and
+    connection errors. With compress, the body is sent gzip-encoded; an endpoint that
+    answers 415 gets it uncompressed instead.
+    """
+    session = get_session()
+    payload = json.dumps(body).encode("utf-8")
+    for attempt in range(config.HTTP_MAX_RETRIES + 1):
+        resp = None
+        try:
+            headers = dict(DEFAULT_HEADERS)
+            data = payload
+            if compress:
+                headers["Content-Encoding"] = "gzip"
+                data = gzip.compress(payload)
+            with span("http.post"):
+                resp = session.post(endpoint, headers=headers, data=data, timeout=timeout)
+            inc("http_requests")
+            inc("http_request_bytes", len(data))
+            if compress and resp.status_code == 415 and attempt < config.HTTP_MAX_RETRIES:
+                logger.warning("Endpoint does not accept gzip request bodies; sending uncompressed.")
+                compress = False
+                continue
+            if resp.status_code in RETRY_STATUS_CODES and attempt < config.HTTP_MAX_RETRIES:
+                inc("http_retries")
+                delay = _retry_delay(attempt, resp)
+                logger.warning("POST returned %s; retrying in %.1fs (attempt %d/%d)",
+                               resp.status_code, delay, attempt + 1, config.HTTP_MAX_RETRIES)
+                time.sleep(delay)
+                continue
+            resp.raise_for_status()
+            logger.info("POST successful, status code: %s", resp.status_code)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            inc("http_errors")
+            if attempt < config.HTTP_MAX_RETRIES:
+                inc("http_retries")
+                delay = _retry_delay(attempt, None)
+                logger.warning("POST failed (%s); retrying in %.1fs (attempt %d/%d)",
+                               e, delay, attempt + 1, config.HTTP_MAX_RETRIES)
+                time.sleep(delay)
+                continue
+            logger.exception("HTTP request failed: %s", e)
+            raise
+        except requests.RequestException as e:
+            inc("http_errors")
+            logger.exception("HTTP request failed: %s", e)
+            raise
+
+        try:
+            response_json = resp.json()
+            logger.info("Response JSON parsed")
+            return response_json
+        except ValueError:
+            inc("http_errors")
+            logger.error("Response content is not valid JSON")
+            raise
+
+
+def post_incident_records(
+    records: List[dict],
     ai_agent_id: str = DEFAULT_AI_AGENT_ID,
     configuration_environment: str = "DEV",
     endpoint: str = DEFAULT_ENDPOINT,
-    timeout: int = DEFAULT_TIMEOUT
+    timeout: int = DEFAULT_TIMEOUT,
+    compress: bool = False,
 ) -> Dict:
 
-    logger.info("Posting JSON to endpoint: %s", endpoint)
-    with open(json_path, "r", encoding="utf-8") as f:
-        payload_records = json.load(f)
+    logger.info("Posting %d records to endpoint: %s", len(records), endpoint)
 
     #body: convert the array to a JSON string 
-    user_query_str = json.dumps(payload_records, ensure_ascii=False)
+    user_query_str = json.dumps(records, ensure_ascii=False)
     body = {
         "ai_agent_id": ai_agent_id,
         "user_query": user_query_str,
         "configuration_environment": configuration_environment
     }
+    return _post_with_retry(endpoint, body, timeout, compress=compress)
 
-    try:
-        resp = requests.post(endpoint, headers=DEFAULT_HEADERS, json=body, timeout=timeout)
-        resp.raise_for_status()
-        logger.info("POST successful, status code: %s", resp.status_code)
-        try:
-            response_json = resp.json()
-            logger.info("Response JSON parsed")
-            return response_json
-        except ValueError:
-            logger.error("Response content is not valid JSON")
-            raise
-    except requests.RequestException as e:
-        logger.exception("HTTP request failed: %s", e)
-        raise
+
+def post_incident_json(
+    json_path: str,
+    ai_agent_id: str = DEFAULT_AI_AGENT_ID,
+    configuration_environment: str = "DEV",
+    endpoint: str = DEFAULT_ENDPOINT,
+    timeout: int = DEFAULT_TIMEOUT
+) -> Dict:
+
+    logger.info("Posting JSON to endpoint: %s", endpoint)
+    with open(json_path, "r", encoding="utf-8") as f:
+        payload_records = json.load(f)
+
+    return post_incident_records(
+        payload_records,
+        ai_agent_id=ai_agent_id,
+        configuration_environment=configuration_environment,
+        endpoint=endpoint,
+        timeout=timeout,
+    )
 
 def get_summarized_output(
         json_list: List[dict],
@@ -69,21 +169,146 @@ def get_summarized_output(
         "user_query": user_query_str,
         "configuration_environment": configuration_environment
     }
+    with span("summarize.request"):
+        return _post_with_retry(endpoint, body, timeout)
 
-    try:
-        resp = requests.post(endpoint, headers=DEFAULT_HEADERS, json=body, timeout=timeout)
-        resp.raise_for_status()
-        logger.info("POST successful, status code: %s", resp.status_code)
+def get_cached_summarized_output(
+        json_list: List[dict],
+        ai_agent_id: str = DEFAULT_SUMMARIZATION_AGENT_ID,
+        configuration_environment: str = "DEV",
+        endpoint: str = DEFAULT_ENDPOINT,
+        timeout: int = DEFAULT_TIMEOUT
+) -> Dict:
+    """
+    get_summarized_output() behind the on-disk summary cache, keyed by the incident
+    Numbers being summarized and the agent id. Only usable responses are cached.
+    """
+    numbers = [rec.get("Number") for rec in json_list]
+    cacheable = config.SUMMARY_CACHE_ENABLED and numbers and all(numbers)
+    if cacheable:
+        cached = get_summary_cache().get(numbers, ai_agent_id)
+        if cached is not None:
+            inc("summary_cache_hits")
+            logger.info("Summary cache hit for %d incidents", len(numbers))
+            return cached
+        inc("summary_cache_misses")
+        logger.info("Summary cache miss for %d incidents", len(numbers))
+
+    response_json = get_summarized_output(
+        json_list,
+        ai_agent_id=ai_agent_id,
+        configuration_environment=configuration_environment,
+        endpoint=endpoint,
+        timeout=timeout,
+    )
+    if cacheable and response_json.get("data", {}).get("responses", {}).get("agent_response"):
+        get_summary_cache().put(numbers, ai_agent_id, response_json)
+    return response_json
+
+
+def iter_sse(resp: requests.Response) -> Iterator[Tuple[str, str]]:
+    """Yields (event, data) for each server-sent event of a streamed response."""
+    if resp.encoding is None:
+        resp.encoding = "utf-8"
+    event, data = "message", []
+    # chunk_size=None hands over each chunk as it arrives instead of waiting for 512 bytes.
+    for line in resp.iter_lines(chunk_size=None, decode_unicode=True):
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "event":
+            event = value
+        elif field == "data":
+            data.append(value)
+    if data:
+        yield event, "\n".join(data)
+
+
+def stream_summarized_output(
+        json_list: List[dict],
+        ai_agent_id: str = DEFAULT_SUMMARIZATION_AGENT_ID,
+        configuration_environment: str = "DEV",
+        endpoint: str = DEFAULT_ENDPOINT,
+        timeout: int = DEFAULT_TIMEOUT
+) -> Iterator[str]:
+    """
+    Streaming variant of get_cached_summarized_output(): yields the agent_response text
+    as it arrives. The request asks for an event stream; each "data:" event carries
+    {"delta": "..."} (or plain text) and "[DONE]" ends the stream. An endpoint that
+    answers with plain JSON, and a summary cache hit, are yielded in one piece. Only a
+    stream that ended with "[DONE]" or a non-empty JSON reply is cached. timeout
+    applies to the connection and to each wait between chunks.
+    """
+    numbers = [rec.get("Number") for rec in json_list]
+    cacheable = config.SUMMARY_CACHE_ENABLED and numbers and all(numbers)
+    if cacheable:
+        cached = get_summary_cache().get(numbers, ai_agent_id)
+        if cached is not None:
+            inc("summary_cache_hits")
+            agent_response = cached.get("data", {}).get("responses", {}).get("agent_response") or {}
+            yield agent_response if isinstance(agent_response, str) else json.dumps(agent_response)
+            return
+        inc("summary_cache_misses")
+
+    logger.info("Streaming summarization from endpoint: %s", endpoint)
+    body = {
+        "ai_agent_id": ai_agent_id,
+        "user_query": json.dumps(json_list, ensure_ascii=False),
+        "configuration_environment": configuration_environment,
+        "stream": True,
+    }
+    headers = dict(DEFAULT_HEADERS, Accept="text/event-stream")
+    chunks = []
+    complete = False
+    start = time.perf_counter()
+    with span("summarize.stream"):
+        with get_session().post(endpoint, headers=headers, json=body, timeout=timeout, stream=True) as resp:
+            inc("http_requests")
+            resp.raise_for_status()
+            if not resp.headers.get("Content-Type", "").startswith("text/event-stream"):
+                agent_response = resp.json().get("data", {}).get("responses", {}).get("agent_response")
+                if agent_response:
+                    complete = True
+                    chunks.append(agent_response if isinstance(agent_response, str) else json.dumps(agent_response))
+                    yield chunks[0]
+                else:
+                    logger.warning("Summarization response has no agent_response")
+            else:
+                for _, data in iter_sse(resp):
+                    if data.strip() == "[DONE]":
+                        complete = True
+                        break
+                    try:
+                        payload = json.loads(data)
+                    except ValueError:
+                        payload = data
+                    chunk = payload.get("delta", "") if isinstance(payload, dict) else str(payload)
+                    if not chunk:
+                        continue
+                    if not chunks:
+                        get_registry().observe("summarize.first_chunk", time.perf_counter() - start)
+                    chunks.append(chunk)
+                    yield chunk
+
+    text = "".join(chunks)
+    if not complete:
+        logger.warning("Summarization stream ended without [DONE]; not caching %d chars", len(text))
+    # Same rule as get_cached_summarized_output(): only complete, non-empty summaries are cached.
+    if cacheable and complete and text:
         try:
-            response_json = resp.json()
-            logger.info("Response JSON parsed")
-            return response_json
+            agent_response = json.loads(text)
         except ValueError:
-            logger.error("Response content is not valid JSON")
-            raise
-    except requests.RequestException as e:
-        logger.exception("HTTP request failed: %s", e)
-        raise
+            agent_response = text
+        get_summary_cache().put(
+            numbers, ai_agent_id, {"success": True, "data": {"responses": {"agent_response": agent_response}}}
+        )
+
 
 def extract_incidents_from_response(response_json: dict) -> Optional[List[dict]]:
     """
@@ -0,0 +1,355 @@
+"""
+Background ingest jobs: uploads are queued in SQLite and processed by a worker process.
+
+    python jobs.py worker           # process queued jobs until stopped
+    python jobs.py submit file.csv  # queue an upload
+    python jobs.py status [job_id]
+
+Each enrichment batch is checkpointed with its incidents, so a restarted worker only
+sends the batches that have not succeeded yet and then re-runs indexing.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import threading
+import subprocess
+import traceback
+from typing import Iterator, Optional
+from utils.logger import get_logger
+from utils.config import config
+from json_creator import iter_records_from_file, write_ndjson, iter_ndjson, count_ndjson
+from dedup import iter_collapsed, save_duplicates
+from enrichment import enrich_batches, pack_batches, count_batches
+from http_client import DEFAULT_AI_AGENT_ID, DEFAULT_ENDPOINT
+from faiss_updater import update_faiss_with_new_data
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = get_logger("jobs")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    stage TEXT,
+    upload_path TEXT NOT NULL,
+    batch_size INTEGER NOT NULL,
+    total_records INTEGER,
+    total_batches INTEGER,
+    batches_done INTEGER NOT NULL DEFAULT 0,
+    incidents INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    result TEXT,
+    error TEXT,
+    worker_pid INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_batches (
+    job_id INTEGER NOT NULL,
+    batch_index INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    incidents TEXT,
+    PRIMARY KEY (job_id, batch_index)
+);
+"""
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """Jobs and their per-batch enrichment checkpoints, in one SQLite file."""
+
+    def __init__(self, path: str = None):
+        self.path = path or config.JOBS_DB_FILE
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def submit(self, upload_path: str) -> int:
+        """Queues an uploaded CSV/Excel file; the file is moved into the job's directory."""
+        now = time.time()
+        with self._lock, self._conn:
+            job_id = self._conn.execute(
+                "INSERT INTO jobs (status, stage, upload_path, batch_size, message, created_at, updated_at) "
+                "VALUES (?, 'queued', '', ?, 'Waiting for the ingest worker', ?, ?)",
+                (QUEUED, config.ENRICH_BATCH_SIZE, now, now),
+            ).lastrowid
+            job_dir = job_directory(job_id)
+            os.makedirs(job_dir, exist_ok=True)
+            stored_path = os.path.join(job_dir, "upload" + os.path.splitext(upload_path)[1].lower())
+            shutil.move(upload_path, stored_path)
+            self._conn.execute("UPDATE jobs SET upload_path = ? WHERE job_id = ?", (stored_path, job_id))
+        logger.info("Queued ingest job %d for %s", job_id, stored_path)
+        return job_id
+
+    def get(self, job_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list_jobs(self, limit: int = 10) -> list:
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs ORDER BY job_id DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def update(self, job_id: int, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def claim(self) -> Optional[dict]:
+        """Marks the oldest queued job as running in this process, requeueing jobs of dead workers first."""
+        with self._lock, self._conn:
+            for row in self._conn.execute("SELECT job_id, worker_pid FROM jobs WHERE status = ?", (RUNNING,)).fetchall():
+                if not _pid_alive(row["worker_pid"]):
+                    logger.warning("Job %d was interrupted; resuming from its last checkpoint", row["job_id"])
+                    self._conn.execute("UPDATE jobs SET status = ? WHERE job_id = ?", (QUEUED, row["job_id"]))
+            row = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE status = ? ORDER BY job_id LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, worker_pid = ?, attempts = attempts + 1, updated_at = ? WHERE job_id = ?",
+                (RUNNING, os.getpid(), time.time(), row["job_id"]),
+            )
+        return self.get(row["job_id"])
+
+    def save_batch(self, job_id: int, batch_index: int, incidents: Optional[list]):
+        """Checkpoints one enrichment batch; incidents is None for a failed or rejected batch."""
+        status = "ok" if incidents is not None else "failed"
+        payload = json.dumps(incidents, ensure_ascii=False) if incidents is not None else None
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_batches (job_id, batch_index, status, incidents) VALUES (?, ?, ?, ?)",
+                (job_id, batch_index, status, payload),
+            )
+
+    def completed_batches(self, job_id: int) -> set:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT batch_index FROM job_batches WHERE job_id = ? AND status = 'ok'", (job_id,)
+            ).fetchall()
+        return {r[0] for r in rows}
+
+    def batch_counts(self, job_id: int) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM job_batches WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall()
+        return {status: n for status, n in rows}
+
+    def iter_incidents(self, job_id: int, page: int = 100) -> Iterator[dict]:
+        """Enriched incidents of all successful batches, in input order."""
+        last = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT batch_index, incidents FROM job_batches "
+                    "WHERE job_id = ? AND status = 'ok' AND batch_index > ? ORDER BY batch_index LIMIT ?",
+                    (job_id, last, page),
+                ).fetchall()
+            if not rows:
+                return
+            for batch_index, incidents in rows:
+                yield from json.loads(incidents)
+                last = batch_index
+
+    def purge_batches(self, job_id: int):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM job_batches WHERE job_id = ?", (job_id,))
+
+
+def job_directory(job_id: int) -> str:
+    return os.path.join(config.JOBS_DIR, str(job_id))
+
+
+def run_job(queue: JobQueue, job: dict):
+    job_id = job["job_id"]
+    batch_size = job["batch_size"]
+
+    # Parse: the upload is converted to NDJSON once and reused on resume.
+    input_path = os.path.join(job_directory(job_id), "input.ndjson")
+    # Near-duplicates are recorded only after indexing, once their representatives are searchable.
+    duplicates_path = os.path.join(job_directory(job_id), "duplicates.ndjson")
+    if not os.path.exists(input_path):
+        queue.update(job_id, stage="parsing", message="Reading uploaded file")
+        records = iter_records_from_file(job["upload_path"])
+        duplicates = []
+        if config.DEDUP_ENABLED:
+            dedup_stats = {}
+            records = iter_collapsed(records, dedup_stats, duplicates)
+        # input.ndjson appears last, so a resumed job never lacks the duplicates file.
+        write_ndjson(records, input_path + ".parsed")
+        write_ndjson(duplicates, duplicates_path)
+        os.replace(input_path + ".parsed", input_path)
+        if config.DEDUP_ENABLED:
+            queue.update(job_id, message=f"Collapsed {dedup_stats['records'] - dedup_stats['representatives']} "
+                                         f"near-duplicate(s) of {dedup_stats['records']} incidents")
+    total = count_ndjson(input_path)
+    total_batches = count_batches(iter_ndjson(input_path), batch_size)
+    done = queue.completed_batches(job_id)
+    queue.update(job_id, stage="enriching", total_records=total, total_batches=total_batches,
+                 batches_done=len(done), message=f"{total} incidents in {total_batches} batch(es)")
+    logger.info("Job %d: %d records, %d/%d batches already enriched", job_id, total, len(done), total_batches)
+
+    # Enrich: only batches without a successful checkpoint are sent.
+    remaining = []
+
+    # Packing is deterministic, so batch indexes match the checkpoints of an earlier run.
+    def remaining_batches():
+        for batch_index, batch in enumerate(pack_batches(iter_ndjson(input_path), batch_size)):
+            if batch_index in done:
+                continue
+            remaining.append(batch_index)
+            yield batch
+
+    stats = {}
+    batches_done = len(done)
+    for i, incidents, message in enrich_batches(
+        remaining_batches(), DEFAULT_AI_AGENT_ID, DEFAULT_ENDPOINT, stats=stats
+    ):
+        queue.save_batch(job_id, remaining[i], incidents)
+        batches_done += 1
+        queue.update(job_id, batches_done=batches_done, incidents=job["incidents"] + stats["incidents"], message=message)
+
+    counts = queue.batch_counts(job_id)
+    failed = counts.get("failed", 0)
+    if not counts.get("ok"):
+        raise RuntimeError("No incidents successfully processed.")
+
+    # Index: holds the index lock inside update_faiss_with_new_data, so only one
+    # rebuild runs at a time across workers, the UI and the search service.
+    queue.update(job_id, stage="indexing", message="Updating FAISS index")
+    new_count, total_count = update_faiss_with_new_data(queue.iter_incidents(job_id))
+    duplicates = save_duplicates(iter_ndjson(duplicates_path)) if os.path.exists(duplicates_path) else 0
+    result = {"new": new_count, "total": total_count, "failed_batches": failed, "missing": stats.get("missing", 0),
+              "duplicates": duplicates,
+              "enrichment_cache_hits": stats.get("cache_hits", 0), "enrichment_cache_misses": stats.get("cache_misses", 0)}
+    queue.update(
+        job_id, status=DONE, stage="done", result=json.dumps(result),
+        message=f"Added {new_count} new incidents. Total: {total_count}"
+        + (f" ({failed} batch(es) failed and were skipped)" if failed else ""),
+    )
+    queue.purge_batches(job_id)
+    shutil.rmtree(job_directory(job_id), ignore_errors=True)
+    logger.info("Job %d finished: %s", job_id, result)
+
+
+def run_worker(poll_interval: float = None, once: bool = False):
+    """Processes queued jobs one at a time; exits if another worker already holds the lock."""
+    poll_interval = poll_interval or config.JOB_POLL_INTERVAL
+    lock_file = _acquire_worker_lock()
+    if lock_file is None:
+        logger.info("Another ingest worker is already running.")
+        return
+    queue = JobQueue()
+    logger.info("Ingest worker %d started", os.getpid())
+    try:
+        while True:
+            job = queue.claim()
+            if job is None:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                continue
+            logger.info("Running ingest job %d (attempt %d)", job["job_id"], job["attempts"])
+            try:
+                run_job(queue, job)
+            except Exception as e:
+                logger.exception("Ingest job %d failed: %s", job["job_id"], e)
+                queue.update(job["job_id"], status=FAILED, error=traceback.format_exc(), message=f"Failed: {e}")
+    finally:
+        lock_file.close()
+
+
+def _acquire_worker_lock():
+    os.makedirs(os.path.dirname(config.JOB_WORKER_LOCK_FILE) or ".", exist_ok=True)
+    f = open(config.JOB_WORKER_LOCK_FILE, "a")
+    if fcntl is None:
+        return f
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def worker_running() -> bool:
+    if fcntl is None or not os.path.exists(config.JOB_WORKER_LOCK_FILE):
+        return False
+    with open(config.JOB_WORKER_LOCK_FILE, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return False
+
+
+def ensure_worker():
+    """Starts a detached worker process unless one is already running."""
+    if worker_running():
+        return
+    log_path = os.path.join(config.DATA_DIR, "jobs_worker.log")
+    with open(log_path, "a") as log:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "worker"],
+            stdout=log, stderr=log, start_new_session=True,
+        )
+    logger.info("Started background ingest worker")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Background ingest jobs.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker = sub.add_parser("worker", help="process queued jobs")
+    worker.add_argument("--once", action="store_true", help="exit when the queue is empty")
+    submit = sub.add_parser("submit", help="queue a CSV/Excel upload (the file is moved)")
+    submit.add_argument("path")
+    status = sub.add_parser("status", help="show recent jobs or one job")
+    status.add_argument("job_id", nargs="?", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "worker":
+        run_worker(once=args.once)
+    elif args.command == "submit":
+        print(JobQueue().submit(args.path))
+    else:
+        jobs = [JobQueue().get(args.job_id)] if args.job_id else JobQueue().list_jobs()
+        for job in jobs:
+            if job:
+                print(f"{job['job_id']:>5} {job['status']:<8} {job['stage'] or '':<10} "
+                      f"{job['batches_done']}/{job['total_batches'] or '?'} {job['message'] or ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
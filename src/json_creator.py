@@ -1,8 +1,11 @@
 import os
+import codecs
 import pandas as pd
 import json
+from typing import Iterable, Iterator
 from utils.logger import get_logger
 from utils.config import config
+from utils.metrics import span, inc
 
 logger = get_logger("json_creator")
 
@@ -15,45 +18,141 @@ REQUIRED_COLUMNS = [
 ]
 
 
-def create_json_from_file(upload_path: str) -> str:
+def _detect_csv_encoding(upload_path: str) -> str:
+    # Decode incrementally so the check does not hold the file in memory.
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        with open(upload_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                decoder.decode(block)
+            decoder.decode(b"", final=True)
+        return "utf-8"
+    except UnicodeDecodeError:
+        logger.warning("UTF-8 decoding failed. Retrying with latin1 encoding...")
+        return "latin1"
+
+
+def _select_columns(columns: list) -> list:
+    columns = [str(c).strip() for c in columns]
+    missing_cols = [c for c in REQUIRED_COLUMNS if c not in columns]
+    if missing_cols:
+        logger.warning("Missing columns in upload: %s", missing_cols)
+    return [c for c in REQUIRED_COLUMNS if c in columns]
+
+
+def _iter_csv_records(upload_path: str) -> Iterator[dict]:
+    encoding = _detect_csv_encoding(upload_path)
+    available_cols = None
+    for chunk in pd.read_csv(upload_path, dtype=str, encoding=encoding, chunksize=config.INGEST_CHUNK_SIZE):
+        chunk.columns = chunk.columns.str.strip()
+        if available_cols is None:
+            available_cols = _select_columns(list(chunk.columns))
+        chunk = chunk[available_cols].dropna(subset=available_cols)
+        yield from chunk.to_dict(orient="records")
 
-    os.makedirs(config.DATA_DIR, exist_ok=True)
-    logger.info("Starting JSON creation from file: %s", upload_path)
 
+def _iter_xlsx_records(upload_path: str) -> Iterator[dict]:
+    from openpyxl import load_workbook
+
+    # read_only mode streams rows instead of building the whole sheet in memory.
+    wb = load_workbook(upload_path, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = [str(c).strip() if c is not None else "" for c in next(rows, [])]
+        available_cols = _select_columns(header)
+        positions = [header.index(c) for c in available_cols]
+        for row in rows:
+            values = [row[p] if p < len(row) else None for p in positions]
+            if any(v is None or v == "" for v in values):
+                continue
+            yield {c: str(v) for c, v in zip(available_cols, values)}
+    finally:
+        wb.close()
+
+
+def _iter_xls_records(upload_path: str) -> Iterator[dict]:
+    # openpyxl cannot read the legacy binary format, so .xls is loaded in one go.
+    df = pd.read_excel(upload_path, dtype=str)
+    df.columns = df.columns.str.strip()
+    available_cols = _select_columns(list(df.columns))
+    df = df[available_cols].dropna(subset=available_cols)
+    yield from df.to_dict(orient="records")
+
+
+def iter_records_from_file(upload_path: str) -> Iterator[dict]:
+    """
+    Yields cleaned incident records from a CSV or Excel upload without loading the
+    whole file. Rows missing any of the available required columns are dropped.
+    """
+    logger.info("Streaming records from file: %s", upload_path)
     ext = upload_path.split(".")[-1].lower()
 
-    if ext in ("xlsx", "xls"):
-        df = pd.read_excel(upload_path, dtype=str)
-        logger.info("Read Excel file, rows: %d", len(df))
-    elif ext == "csv":
-        try:
-            df = pd.read_csv(upload_path, dtype=str, encoding="utf-8")
-        except UnicodeDecodeError:
-            logger.warning("UTF-8 decoding failed. Retrying with latin1 encoding...")
-            df = pd.read_csv(upload_path, dtype=str, encoding="latin1")
-        logger.info("Read CSV file, rows: %d", len(df))
+    if ext == "csv":
+        records = _iter_csv_records(upload_path)
+    elif ext == "xlsx":
+        records = _iter_xlsx_records(upload_path)
+    elif ext == "xls":
+        records = _iter_xls_records(upload_path)
     else:
         logger.error("Unsupported file type: %s", ext)
         raise ValueError("Unsupported file type. Please upload CSV or Excel.")
 
-    df.columns = df.columns.str.strip()
+    kept = 0
+    for rec in records:
+        kept += 1
+        yield rec
+    inc("upload_records_parsed", kept)
+    logger.info("Streamed %d records with all required fields from %s", kept, upload_path)
 
-    missing_cols = [c for c in REQUIRED_COLUMNS if c not in df.columns]
-    if missing_cols:
-        logger.warning("Missing columns in upload: %s", missing_cols)
-    available_cols = [c for c in REQUIRED_COLUMNS if c in df.columns]
 
-    df = df[available_cols].copy()
+def write_ndjson(records: Iterable[dict], path: str) -> int:
+    tmp_path = path + ".tmp"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(rec, ensure_ascii=False))
+            f.write("\n")
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+def iter_ndjson(path: str) -> Iterator[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def count_ndjson(path: str) -> int:
+    with open(path, "r", encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def create_ndjson_from_file(upload_path: str) -> str:
+
+    os.makedirs(config.DATA_DIR, exist_ok=True)
+    logger.info("Starting NDJSON creation from file: %s", upload_path)
 
-    before = len(df)
-    df = df.dropna(subset=available_cols)
-    after = len(df)
-    logger.info("Dropped %d rows with missing required fields. Remaining: %d", before - after, after)
+    with span("upload.parse"):
+        count = write_ndjson(iter_records_from_file(upload_path), config.TEMP_NDJSON)
+
+    logger.info("Temporary NDJSON file with %d records created at: %s", count, config.TEMP_NDJSON)
+    return config.TEMP_NDJSON
+
+
+def create_json_from_file(upload_path: str) -> str:
+
+    os.makedirs(config.DATA_DIR, exist_ok=True)
+    logger.info("Starting JSON creation from file: %s", upload_path)
 
-    records = df.to_dict(orient="records") # json compatible form
     tmp_path = config.TEMP_JSON + ".tmp"
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(records, f, ensure_ascii=False, indent=2)
+    with span("upload.parse"), open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for i, rec in enumerate(iter_records_from_file(upload_path)):
+            f.write(",\n" if i else "\n")
+            json.dump(rec, f, ensure_ascii=False)
+        f.write("\n]")
     os.replace(tmp_path, config.TEMP_JSON)
 
     logger.info("Temporary JSON file created at: %s", config.TEMP_JSON)
@@ -0,0 +1,407 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import threading
+import pandas as pd
+from utils.logger import get_logger
+from utils.config import config
+
+logger = get_logger("metadata_store")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS incidents (
+    row_id INTEGER PRIMARY KEY,
+    number TEXT UNIQUE,
+    cluster_id INTEGER,
+    record TEXT NOT NULL,
+    content_hash TEXT,
+    record_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_incidents_cluster ON incidents(cluster_id);
+CREATE TABLE IF NOT EXISTS superseded (
+    row_id INTEGER PRIMARY KEY,
+    number TEXT,
+    cluster_id INTEGER,
+    record TEXT NOT NULL,
+    content_hash TEXT,
+    record_hash TEXT,
+    superseded_by INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_superseded_number ON superseded(number);
+CREATE INDEX IF NOT EXISTS idx_superseded_by ON superseded(superseded_by);
+CREATE TABLE IF NOT EXISTS duplicates (
+    number TEXT PRIMARY KEY,
+    representative TEXT NOT NULL,
+    distance REAL
+);
+CREATE INDEX IF NOT EXISTS idx_duplicates_representative ON duplicates(representative);
+"""
+
+# Token index over the fields engineers search for verbatim. "-", "_" and "." are kept
+# inside tokens so ORA-01017, 0x80070005 and srv-prd-01 are indexed whole.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE incidents_fts USING fts5(tokens, tokenize="unicode61 tokenchars '-_.'");
+"""
+LEXICAL_FIELDS = ["Number", "Short description", "Description", "Resolution notes"]
+_TOKEN_RE = re.compile(r"[^\W_](?:[\w.\-]*[^\W_])?")
+
+# SQLite limits the number of bound parameters per statement.
+_QUERY_CHUNK = 500
+
+
+def content_hash(text: str) -> str:
+    """Hash of the text an incident is embedded from."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def record_hash(record: dict) -> str:
+    """Hash of the full record, independent of key order."""
+    return hashlib.sha256(json.dumps(record, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def tokenize(text: str) -> list:
+    """Splits on whitespace and punctuation, keeping "-", "_" and "." between alphanumerics."""
+    return _TOKEN_RE.findall(str(text))
+
+
+def _lexical_text(record: dict) -> str:
+    return " ".join(" ".join(tokenize(record.get(field) or "")) for field in LEXICAL_FIELDS)
+
+
+class MetadataStore:
+    """
+    Incident records keyed by FAISS row id, with lookups by incident Number and an
+    index on cluster_id. Row ids are the positions of the vectors in the embedding store.
+    Rows are never rewritten: a changed incident gets a new row, and the version it
+    replaces moves to the superseded table, where older generations still find it.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or config.METADATA_DB_FILE
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._conn.commit()
+        self.fts = self._init_fts()
+
+    def _migrate(self):
+        # Stores created before hashes were tracked; NULL hashes force a re-embed on the next upload.
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(incidents)")}
+        for column in ("content_hash", "record_hash"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE incidents ADD COLUMN {column} TEXT")
+
+    def _init_fts(self) -> bool:
+        exists = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'incidents_fts'"
+        ).fetchone()
+        if exists:
+            return True
+        try:
+            with self._conn:
+                self._conn.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            logger.warning("SQLite FTS5 unavailable (%s); lexical search disabled.", e)
+            return False
+        # Stores created before the token index existed are indexed once here.
+        backfilled = 0
+        last_row_id = -1
+        while True:
+            rows = self._conn.execute(
+                "SELECT row_id, record FROM incidents WHERE row_id > ? ORDER BY row_id LIMIT ?",
+                (last_row_id, config.BATCH_SIZE),
+            ).fetchall()
+            if not rows:
+                break
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO incidents_fts (rowid, tokens) VALUES (?, ?)",
+                    [(row_id, _lexical_text(json.loads(record))) for row_id, record in rows],
+                )
+            backfilled += len(rows)
+            last_row_id = rows[-1][0]
+        if backfilled:
+            logger.info("Built token index for %d existing incidents", backfilled)
+        return True
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM incidents").fetchone()[0]
+
+    def next_row_id(self) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MAX(row_id) FROM (SELECT MAX(row_id) AS row_id FROM incidents "
+                "UNION ALL SELECT MAX(row_id) FROM superseded)"
+            ).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def get_row_ids(self, numbers, before: int = None) -> dict:
+        """
+        Maps each known incident Number to its row id. With before, only rows below it
+        count: the version a generation of that many rows holds.
+        """
+        numbers = [n for n in numbers if n is not None]
+        found = {}
+        with self._lock:
+            for i in range(0, len(numbers), _QUERY_CHUNK):
+                chunk = numbers[i:i + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for number, row_id in self._conn.execute(
+                    f"SELECT number, row_id FROM incidents WHERE number IN ({placeholders})", chunk
+                ):
+                    if before is None or row_id < before:
+                        found[number] = row_id
+            older = [n for n in numbers if n not in found] if before is not None else []
+            for i in range(0, len(older), _QUERY_CHUNK):
+                chunk = older[i:i + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for number, row_id in self._conn.execute(
+                    f"SELECT number, MAX(row_id) FROM superseded WHERE number IN ({placeholders}) AND row_id < ? "
+                    "GROUP BY number", [*chunk, before]
+                ):
+                    found[number] = row_id
+        return found
+
+    def current_row_ids(self, start: int = 0, end: int = None) -> list:
+        """Row ids of the current version of every incident, optionally within [start, end)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_id FROM incidents WHERE row_id >= ? AND row_id < ? ORDER BY row_id",
+                (int(start), int(end) if end is not None else 2 ** 62),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def superseded_since(self, n_rows: int) -> list:
+        """Rows below n_rows replaced by a row at or past it, i.e. after a generation of n_rows rows."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_id FROM superseded WHERE row_id < ? AND superseded_by >= ? ORDER BY row_id",
+                (int(n_rows), int(n_rows)),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def superseded_row_ids(self, numbers) -> list:
+        """Row ids of the replaced versions of the given incidents."""
+        numbers = [n for n in numbers if n is not None]
+        row_ids = []
+        with self._lock:
+            for i in range(0, len(numbers), _QUERY_CHUNK):
+                chunk = numbers[i:i + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                row_ids.extend(r[0] for r in self._conn.execute(
+                    f"SELECT row_id FROM superseded WHERE number IN ({placeholders})", chunk
+                ))
+        return row_ids
+
+    def get_hashes(self, numbers) -> dict:
+        """Maps each known incident Number to (row_id, content_hash, record_hash)."""
+        numbers = [n for n in numbers if n is not None]
+        found = {}
+        with self._lock:
+            for i in range(0, len(numbers), _QUERY_CHUNK):
+                chunk = numbers[i:i + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for number, row_id, c_hash, r_hash in self._conn.execute(
+                    f"SELECT number, row_id, content_hash, record_hash FROM incidents WHERE number IN ({placeholders})",
+                    chunk,
+                ):
+                    found[number] = (row_id, c_hash, r_hash)
+        return found
+
+    def insert_records(self, records: list, start_row_id: int, content_hashes: list = None):
+        content_hashes = content_hashes or [None] * len(records)
+        rows = [
+            (start_row_id + i, rec.get("Number"), json.dumps(rec, ensure_ascii=False), c_hash, record_hash(rec))
+            for i, (rec, c_hash) in enumerate(zip(records, content_hashes))
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO incidents (row_id, number, record, content_hash, record_hash) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            if self.fts:
+                self._conn.executemany(
+                    "INSERT INTO incidents_fts (rowid, tokens) VALUES (?, ?)",
+                    [(start_row_id + i, _lexical_text(rec)) for i, rec in enumerate(records)],
+                )
+        logger.info("Inserted %d incident records starting at row %d", len(rows), start_row_id)
+
+    def replace_records(self, old_row_ids: list, records: list, start_row_id: int, content_hashes: list):
+        """
+        Stores new versions of known incidents at rows start_row_id onwards. The versions
+        they replace keep their rows, in the superseded table and the token index.
+        """
+        old_row_ids = [int(r) for r in old_row_ids]
+        rows = [
+            (start_row_id + i, json.dumps(rec, ensure_ascii=False), c_hash, record_hash(rec), old_row_id)
+            for i, (old_row_id, rec, c_hash) in enumerate(zip(old_row_ids, records, content_hashes))
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO superseded (row_id, number, cluster_id, record, content_hash, record_hash, superseded_by) "
+                "SELECT row_id, number, cluster_id, record, content_hash, record_hash, ? FROM incidents WHERE row_id = ?",
+                [(start_row_id + i, old_row_id) for i, old_row_id in enumerate(old_row_ids)],
+            )
+            self._conn.executemany(
+                "UPDATE incidents SET row_id = ?, record = ?, content_hash = ?, record_hash = ?, cluster_id = NULL "
+                "WHERE row_id = ?",
+                rows,
+            )
+            if self.fts:
+                self._conn.executemany(
+                    "INSERT INTO incidents_fts (rowid, tokens) VALUES (?, ?)",
+                    [(start_row_id + i, _lexical_text(rec)) for i, rec in enumerate(records)],
+                )
+        logger.info("Stored %d new incident versions starting at row %d", len(rows), start_row_id)
+
+    def search_tokens(self, tokens: list, limit: int, before: int = None) -> list:
+        """
+        Row ids of incidents containing any of the tokens, best BM25 match first. With
+        before, the incidents as a generation of that many rows holds them.
+        """
+        if not (self.fts and tokens):
+            return []
+        match = " OR ".join('"' + t.replace('"', '""') + '"' for t in tokens)
+        before = int(before) if before is not None else 2 ** 62
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rowid FROM incidents_fts WHERE incidents_fts MATCH ? AND rowid < ? "
+                "AND rowid NOT IN (SELECT row_id FROM superseded WHERE superseded_by < ?) ORDER BY rank LIMIT ?",
+                (match, before, before, int(limit)),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def add_duplicates(self, rows: list):
+        """Records (number, representative Number, distance) for near-duplicates that were not indexed."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO duplicates (number, representative, distance) VALUES (?, ?, ?)",
+                [(n, rep, float(d)) for n, rep, d in rows],
+            )
+
+    def remove_duplicates(self, numbers):
+        numbers = [n for n in numbers if n is not None]
+        with self._lock, self._conn:
+            for i in range(0, len(numbers), _QUERY_CHUNK):
+                chunk = numbers[i:i + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                self._conn.execute(f"DELETE FROM duplicates WHERE number IN ({placeholders})", chunk)
+
+    def get_duplicates(self, representatives) -> dict:
+        """Maps each representative Number to the Numbers collapsed into it, closest first."""
+        representatives = [r for r in dict.fromkeys(representatives) if r is not None]
+        found = {}
+        with self._lock:
+            for i in range(0, len(representatives), _QUERY_CHUNK):
+                chunk = representatives[i:i + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for number, rep in self._conn.execute(
+                    f"SELECT number, representative FROM duplicates WHERE representative IN ({placeholders}) "
+                    "ORDER BY distance, number", chunk
+                ):
+                    found.setdefault(rep, []).append(number)
+        return found
+
+    def get_representatives(self, numbers) -> dict:
+        """Maps each collapsed near-duplicate Number to its representative's Number."""
+        numbers = [n for n in numbers if n is not None]
+        found = {}
+        with self._lock:
+            for i in range(0, len(numbers), _QUERY_CHUNK):
+                chunk = numbers[i:i + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for number, rep in self._conn.execute(
+                    f"SELECT number, representative FROM duplicates WHERE number IN ({placeholders})", chunk
+                ):
+                    found[number] = rep
+        return found
+
+    def get_cluster_ids(self, row_ids) -> dict:
+        row_ids = [int(r) for r in row_ids]
+        found = {}
+        with self._lock:
+            for i in range(0, len(row_ids), _QUERY_CHUNK):
+                chunk = row_ids[i:i + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for row_id, cluster_id in self._conn.execute(
+                    f"SELECT row_id, cluster_id FROM incidents WHERE row_id IN ({placeholders})", chunk
+                ):
+                    found[row_id] = cluster_id
+        return found
+
+    def set_cluster_ids(self, row_ids, cluster_ids):
+        rows = [(int(c), int(r)) for r, c in zip(row_ids, cluster_ids)]
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE incidents SET cluster_id = ? WHERE row_id = ?", rows)
+        logger.info("Saved cluster assignments for %d rows", len(rows))
+
+    def fetch(self, row_ids, include_row_id: bool = False) -> pd.DataFrame:
+        """
+        Returns the records for the given row ids, in the same order; ids that are not
+        stored are skipped. include_row_id adds each record's row id as a row_id column.
+        """
+        row_ids = [int(r) for r in row_ids]
+        by_id = {}
+        with self._lock:
+            for i in range(0, len(row_ids), _QUERY_CHUNK):
+                chunk = row_ids[i:i + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for row_id, cluster_id, record in self._conn.execute(
+                    f"SELECT row_id, cluster_id, record FROM incidents WHERE row_id IN ({placeholders}) "
+                    f"UNION ALL SELECT row_id, cluster_id, record FROM superseded WHERE row_id IN ({placeholders})",
+                    chunk + chunk,
+                ):
+                    rec = json.loads(record)
+                    rec["cluster_id"] = cluster_id
+                    if include_row_id:
+                        rec["row_id"] = row_id
+                    by_id[row_id] = rec
+        return pd.DataFrame([by_id[r] for r in row_ids if r in by_id])
+
+    def fetch_cluster(self, cluster_id: int) -> pd.DataFrame:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT record FROM incidents WHERE cluster_id = ? ORDER BY row_id", (int(cluster_id),)
+            ).fetchall()
+        records = [json.loads(r[0]) for r in rows]
+        for rec in records:
+            rec["cluster_id"] = int(cluster_id)
+        return pd.DataFrame(records)
+
+    def import_legacy_json(self):
+        """
+        One-time import of clustered_incidents.json (or cleaned_incidents.json when no
+        clustering has run yet). Row ids follow the file order. The legacy embeddings.npy
+        is not paired with these rows; open_embedding_store() re-embeds them.
+        """
+        if self.count() > 0:
+            return
+        path = config.CLUSTER_ASSIGNMENTS_FILE
+        if not os.path.exists(path):
+            path = config.DATA_FILE
+        if not os.path.exists(path):
+            return
+
+        with open(path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+        cluster_ids = [rec.pop("cluster_id", None) for rec in records]
+        self.insert_records(records, 0)
+        if all(c is not None for c in cluster_ids):
+            self.set_cluster_ids(range(len(records)), cluster_ids)
+        logger.info("Imported %d legacy records from %s; the JSON file is no longer read.", len(records), path)
+
+
+def open_metadata_store() -> MetadataStore:
+    store = MetadataStore()
+    store.import_legacy_json()
+    return store
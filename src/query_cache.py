@@ -0,0 +1,103 @@
+import os
+import atexit
+import threading
+from collections import OrderedDict
+import numpy as np
+from utils.logger import get_logger
+from utils.config import config
+
+logger = get_logger("query_cache")
+
+
+def normalize_query(query: str) -> str:
+    """Collapses whitespace and folds case, so "VPN down" and "vpn  down " share one entry."""
+    return " ".join(str(query).split()).casefold()
+
+
+class QueryEmbeddingCache:
+    """Bounded LRU of query embeddings keyed on (model name, normalized query)."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_name: str, query: str):
+        key = (model_name, normalize_query(query))
+        with self._lock:
+            vec = self._entries.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, model_name: str, query: str, vec: np.ndarray):
+        key = (model_name, normalize_query(query))
+        with self._lock:
+            self._entries[key] = np.asarray(vec, dtype=np.float32)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def save(self, path: str):
+        with self._lock:
+            if not self._entries:
+                return
+            keys = list(self._entries.keys())
+            vectors = np.stack(list(self._entries.values()))
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"  # service workers may save concurrently
+        np.savez(
+            tmp_path,
+            models=np.array([k[0] for k in keys]),
+            queries=np.array([k[1] for k in keys]),
+            vectors=vectors,
+        )
+        os.replace(tmp_path, path)
+        logger.info("Saved %d cached query embeddings to %s", len(keys), path)
+
+    def load(self, path: str):
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                entries = zip(data["models"].tolist(), data["queries"].tolist(), data["vectors"])
+                with self._lock:
+                    for model_name, query, vec in entries:
+                        self._entries[(model_name, query)] = vec
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+            logger.info("Loaded %d cached query embeddings from %s", len(self._entries), path)
+        except Exception as e:
+            logger.warning("Could not load query cache %s: %s", path, e)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> QueryEmbeddingCache:
+    """Process-wide cache; survives retriever reloads and, if enabled, restarts."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = QueryEmbeddingCache(config.QUERY_CACHE_SIZE)
+            if config.QUERY_CACHE_PERSIST:
+                _cache.load(config.QUERY_CACHE_FILE)
+                atexit.register(_cache.save, config.QUERY_CACHE_FILE)
+        return _cache
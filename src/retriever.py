@@ -1,97 +1,308 @@
 import os
-import json
+import re
+import time
+import threading
 import faiss
 import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
 from utils.logger import get_logger
-from cluster_manager import load_cluster_model
+from cluster_manager import load_ivf_index
+from generations import current_generation, generation_path, read_manifest
+from metadata_store import open_metadata_store, tokenize
+from embedding_store import open_embedding_store
+from embedder import get_encoder
+from query_cache import get_query_cache, normalize_query
 from utils.config import config
+from utils.metrics import span, timed, inc
 
 logger = get_logger("retriever")
 
-DATA_FILE = os.path.join("data", "clustered_incidents.json")
-INDEX_FILE = os.path.join("data", "embeddings.faiss")
-MODEL_NAME = "all-MiniLM-L6-v2"
+# Tokens that are matched verbatim: error codes, hex codes, host names, ticket numbers.
+_EXACT_TOKEN_RE = re.compile(r"^(?=.*\d)[\w.\-]{3,}$")
+
+_retriever = None
+_retriever_lock = threading.Lock()
+_reload_lock = threading.Lock()
+_last_version_check = 0.0
+
+
+def current_index_version() -> str:
+    """
+    Returns the published generation id. Falls back to the mtimes of the index files
+    for data written before generations existed.
+    """
+    generation = current_generation()
+    if generation:
+        return generation
+
+    paths = [config.METADATA_DB_FILE, config.IVF_INDEX_FILE]
+    return "|".join(
+        str(os.path.getmtime(p)) if os.path.exists(p) else "-" for p in paths
+    )
 
 
 class IncidentRetriever:
+    @timed("retriever.load")
     def __init__(self):
-        if not os.path.exists(DATA_FILE):
-            raise FileNotFoundError(f"Data file not found: {DATA_FILE}")
-        if not os.path.exists(INDEX_FILE):
-            raise FileNotFoundError(f"FAISS index not found: {INDEX_FILE}")
+        # Everything below is read from this one generation, however many are published meanwhile.
+        self.version = current_index_version()
+        self.generation = current_generation()
+        ivf_path = generation_path("ivf_index", self.generation)
+        if not os.path.exists(ivf_path):
+            raise FileNotFoundError(f"FAISS index not found: {ivf_path}")
+        manifest = read_manifest(self.generation) if self.generation else None
 
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            self.data = json.load(f)
-        self.df = pd.DataFrame(self.data)
+        # Records are looked up by row id per query instead of being held in a DataFrame.
+        self.metadata = open_metadata_store()
+        logger.info("Opened metadata store with %d records", self.metadata.count())
 
-        logger.info("Loaded DataFrame with shape %s and columns: %s", self.df.shape, list(self.df.columns))
+        with span("encoder.load"):
+            self.model = get_encoder()
+        self.index = load_ivf_index(generation=self.generation)
+        # Cluster ids as of this generation; the metadata store holds the latest ones.
+        ids_path = generation_path("cluster_ids", self.generation)
+        self.cluster_ids = np.load(ids_path, mmap_mode="r") if os.path.exists(ids_path) else None
 
-        self.model = SentenceTransformer(MODEL_NAME, device="cpu", trust_remote_code=True)
-        self.index = faiss.read_index(INDEX_FILE)
+        # Compressed (SQ8/PQ) indexes return approximate distances; candidates are
+        # re-ranked against the exact vectors in the memory-mapped embedding store.
+        self.rerank = config.RERANK and not isinstance(self.index, faiss.IndexIVFFlat)
+        # Also read for incident Number lookups and for distances of token-only matches.
+        # Rows appended after this generation was published, including newer versions of
+        # its incidents, stay invisible to this reader.
+        self.embeddings = open_embedding_store().open_memmap()
+        self.n_rows = manifest["n_rows"] if manifest else len(self.embeddings)
+        self.embeddings = self.embeddings[:self.n_rows]
 
-        logger.info("Retriever initialized: loaded %d records and FAISS index", len(self.df))
+        logger.info(
+            "Retriever initialized: IVF index with %d vectors, %d lists, nprobe=%d (generation %s)",
+            self.index.ntotal, self.index.nlist, self.index.nprobe, self.version
+        )
 
+    @timed("search.total")
     def search(self, query: str, top_k: int = 5):
         logger.info("Starting search for query: %s", query)
+        inc("searches")
+        return self._search_queries([query], top_k)[0]
 
-        query_vec = self.model.encode([query], convert_to_numpy=True)
+    @timed("search_many.total")
+    def search_many(self, queries: list, top_k: int = 5):
+        """
+        Batched variant of search(): encodes all queries at once and issues a single
+        FAISS search for the whole batch. Returns a list of (results, distances) tuples in
+        the same order as the queries.
+        """
+        if not queries:
+            return []
+        logger.info("Starting batched search for %d queries", len(queries))
+        inc("searches", len(queries))
+        return self._search_queries(list(queries), top_k)
 
-        cluster_model = load_cluster_model()
-        cluster_id = int(cluster_model.predict(query_vec)[0]) #predict() method is designed to handle batches of inputs
-        logger.info("Predicted cluster ID: %d", cluster_id)
+    def _search_queries(self, queries: list, top_k: int):
+        """
+        Incident Numbers are answered without the encoder. Queries made only of exact
+        tokens (error codes, hosts) return their token matches, scored by true distance
+        to the query; queries mixing such tokens with free text fuse the token matches
+        into the vector results.
+        """
+        outputs = [None] * len(queries)
+        lexical_hits = {}
+        lexical_only = set()
+        if config.LEXICAL_SEARCH and self.metadata.fts:
+            for i, query in enumerate(queries):
+                row_id = self._number_row_id(query)
+                if row_id is not None:
+                    inc("lexical_number_searches")
+                    outputs[i] = self._search_similar_to_row(row_id, top_k)
+                    continue
+                tokens = [t for t in tokenize(query) if _EXACT_TOKEN_RE.match(t)]
+                if not tokens:
+                    continue
+                with span("search.lexical"):
+                    hits = self.metadata.search_tokens(tokens, top_k, before=self.n_rows)
+                if hits:
+                    lexical_hits[i] = hits
+                    if len(tokens) == len(tokenize(query)):
+                        inc("lexical_only_searches")
+                        lexical_only.add(i)
 
-        cluster_index_path = os.path.join(config.CLUSTER_FAISS_DIR, f"cluster_{cluster_id}.faiss")
-        logger.info("Expected FAISS index path for this cluster: %s", cluster_index_path)
+        pending = [i for i, out in enumerate(outputs) if out is None]
+        if pending:
+            query_vecs = dict(zip(pending, self._encode_queries([queries[i] for i in pending])))
+            for i in lexical_only:
+                outputs[i] = self._rank_rows(query_vecs[i], lexical_hits[i])
+            vector_pending = [i for i in pending if i not in lexical_only]
+            if vector_pending:
+                vector_results = self._search_vectors(
+                    np.vstack([query_vecs[i] for i in vector_pending]), top_k,
+                    [lexical_hits.get(i) for i in vector_pending],
+                )
+                for i, result in zip(vector_pending, vector_results):
+                    outputs[i] = result
+        return outputs
 
-        if not os.path.exists(cluster_index_path):
-            logger.warning("No FAISS index found for cluster %d", cluster_id)
-            return pd.DataFrame(), []
+    def _rank_rows(self, query_vec: np.ndarray, row_ids: list):
+        """The given rows ordered by their true L2 distance to the query, like vector results."""
+        row_ids = [r for r in row_ids if r < len(self.embeddings)]
+        diff = np.asarray(self.embeddings[row_ids], dtype=np.float32) - query_vec
+        distances = (diff * diff).sum(axis=1)
+        order = np.argsort(distances, kind="stable")
+        row_ids = [row_ids[j] for j in order]
+        with span("search.fetch"):
+            return self._fetch(row_ids, [float(distances[j]) for j in order])
 
-        cluster_index = faiss.read_index(cluster_index_path)
-        logger.info("Loaded FAISS cluster index successfully (ntotal=%d)", cluster_index.ntotal)
+    def _number_row_id(self, query: str):
+        query = query.strip()
+        if not query or len(query.split()) != 1:
+            return None
+        candidates = [query, query.upper()]
+        found = self.metadata.get_row_ids(candidates, before=self.n_rows)
+        if not found:
+            # A collapsed near-duplicate is answered through its representative.
+            found = self.metadata.get_row_ids(
+                self.metadata.get_representatives(candidates).values(), before=self.n_rows
+            )
+            return next(iter(found.values()), None)
+        return found.get(query, found.get(query.upper()))
 
-        distances, indices = cluster_index.search(query_vec, top_k)
-        logger.info("Search results from cluster FAISS: indices=%s, distances=%s", indices, distances)
+    def _fetch(self, row_ids: list, distances: list):
+        """
+        Records for the row ids, with the Numbers of near-duplicates collapsed into each,
+        and the distances of the rows that were found.
+        """
+        results = self.metadata.fetch(row_ids, include_row_id=True)
+        if results.empty:
+            return results, []
+        by_row = dict(zip(row_ids, distances))
+        distances = [by_row[r] for r in results["row_id"]]
+        if self.cluster_ids is not None:
+            results["cluster_id"] = [
+                int(self.cluster_ids[r]) if r < len(self.cluster_ids) else None for r in results["row_id"]
+            ]
+        results = results.drop(columns="row_id")
+        members = self.metadata.get_duplicates(results["Number"])
+        results["duplicate_numbers"] = [members.get(n, []) for n in results["Number"]]
+        return results, distances
 
-        if "cluster_id" not in self.df.columns:
-            logger.error(
-                "'cluster_id' column missing in DataFrame! Columns present: %s",
-                list(self.df.columns)
-            )
-            raise KeyError("cluster_id")
+    def _search_similar_to_row(self, row_id: int, top_k: int):
+        """The incident itself first, then its neighbours, using its stored vector as the query."""
+        if row_id >= len(self.embeddings):
+            # Ingested after this retriever loaded; the next reload picks it up.
+            return self._fetch([row_id], [0.0])
+        query_vec = np.asarray(self.embeddings[[row_id]], dtype=np.float32)
+        return self._search_vectors(query_vec, top_k, [[row_id]])[0]
 
-        # Get records for that cluster
-        cluster_df = self.df[self.df["cluster_id"] == cluster_id].reset_index(drop=True)
-        logger.info(
-            "Filtered DataFrame for cluster %d: %d rows found",
-            cluster_id, len(cluster_df)
-        )
+    def _encode_queries(self, queries: list) -> np.ndarray:
+        # Repeated queries skip the transformer entirely; misses are encoded in one batch.
+        # Each distinct query is looked up once, so repeats within a batch are neither hits nor misses.
+        cache = get_query_cache()
+        model_key = f"{config.MODEL_NAME}:{config.EMBEDDING_BACKEND}"
+        vectors = {text: cache.get(model_key, text) for text in dict.fromkeys(normalize_query(q) for q in queries)}
+        missing = sorted(text for text, vec in vectors.items() if vec is None)
+
+        if missing:
+            with span("search.encode"):
+                encoded = dict(zip(missing, self.model.encode(missing, convert_to_numpy=True)))
+            for text, vec in encoded.items():
+                cache.put(model_key, text, vec)
+            vectors.update(encoded)
+
+        hits = len(vectors) - len(missing)
+        inc("query_cache_hits", hits)
+        inc("query_cache_misses", len(missing))
+        logger.info("Query embedding cache: %d/%d hits (%s)", hits, len(vectors), cache.stats())
+        return np.vstack([vectors[normalize_query(q)] for q in queries]).astype(np.float32)
+
+    def _search_vectors(self, query_vecs: np.ndarray, top_k: int, lexical_hits: list = None):
+        query_vecs = np.asarray(query_vecs, dtype=np.float32)
+
+        # The IVF quantizer routes each query to its nprobe nearest clusters, so there is
+        # no separate cluster prediction step and no global fallback.
+        k = top_k * config.RERANK_FACTOR if self.rerank else top_k
+        with span("search.faiss"):
+            distances, indices = self.index.search(query_vecs, k)
+        if self.rerank:
+            with span("search.rerank"):
+                distances, indices = self._rerank(query_vecs, indices, top_k)
+        logger.info("Search results from IVF index: indices=%s, distances=%s", indices, distances)
+
+        outputs = []
+        for row in range(len(query_vecs)):
+            # Collect valid results
+            valid = []
+            valid_distances = []
+            for idx_pos, idx in enumerate(indices[row]):
+                if idx >= 0:
+                    valid.append(int(idx))
+                    valid_distances.append(float(distances[row][idx_pos]))
+            if lexical_hits and lexical_hits[row]:
+                valid, valid_distances = self._fuse(query_vecs[row], valid, valid_distances, lexical_hits[row], top_k)
+            with span("search.fetch"):
+                outputs.append(self._fetch(valid, valid_distances))
+
+        logger.info("Final results retrieved for %d queries", len(outputs))
+        return outputs
+
+
+    def _fuse(self, query_vec: np.ndarray, vector_ids: list, vector_distances: list, lexical_ids: list, top_k: int):
+        """Reciprocal rank fusion of vector and token matches; distances stay true L2 distances."""
+        scores = {}
+        for ranked in (vector_ids, lexical_ids):
+            for rank, row_id in enumerate(ranked):
+                scores[row_id] = scores.get(row_id, 0.0) + 1.0 / (config.RRF_K + rank + 1)
+        fused = sorted(scores, key=lambda r: -scores[r])[:top_k]
+
+        known = dict(zip(vector_ids, vector_distances))
+        missing = [r for r in fused if r not in known and r < len(self.embeddings)]
+        if missing:
+            diff = np.asarray(self.embeddings[missing], dtype=np.float32) - query_vec
+            known.update(zip(missing, (diff * diff).sum(axis=1).tolist()))
+        fused = [r for r in fused if r in known]
+        return fused, [float(known[r]) for r in fused]
+
+    def _rerank(self, query_vecs: np.ndarray, indices: np.ndarray, top_k: int):
+        out_distances = np.full((len(query_vecs), top_k), np.inf, dtype=np.float32)
+        out_indices = np.full((len(query_vecs), top_k), -1, dtype=np.int64)
+        for row, candidates in enumerate(indices):
+            candidates = candidates[(candidates >= 0) & (candidates < len(self.embeddings))]
+            if len(candidates) == 0:
+                continue
+            diff = np.asarray(self.embeddings[candidates], dtype=np.float32) - query_vecs[row]
+            exact = (diff * diff).sum(axis=1)
+            order = np.argsort(exact)[:top_k]
+            out_distances[row, :len(order)] = exact[order]
+            out_indices[row, :len(order)] = candidates[order]
+        return out_distances, out_indices
+
+
+def get_retriever() -> IncidentRetriever:
+    """
+    Returns the process-wide retriever, rebuilding it when the index version changes.
+    The new retriever is loaded outside _retriever_lock and swapped in when ready, so
+    searches keep using the old one, a consistent generation, during the reload.
+    """
+    global _retriever, _last_version_check
+    with _retriever_lock:
+        current = _retriever
+        now = time.monotonic()
+        if current is not None and now - _last_version_check < config.RELOAD_CHECK_INTERVAL:
+            return current
+        _last_version_check = now
 
-        if cluster_df.empty:
-            logger.warning("No incidents found for cluster %d in data file.", cluster_id)
-            return pd.DataFrame(), []
-
-        # Collect valid results
-        valid = []
-        valid_distances = []
-        for idx_pos, idx in enumerate(indices[0]):
-            if 0 <= idx < len(cluster_df):
-                valid.append(idx)
-                valid_distances.append(float(distances[0][idx_pos]))
-
-        # if cluster too small, use global search ??
-        if len(valid) < top_k:
-            logger.info("Cluster too small; falling back to global search.")
-            global_distances, global_indices = self.index.search(query_vec, top_k)
-            valid = [int(i) for i in global_indices[0] if 0 <= i < len(self.df)]
-            valid_distances = [float(d) for d in global_distances[0]]
-
-            results = self.df.iloc[valid].reset_index(drop=True)
-            logger.info("Global search returned %d results", len(results))
-            return results, valid_distances
-
-        results = cluster_df.iloc[valid].reset_index(drop=True)
-        logger.info("Final results retrieved: %d records", len(results))
-        return results, valid_distances
+    if current is not None and current.version == current_index_version():
+        return current
+    # One loader at a time. While it runs, other callers keep the current retriever;
+    # only a cold start waits for it.
+    if not _reload_lock.acquire(blocking=current is None):
+        return current
+    try:
+        with _retriever_lock:
+            if _retriever is not current:
+                return _retriever
+        logger.info("Loading retriever for index version %s", current_index_version())
+        loaded = IncidentRetriever()
+        inc("retriever_reloads")
+        with _retriever_lock:
+            _retriever = loaded
+        return loaded
+    finally:
+        _reload_lock.release()
@@ -0,0 +1,207 @@
+import json
+import requests
+import pandas as pd
+from typing import Iterator, Optional, Tuple
+from utils.logger import get_logger
+from utils.config import config
+from utils.metrics import span
+from retriever import get_retriever
+from batcher import get_batcher
+from http_client import (
+    get_cached_summarized_output,
+    stream_summarized_output,
+    iter_sse,
+    DEFAULT_ENDPOINT,
+    DEFAULT_SUMMARIZATION_AGENT_ID,
+)
+
+logger = get_logger("search_pipeline")
+
+MIN_CONFIDENCE = 40.0  # percent
+
+
+def confident_results(results: pd.DataFrame, distances: list, min_confidence: float = MIN_CONFIDENCE) -> pd.DataFrame:
+    """Adds a confidence column (1 / (1 + L2 distance), in percent) and drops rows below min_confidence."""
+    if results.empty:
+        return results
+    with span("search.filter"):
+        results = results.copy()
+        results["confidence"] = [(1 / (1 + dist)) * 100 for dist in distances]
+        return results[results["confidence"] >= min_confidence].reset_index(drop=True)
+
+
+def search(query: str, top_k: int = 5):
+    """IncidentRetriever.search(), coalesced with concurrent callers when SEARCH_BATCHING is on."""
+    if config.SEARCH_BATCHING:
+        return get_batcher().search(query, top_k)
+    return get_retriever().search(query, top_k)
+
+
+def search_incidents(query: str, top_k: int = 5, min_confidence: float = MIN_CONFIDENCE) -> pd.DataFrame:
+    results, distances = search(query, top_k)
+    return confident_results(results, distances, min_confidence)
+
+
+def summarize_results(
+    results: pd.DataFrame,
+    ai_agent_id: str = DEFAULT_SUMMARIZATION_AGENT_ID,
+    endpoint: str = DEFAULT_ENDPOINT,
+) -> dict:
+    """Returns the agent_response of the summarization agent, or {} when it gave none."""
+    if results.empty:
+        return {}
+    summary = get_cached_summarized_output(
+        results.to_dict(orient="records"),
+        ai_agent_id=ai_agent_id,
+        configuration_environment="DEV",
+        endpoint=endpoint,
+    )
+    return summary.get("data", {}).get("responses", {}).get("agent_response", {}) or {}
+
+
+def search_with_summary(query: str, top_k: int = 5, min_confidence: float = MIN_CONFIDENCE) -> Tuple[pd.DataFrame, dict]:
+    results = search_incidents(query, top_k, min_confidence)
+    return results, summarize_results(results)
+
+
+def remote_search_with_summary(
+    service_url: str,
+    query: str,
+    top_k: int = 5,
+    min_confidence: float = MIN_CONFIDENCE,
+    timeout: Optional[int] = 120,
+) -> Tuple[pd.DataFrame, dict]:
+    """Same as search_with_summary(), served by a running search service (see service.py)."""
+    resp = requests.post(
+        service_url.rstrip("/") + "/search_summary",
+        json={"query": query, "top_k": top_k, "min_confidence": min_confidence},
+        timeout=timeout,
+    )
+    resp.raise_for_status()
+    payload = resp.json()
+    logger.info("Search service returned %d results (index version %s)",
+                len(payload["results"]), payload.get("index_version"))
+    return pd.DataFrame(payload["results"]), payload.get("summary") or {}
+
+
+def _close_json(text: str) -> str:
+    """Appends the quote and brackets that an unfinished JSON document is missing."""
+    closers, in_string, escaped = [], False, False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]" and closers:
+            closers.pop()
+    if escaped:
+        text = text[:-1]
+    return text + ('"' if in_string else "") + "".join(reversed(closers))
+
+
+def parse_partial_summary(text: str) -> Optional[dict]:
+    """
+    Best-effort parse of a summary that is still streaming in. Unfinished JSON is closed
+    off, dropping a trailing element that cannot be completed; prose is returned as the
+    overview. Returns None when nothing usable has arrived yet.
+    """
+    stripped = text.strip()
+    if not stripped:
+        return None
+    if not stripped.startswith("{"):
+        return {"overview": text}
+    candidate = stripped
+    while candidate:
+        try:
+            parsed = json.loads(_close_json(candidate))
+        except ValueError:
+            cut = candidate.rfind(",")
+            if cut < 0:
+                return None
+            candidate = candidate[:cut]
+            continue
+        if isinstance(parsed, dict) and isinstance(parsed.get("agent_response"), dict):
+            parsed = parsed["agent_response"]
+        return parsed if isinstance(parsed, dict) else None
+    return None
+
+
+def stream_summary(
+    results: pd.DataFrame,
+    ai_agent_id: str = DEFAULT_SUMMARIZATION_AGENT_ID,
+    endpoint: str = DEFAULT_ENDPOINT,
+) -> Iterator[dict]:
+    """
+    Streaming variant of summarize_results(): yields the agent_response as it grows,
+    the last one complete. Falls back to the blocking request if the stream fails
+    before anything arrived.
+    """
+    if results.empty:
+        return
+    text, last = "", None
+    try:
+        for chunk in stream_summarized_output(
+            results.to_dict(orient="records"),
+            ai_agent_id=ai_agent_id,
+            configuration_environment="DEV",
+            endpoint=endpoint,
+        ):
+            text += chunk
+            partial = parse_partial_summary(text)
+            if partial and partial != last:
+                last = partial
+                yield partial
+    except Exception as e:
+        if last is not None:
+            raise
+        logger.warning("Streaming summarization failed (%s); falling back to a blocking request.", e)
+        summary = summarize_results(results, ai_agent_id, endpoint)
+        if summary:
+            yield summary
+
+
+def stream_search_with_summary(
+    query: str,
+    top_k: int = 5,
+    min_confidence: float = MIN_CONFIDENCE,
+    ai_agent_id: str = DEFAULT_SUMMARIZATION_AGENT_ID,
+    endpoint: str = DEFAULT_ENDPOINT,
+) -> Iterator[Tuple[str, object]]:
+    """Yields ("results", DataFrame) as soon as retrieval finishes, then ("summary", dict) as the summary grows."""
+    results = search_incidents(query, top_k, min_confidence)
+    yield "results", results
+    for summary in stream_summary(results, ai_agent_id, endpoint):
+        yield "summary", summary
+
+
+def remote_stream_search_with_summary(
+    service_url: str,
+    query: str,
+    top_k: int = 5,
+    min_confidence: float = MIN_CONFIDENCE,
+    timeout: Optional[int] = 120,
+) -> Iterator[Tuple[str, object]]:
+    """Same as stream_search_with_summary(), served by a running search service (see service.py)."""
+    with requests.post(
+        service_url.rstrip("/") + "/search_summary/stream",
+        json={"query": query, "top_k": top_k, "min_confidence": min_confidence},
+        headers={"Accept": "text/event-stream"},
+        timeout=timeout,
+        stream=True,
+    ) as resp:
+        resp.raise_for_status()
+        for event, data in iter_sse(resp):
+            payload = json.loads(data)
+            if event == "results":
+                logger.info("Search service returned %d results (index version %s)",
+                            len(payload["results"]), payload.get("index_version"))
+                yield "results", pd.DataFrame(payload["results"])
+            elif event == "summary":
+                yield "summary", payload
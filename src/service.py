@@ -0,0 +1,168 @@
+"""
+Headless HTTP service for search, search-with-summary and ingest.
+
+    python service.py --workers 4 --port 8000
+
+Each worker process loads the model and index once at startup and picks up new
+index versions the same way the Streamlit app does. Handlers are plain functions,
+so requests within a worker run concurrently on the server's thread pool.
+"""
+import json
+import argparse
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from utils.logger import get_logger
+from utils.config import config
+from utils.metrics import get_registry, inc
+from retriever import get_retriever, current_index_version
+from faiss_updater import update_faiss_with_new_data
+from batcher import get_batcher
+from search_pipeline import (
+    MIN_CONFIDENCE,
+    search as batched_search,
+    confident_results,
+    summarize_results,
+    stream_summary,
+)
+
+logger = get_logger("service")
+
+
+class SearchRequest(BaseModel):
+    query: str = Field(min_length=1)
+    top_k: int = Field(default=5, ge=1, le=100)
+    min_confidence: float = MIN_CONFIDENCE
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str] = Field(min_length=1)
+    top_k: int = Field(default=5, ge=1, le=100)
+    min_confidence: float = MIN_CONFIDENCE
+
+
+class IngestRequest(BaseModel):
+    # Enriched incidents, as written by enrich_to_ndjson.
+    records: List[dict] = Field(min_length=1)
+    incremental: Optional[bool] = None
+
+
+def _records(results) -> list:
+    # Round-trip through pandas' JSON writer so NaN and numpy scalars serialize cleanly.
+    return json.loads(results.to_json(orient="records")) if not results.empty else []
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        retriever = get_retriever()
+        logger.info("Search service ready: %d vectors (version %s)", retriever.index.ntotal, retriever.version)
+    except FileNotFoundError as e:
+        # An empty deployment can still accept its first ingest.
+        logger.warning("Starting without an index: %s", e)
+    yield
+
+
+app = FastAPI(title="Incident Resolution Assistant", lifespan=lifespan)
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "index_version": current_index_version(), "batcher": get_batcher().stats()}
+
+
+@app.post("/search")
+def search(req: SearchRequest):
+    retriever = _retriever_or_503()
+    results, distances = batched_search(req.query, req.top_k)
+    results = confident_results(results, distances, req.min_confidence)
+    return {"results": _records(results), "index_version": retriever.version}
+
+
+@app.post("/search/batch")
+def search_batch(req: BatchSearchRequest):
+    retriever = _retriever_or_503()
+    outputs = retriever.search_many(req.queries, req.top_k)
+    return {
+        "results": [_records(confident_results(r, d, req.min_confidence)) for r, d in outputs],
+        "index_version": retriever.version,
+    }
+
+
+@app.post("/search_summary")
+def search_summary(req: SearchRequest):
+    retriever = _retriever_or_503()
+    results, distances = batched_search(req.query, req.top_k)
+    results = confident_results(results, distances, req.min_confidence)
+    try:
+        summary = summarize_results(results)
+    except Exception as e:
+        # Retrieval results are still useful when the summarization agent is down.
+        inc("service_summary_errors")
+        logger.exception("Summarization failed: %s", e)
+        summary = None
+    return {"results": _records(results), "summary": summary, "index_version": retriever.version}
+
+
+def _sse(event: str, payload) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+@app.post("/search_summary/stream")
+def search_summary_stream(req: SearchRequest):
+    """
+    Server-sent events: one "results" event as soon as retrieval finishes, "summary"
+    events carrying the summary as it grows, then "done".
+    """
+    retriever = _retriever_or_503()
+    results, distances = batched_search(req.query, req.top_k)
+    results = confident_results(results, distances, req.min_confidence)
+
+    def events():
+        yield _sse("results", {"results": _records(results), "index_version": retriever.version})
+        try:
+            for summary in stream_summary(results):
+                yield _sse("summary", summary)
+        except Exception as e:
+            inc("service_summary_errors")
+            logger.exception("Summarization failed: %s", e)
+        yield _sse("done", {})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.post("/ingest")
+def ingest(req: IngestRequest):
+    # update_faiss_with_new_data holds the index lock, so concurrent ingests across
+    # workers queue up instead of interleaving writes.
+    new_count, total_count = update_faiss_with_new_data(req.records, incremental=req.incremental)
+    return {"new": new_count, "total": total_count, "index_version": current_index_version()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return get_registry().render_prometheus()
+
+
+def _retriever_or_503():
+    try:
+        return get_retriever()
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+def main(argv=None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the incident search service.")
+    parser.add_argument("--host", default=config.SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVICE_PORT)
+    parser.add_argument("--workers", type=int, default=config.SERVICE_WORKERS)
+    args = parser.parse_args(argv)
+    uvicorn.run("service:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
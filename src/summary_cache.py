@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Iterable, Optional, Dict
+from utils.logger import get_logger
+from utils.config import config
+
+logger = get_logger("summary_cache")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS summaries (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_summaries_accessed ON summaries(accessed_at);
+CREATE TABLE IF NOT EXISTS summary_members (
+    key TEXT NOT NULL,
+    number TEXT NOT NULL,
+    PRIMARY KEY (key, number)
+);
+CREATE INDEX IF NOT EXISTS idx_summary_members_number ON summary_members(number);
+"""
+
+
+def summary_key(numbers: Iterable[str], ai_agent_id: str) -> str:
+    """Canonical key: the same set of incidents summarized by the same agent, in any order."""
+    canonical = json.dumps({"agent": ai_agent_id, "numbers": sorted(set(numbers))}, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    """
+    Disk-backed cache of summarization responses with TTL expiry and LRU eviction
+    bounded by entry count and total size. Entries are tracked per incident Number
+    so an update to any member invalidates the summaries that cite it.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or config.SUMMARY_CACHE_FILE
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def get(self, numbers: Iterable[str], ai_agent_id: str) -> Optional[Dict]:
+        key = summary_key(numbers, ai_agent_id)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM summaries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > config.SUMMARY_CACHE_TTL:
+                self._delete_keys([key])
+                return None
+            self._conn.execute("UPDATE summaries SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, numbers: Iterable[str], ai_agent_id: str, response: Dict):
+        numbers = sorted(set(numbers))
+        key = summary_key(numbers, ai_agent_id)
+        payload = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now),
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO summary_members (key, number) VALUES (?, ?)",
+                [(key, n) for n in numbers],
+            )
+            self._evict(now)
+
+    def invalidate_numbers(self, numbers: Iterable[str]) -> int:
+        numbers = list(set(numbers))
+        keys = set()
+        with self._lock, self._conn:
+            for i in range(0, len(numbers), 500):
+                chunk = numbers[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                keys.update(r[0] for r in self._conn.execute(
+                    f"SELECT DISTINCT key FROM summary_members WHERE number IN ({placeholders})", chunk
+                ))
+            self._delete_keys(list(keys))
+        if keys:
+            logger.info("Invalidated %d cached summaries for %d updated incidents", len(keys), len(numbers))
+        return len(keys)
+
+    def _delete_keys(self, keys: list):
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            self._conn.execute(f"DELETE FROM summaries WHERE key IN ({placeholders})", chunk)
+            self._conn.execute(f"DELETE FROM summary_members WHERE key IN ({placeholders})", chunk)
+
+    def _evict(self, now: float):
+        expired = [r[0] for r in self._conn.execute(
+            "SELECT key FROM summaries WHERE created_at < ?", (now - config.SUMMARY_CACHE_TTL,)
+        )]
+        self._delete_keys(expired)
+
+        count, total_size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM summaries").fetchone()
+        if count <= config.SUMMARY_CACHE_MAX_ENTRIES and total_size <= config.SUMMARY_CACHE_MAX_BYTES:
+            return
+
+        # Drop least recently used entries until both limits hold.
+        evicted = []
+        for key, size in self._conn.execute("SELECT key, size FROM summaries ORDER BY accessed_at"):
+            if count <= config.SUMMARY_CACHE_MAX_ENTRIES and total_size <= config.SUMMARY_CACHE_MAX_BYTES:
+                break
+            evicted.append(key)
+            count -= 1
+            total_size -= size
+        self._delete_keys(evicted)
+        logger.info("Evicted %d cached summaries (LRU)", len(evicted))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_summary_cache() -> SummaryCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SummaryCache()
+        return _cache
@@ -3,21 +3,118 @@ import os
 class config:
     # === file paths ===
     DATA_DIR = "data"
-    DATA_FILE = os.path.join("data", "cleaned_incidents.json")
-    CLUSTER_MODEL_FILE = os.path.join("data", "cluster_model.pkl")
-    CLUSTER_ASSIGNMENTS_FILE = os.path.join("data", "clustered_incidents.json")
-    CLUSTER_FAISS_DIR = os.path.join("data", "clusters")
-    INDEX_FILE = os.path.join("data", "embeddings.faiss")
-    EMBEDDINGS_FILE = os.path.join("data", "embeddings.npy")
+    DATA_FILE = os.path.join("data", "cleaned_incidents.json")  # legacy, imported on first use
+    METADATA_DB_FILE = os.path.join("data", "incidents.sqlite")
+    CLUSTER_MODEL_FILE = os.path.join("data", "cluster_model.pkl")  # pre-generation layout, moved on first rebuild
+    CLUSTER_ASSIGNMENTS_FILE = os.path.join("data", "clustered_incidents.json")  # legacy, imported on first use
+    CLUSTER_FAISS_DIR = os.path.join("data", "clusters")  # legacy per-cluster indexes
+    IVF_INDEX_FILE = os.path.join("data", "clusters.ivf.faiss")  # pre-generation layout, moved on first rebuild
+    CLUSTER_STATS_FILE = os.path.join("data", "cluster_stats.json")  # pre-generation layout, moved on first rebuild
+    GENERATIONS_DIR = os.path.join("data", "generations")
+    CURRENT_GENERATION_FILE = os.path.join("data", "CURRENT")
+    INDEX_FILE = os.path.join("data", "embeddings.faiss")  # legacy global index, removed on next update
+    EMBEDDINGS_FILE = os.path.join("data", "embeddings.npy")  # legacy, migrated on first use
+    EMBEDDINGS_STORE_FILE = os.path.join("data", "embeddings.f32")
     TEMP_JSON = os.path.join("data", "temp_incidents.json")
+    TEMP_NDJSON = os.path.join("data", "temp_incidents.ndjson")
+    PROCESSED_NDJSON = os.path.join("data", "incidents_from_api.ndjson")
     LOG_FILE = os.path.join("data", "process.log")
+    SUMMARY_CACHE_FILE = os.path.join("data", "summary_cache.sqlite")
+    ENRICHMENT_CACHE_FILE = os.path.join("data", "enrichment_cache.sqlite")
+    QUERY_CACHE_FILE = os.path.join("data", "query_cache.npz")
+    INDEX_VERSION_FILE = os.path.join("data", "index.version")  # legacy, replaced by CURRENT
+    INDEX_LOCK_FILE = os.path.join("data", "index.lock")
+    METRICS_FILE = os.path.join("data", "metrics.prom")
+    JOBS_DB_FILE = os.path.join("data", "jobs.sqlite")
+    JOBS_DIR = os.path.join("data", "jobs")
+    JOB_WORKER_LOCK_FILE = os.path.join("data", "jobs.worker.lock")
 
     # === clustering parameters ===
     BATCH_SIZE = 1000
     MAX_CLUSTERS = 200
     MIN_CLUSTERS = 10
+    NPROBE = 4  # number of nearest clusters probed per query
+    KEEP_GENERATIONS = 3  # published index generations kept on disk
+
+    # === index compression ===
+    INDEX_TYPE = "flat"  # "flat", "sq8" (8-bit scalar quantizer) or "pq" (product quantizer)
+    PQ_M = 16  # sub-quantizers; must divide the embedding dim
+    PQ_NBITS = 8
+    INDEX_TRAIN_SAMPLE = 50000  # vectors used to train SQ/PQ codebooks
+    RERANK = True  # re-rank compressed-index candidates with exact distances
+    RERANK_FACTOR = 4  # candidates fetched per requested result
+
+    # === incremental clustering ===
+    INCREMENTAL_CLUSTERING = True
+    DRIFT_THRESHOLD = 1.5  # mean squared distance of added vectors vs. the last full fit
+    IMBALANCE_THRESHOLD = 2.0  # largest/mean cluster size vs. the last full fit
+    MAX_INCREMENTAL_GROWTH = 1.5  # corpus growth since the last full fit
 
     # === other parameters ===
     MODEL_NAME = "all-MiniLM-L6-v2"
+    EMBEDDING_BACKEND = "torch"  # "torch", "onnx" or "int8"
+    PARITY_MIN_COSINE = 0.99  # minimum per-text cosine vs. reference embeddings
+
+    # === ingestion parameters ===
+    INGEST_CHUNK_SIZE = 5000  # CSV rows parsed per chunk
+    EMBED_CHUNK_SIZE = 1024  # records embedded and stored per chunk
+    ENCODE_WORKERS = 0  # encoder processes for ingest; > 1 enables parallel encoding for large backfills
+    ENCODE_SHARD_SIZE = 256  # texts per task sent to an encoder process (length-sorted)
+    PARALLEL_EMBED_CHUNK_SIZE = 16384  # records per streamed chunk when encoding in parallel
+
+    # === near-duplicate collapsing ===
+    DEDUP_ENABLED = True  # enrich and index one representative per group of near-duplicate rows
+    DEDUP_MAX_DISTANCE = 0.06  # squared L2 on raw-text embeddings; ~0.97 cosine for normalized vectors
+    DEDUP_BACKEND = None  # embedding backend for the raw-text pass; None uses EMBEDDING_BACKEND
+    DEDUP_INDEX_FILE = os.path.join("data", "dedup.faiss")  # raw-text vectors of indexed incidents, by row id
+
+    # === enrichment parameters ===
+    ENRICH_BATCH_SIZE = 50  # max records per request; ENRICH_BATCH_TOKENS usually closes a batch first
+    ENRICH_BATCH_TOKENS = 6000  # approximate input tokens per request (~4 bytes of JSON per token)
+    ENRICH_RECORD_MAX_TOKENS = 2000  # longer records have their longest fields cut to head and tail
+    ENRICH_MISSING_RETRIES = 3  # rounds of re-sending Numbers missing from a response, halving the batch
+    ENRICH_GZIP = False  # gzip request bodies; enable only for endpoints that accept Content-Encoding: gzip
+    ENRICH_MAX_WORKERS = 4  # concurrent in-flight requests
+    ENRICH_RATE_PER_SEC = 1.0  # sustained request rate (token bucket)
+    ENRICH_BURST = 4  # token bucket capacity
+    HTTP_MAX_RETRIES = 4  # retries on 429/5xx and connection errors
+    HTTP_BACKOFF_BASE = 1.0  # seconds, doubled on each retry
+    HTTP_BACKOFF_MAX = 30.0
+
+    # === enrichment cache ===
+    ENRICHMENT_CACHE_ENABLED = True  # skip the agent for records enriched before with the same content
+    ENRICHMENT_CACHE_TTL = 180 * 24 * 3600  # seconds; applied by `python enrichment_cache.py compact`
+    ENRICHMENT_CACHE_MAX_ENTRIES = 1000000
+    ENRICHMENT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+    # === background ingest jobs ===
+    BACKGROUND_INGEST = True  # uploads are queued for the worker in jobs.py instead of run in the UI
+    JOB_POLL_INTERVAL = 2  # seconds between queue checks in an idle worker
+
+    # === summary cache ===
+    SUMMARY_CACHE_ENABLED = True
+    SUMMARY_CACHE_TTL = 24 * 3600  # seconds
+    SUMMARY_CACHE_MAX_ENTRIES = 2000
+    SUMMARY_CACHE_MAX_BYTES = 50 * 1024 * 1024
+    SUMMARY_STREAMING = True  # show retrieved incidents first and stream the summary in as it is generated
+
+    # === retriever parameters ===
+    RELOAD_CHECK_INTERVAL = 5  # seconds between index version checks
+    QUERY_CACHE_SIZE = 10000  # cached query embeddings
+    QUERY_CACHE_PERSIST = True  # reload the query cache across restarts
+    LEXICAL_SEARCH = True  # answer incident Numbers and exact-token queries from the token index
+    RRF_K = 60  # reciprocal rank fusion constant for mixing token and vector matches
+    SEARCH_BATCHING = True  # coalesce concurrent searches into one encode + FAISS call
+    BATCH_WINDOW_MS = 5  # how long to wait for more queries when other searches are in flight
+    BATCH_MAX_SIZE = 32
 
+    # === search service ===
+    SEARCH_SERVICE_URL = None  # e.g. "http://127.0.0.1:8000"; the UI searches through it when set
+    SERVICE_HOST = "127.0.0.1"
+    SERVICE_PORT = 8000
+    SERVICE_WORKERS = 2  # processes, each holding its own model and index
 
+    # === metrics ===
+    METRICS_ENABLED = True
+    METRICS_PORT = 0  # serve /metrics on this local port; 0 disables the endpoint
+    METRICS_DEBUG_PANEL = False  # show per-stage timings in the Streamlit UI
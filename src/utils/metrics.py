@@ -0,0 +1,187 @@
+"""
+Lightweight in-process timers and counters, exported in Prometheus text format.
+
+    with span("search.encode"):
+        vectors = model.encode(texts)
+    inc("query_cache_hits", hits)
+
+Durations go into one histogram labelled by stage and events into one counter
+labelled by name, so new stages need no registration. Metrics are per process.
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from utils.config import config
+
+# Seconds; covers sub-millisecond FAISS probes up to full reclusters.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+PREFIX = "ira"
+
+
+class _Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            hist = self._histograms.get(stage)
+            if hist is None:
+                hist = self._histograms[stage] = _Histogram()
+            hist.observe(seconds)
+
+    def inc(self, event: str, value: float = 1):
+        with self._lock:
+            self._counters[event] = self._counters.get(event, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self) -> dict:
+        """Plain-dict view for the debug panel: per-stage timings in ms and counter values."""
+        with self._lock:
+            stages = [
+                {
+                    "stage": stage,
+                    "count": hist.count,
+                    "mean_ms": hist.sum / hist.count * 1000.0 if hist.count else 0.0,
+                    "max_ms": hist.max * 1000.0,
+                    "last_ms": hist.last * 1000.0,
+                    "total_s": hist.sum,
+                }
+                for stage, hist in sorted(self._histograms.items())
+            ]
+            return {"stages": stages, "counters": dict(sorted(self._counters.items()))}
+
+    def render_prometheus(self) -> str:
+        lines = [
+            f"# HELP {PREFIX}_stage_duration_seconds Time spent per pipeline stage.",
+            f"# TYPE {PREFIX}_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage, hist in sorted(self._histograms.items()):
+                label = _escape(stage)
+                cumulative = 0
+                for bound, n in zip(BUCKETS, hist.bucket_counts):
+                    cumulative += n
+                    lines.append(f'{PREFIX}_stage_duration_seconds_bucket{{stage="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'{PREFIX}_stage_duration_seconds_bucket{{stage="{label}",le="+Inf"}} {hist.count}')
+                lines.append(f'{PREFIX}_stage_duration_seconds_sum{{stage="{label}"}} {hist.sum}')
+                lines.append(f'{PREFIX}_stage_duration_seconds_count{{stage="{label}"}} {hist.count}')
+
+            lines.append(f"# HELP {PREFIX}_events_total Counted events such as cache hits and remote errors.")
+            lines.append(f"# TYPE {PREFIX}_events_total counter")
+            for event, value in sorted(self._counters.items()):
+                lines.append(f'{PREFIX}_events_total{{event="{_escape(event)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry() -> MetricsRegistry:
+    return _registry
+
+
+@contextmanager
+def span(stage: str):
+    """Times the enclosed block into the stage histogram; exceptions are timed too."""
+    if not config.METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registry.observe(stage, time.perf_counter() - start)
+
+
+def timed(stage: str):
+    """Decorator form of span()."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inc(event: str, value: float = 1):
+    if config.METRICS_ENABLED and value:
+        _registry.inc(event, value)
+
+
+def write_metrics_file(path: str = None):
+    """Writes the Prometheus text atomically, e.g. for node_exporter's textfile collector."""
+    path = path or config.METRICS_FILE
+    if not (config.METRICS_ENABLED and path):
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(_registry.render_prometheus())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = _registry.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int = None, host: str = "127.0.0.1"):
+    """Serves GET /metrics on a daemon thread; a no-op when already running or port is 0."""
+    global _server
+    port = config.METRICS_PORT if port is None else port
+    with _server_lock:
+        if _server is not None or not port:
+            return _server
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
@@ -0,0 +1,69 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def summary_cache(tmp_path, monkeypatch):
+    """A fresh on-disk summary cache in place of the process-wide one."""
+    import summary_cache as module
+    cache = module.SummaryCache(str(tmp_path / "summary_cache.sqlite"))
+    monkeypatch.setattr(module, "_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def fast_http(monkeypatch):
+    """Millisecond backoff and no enrichment cache, so retries run against the stub quickly."""
+    from utils.config import config
+    monkeypatch.setattr(config, "HTTP_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(config, "HTTP_BACKOFF_MAX", 0.05)
+    monkeypatch.setattr(config, "ENRICHMENT_CACHE_ENABLED", False)
+    return config
+
+
+class HashingEncoder:
+    """Deterministic bag-of-words vectors, so indexing tests need no transformer model."""
+
+    dim = 64
+
+    def encode(self, texts, convert_to_numpy=True, show_progress_bar=False, **kwargs):
+        import zlib
+        import numpy as np
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in str(text).lower().split():
+                out[i, zlib.crc32(word.encode()) % self.dim] += 1.0
+            out[i] /= np.linalg.norm(out[i]) or 1.0
+        return out
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch, summary_cache):
+    """
+    Runs the test from an empty working directory, so the relative data/ paths land in
+    tmp_path. The query cache is a fresh in-memory one, never saved at exit.
+    """
+    import query_cache
+    from utils.config import config
+    monkeypatch.setattr(query_cache, "_cache", query_cache.QueryEmbeddingCache(config.QUERY_CACHE_SIZE))
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+    return tmp_path / "data"
+
+
+@pytest.fixture
+def fake_encoder(monkeypatch):
+    """HashingEncoder in place of the sentence transformer for ingest and search."""
+    pytest.importorskip("sentence_transformers")
+    pytest.importorskip("faiss")
+    import embedder
+    encoder = HashingEncoder()
+    monkeypatch.setattr(embedder, "get_encoder", lambda *args, **kwargs: encoder)
+    for module in ("faiss_updater", "retriever", "dedup"):
+        monkeypatch.setattr(__import__(module), "get_encoder", lambda *args, **kwargs: encoder)
+    return encoder
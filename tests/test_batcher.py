@@ -0,0 +1,42 @@
+import threading
+import pandas as pd
+import pytest
+
+pytest.importorskip("sentence_transformers")
+
+
+class RecordingRetriever:
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def search_many(self, queries, top_k):
+        with self.lock:
+            self.calls.append((list(queries), top_k))
+        return [(pd.DataFrame({"Number": [f"{q}#{i}" for i in range(top_k)]}), [float(top_k)] * top_k)
+                for q in queries]
+
+
+def test_each_top_k_is_searched_on_its_own():
+    from batcher import QueryBatcher
+
+    fake = RecordingRetriever()
+    batcher = QueryBatcher(window_ms=200, max_batch=8, retriever_getter=lambda: fake)
+    requests = [(f"q{i}", 3 if i % 2 else 5) for i in range(8)]
+    results = {}
+
+    def call(query, top_k):
+        results[query] = batcher.search(query, top_k)
+
+    threads = [threading.Thread(target=call, args=r) for r in requests]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for query, top_k in requests:
+        found, distances = results[query]
+        assert list(found["Number"]) == [f"{query}#{i}" for i in range(top_k)]
+        assert distances == [float(top_k)] * top_k
+    for queries, top_k in fake.calls:
+        assert all(dict(requests)[q] == top_k for q in queries)
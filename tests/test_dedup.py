@@ -0,0 +1,27 @@
+def _raw(number, text):
+    return {"Number": number, "Short description": text, "Description": "", "Resolution notes": "cleared"}
+
+
+def _enriched(record):
+    # The indexed text is the agent's rewrite, far from the raw text in embedding space.
+    return dict(record, **{"Incident description": f"summary of {record['Number']} written by the agent"})
+
+
+def test_repeated_raw_row_collapses_onto_indexed_incident(data_dir, fake_encoder):
+    from dedup import iter_collapsed, save_duplicates
+    from faiss_updater import update_faiss_with_new_data
+    from metadata_store import open_metadata_store
+
+    first = [_raw(f"INC{i:05d}", f"mailbox {i} over quota on exchange") for i in range(20)]
+    duplicates = []
+    representatives = list(iter_collapsed(first, {}, duplicates))
+    update_faiss_with_new_data([_enriched(rec) for rec in representatives])
+    save_duplicates(duplicates)
+
+    stats, duplicates = {}, []
+    repeat = _raw("INC00100", "mailbox 7 over quota on exchange")
+    assert list(iter_collapsed([repeat], stats, duplicates)) == []
+    assert stats["duplicates_of_indexed"] == 1
+
+    save_duplicates(duplicates)
+    assert open_metadata_store().get_representatives(["INC00100"]) == {"INC00100": "INC00007"}
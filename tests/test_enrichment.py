@@ -0,0 +1,67 @@
+import time
+from benchmarks.stub_server import run_stub_server
+from enrichment import TokenBucket, _enrich_batch, count_batches, enrich_batches, enrich_records, pack_batches
+
+
+def _records(n):
+    return [{"Number": f"INC{i:07d}", "Short description": f"issue {i}"} for i in range(n)]
+
+
+def test_failed_missing_retry_keeps_enriched_incidents(fast_http, monkeypatch):
+    monkeypatch.setattr(fast_http, "HTTP_MAX_RETRIES", 0)
+    # The first response is cut to 2 incidents; every retry fails.
+    with run_stub_server(max_incidents=2, fail_requests=range(2, 100)) as (url, server):
+        incidents = _enrich_batch(_records(6), TokenBucket(1000, 1000), "stub-enricher", url)
+    assert [i["Number"] for i in incidents] == ["INC0000000", "INC0000001"]
+    assert server.requests > 1
+
+
+def test_token_bucket_throttles_after_burst():
+    bucket = TokenBucket(rate=20, capacity=2)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # Two requests go out in the burst, the other four at 20 per second.
+    assert time.monotonic() - start >= 4 / 20 * 0.9
+
+
+def test_enrich_batches_respects_rate_limit(fast_http, monkeypatch):
+    monkeypatch.setattr(fast_http, "ENRICH_RATE_PER_SEC", 20)
+    monkeypatch.setattr(fast_http, "ENRICH_BURST", 2)
+    batches = [_records(3) for _ in range(6)]
+    with run_stub_server() as (url, server):
+        start = time.monotonic()
+        results = list(enrich_batches(batches, "stub-enricher", url, max_workers=6))
+        elapsed = time.monotonic() - start
+    assert server.requests == 6
+    assert all(incidents for _, incidents, _ in results)
+    assert elapsed >= 4 / 20 * 0.9
+
+
+def test_missing_numbers_are_retried(fast_http):
+    records = _records(6)
+    with run_stub_server(max_incidents=2) as (url, server):
+        incidents = _enrich_batch(records, TokenBucket(1000, 1000), "stub-enricher", url)
+    assert sorted(i["Number"] for i in incidents) == [r["Number"] for r in records]
+    assert server.requests > 1
+
+
+def test_enrich_records_survives_transient_errors(fast_http):
+    records = _records(10)
+    with run_stub_server(fail_requests={1, 3}, fail_status=503) as (url, _):
+        incidents, stats = enrich_records(records, "stub-enricher", url, batch_size=5, max_workers=2)
+    assert [i["Number"] for i in incidents] == [r["Number"] for r in records]
+    assert stats["succeeded"] == 2 and stats["failed"] == 0
+
+
+def test_counting_batches_does_not_count_truncations(monkeypatch):
+    from utils.config import config
+    from utils.metrics import get_registry
+
+    monkeypatch.setattr(config, "ENRICH_RECORD_MAX_TOKENS", 50)
+    records = [{"Number": "INC00001", "Description": "x" * 2000}, {"Number": "INC00002", "Description": "short"}]
+    get_registry().reset()
+
+    assert count_batches(records) == len(list(pack_batches(records)))
+
+    assert get_registry().snapshot()["counters"]["enrich_records_truncated"] == 1
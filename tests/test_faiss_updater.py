@@ -0,0 +1,44 @@
+import numpy as np
+
+
+def _incident(number, text):
+    return {"Number": number, "Short description": text, "Description": "", "Resolution notes": "restarted"}
+
+
+def test_later_copy_wins_across_chunks(data_dir, fake_encoder, monkeypatch):
+    from utils.config import config
+    from faiss_updater import update_faiss_with_new_data
+    from metadata_store import open_metadata_store
+    from embedding_store import open_embedding_store
+
+    update_faiss_with_new_data([_incident(f"INC{i:05d}", f"printer {i} offline") for i in range(20)])
+
+    # The changed copy lands in the first chunk; the second chunk repeats the stored version.
+    monkeypatch.setattr(config, "EMBED_CHUNK_SIZE", 1)
+    update_faiss_with_new_data([
+        _incident("INC00003", "printer 3 offline after firmware update"),
+        _incident("INC00003", "printer 3 offline"),
+    ])
+
+    metadata = open_metadata_store()
+    row_id = metadata.get_row_ids(["INC00003"])["INC00003"]
+    assert metadata.fetch([row_id]).iloc[0]["Short description"] == "printer 3 offline"
+    stored = open_embedding_store().read_rows([row_id])[0]
+    np.testing.assert_allclose(stored, fake_encoder.encode(["printer 3 offline"])[0])
+
+
+def test_published_generation_keeps_its_rows(data_dir, fake_encoder, monkeypatch):
+    import retriever
+    from faiss_updater import update_faiss_with_new_data
+
+    monkeypatch.setattr(retriever, "_retriever", None)
+    update_faiss_with_new_data([_incident(f"INC{i:05d}", f"vpn {i} drops") for i in range(20)])
+    reader = retriever.get_retriever()
+
+    update_faiss_with_new_data([_incident("INC00004", "vpn 4 drops every hour")])
+
+    results, _ = reader.search("INC00004", top_k=1)
+    assert results.iloc[0]["Short description"] == "vpn 4 drops"
+    monkeypatch.setattr(retriever, "_retriever", None)
+    results, _ = retriever.get_retriever().search("INC00004", top_k=1)
+    assert results.iloc[0]["Short description"] == "vpn 4 drops every hour"
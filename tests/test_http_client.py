@@ -0,0 +1,68 @@
+import json
+import pytest
+import requests
+import http_client
+from benchmarks.stub_server import run_stub_server, SUMMARIZATION_AGENT_ID
+from http_client import post_incident_records, stream_summarized_output
+
+RECORDS = [
+    {"Number": "INC0000001", "Resolution notes": "Restarted the VPN gateway."},
+    {"Number": "INC0000002", "Resolution notes": "Cleared the print queue."},
+]
+NUMBERS = [rec["Number"] for rec in RECORDS]
+
+
+def _stream(url):
+    return "".join(stream_summarized_output(RECORDS, ai_agent_id=SUMMARIZATION_AGENT_ID, endpoint=url))
+
+
+def test_stream_summary_is_cached_after_done(summary_cache):
+    with run_stub_server() as (url, server):
+        text = _stream(url)
+        assert '"overview"' in text
+        assert summary_cache.get(NUMBERS, SUMMARIZATION_AGENT_ID) is not None
+        assert _stream(url) == text
+        assert server.requests == 1
+
+
+def test_truncated_stream_is_not_cached(summary_cache):
+    with run_stub_server(truncate_stream=True) as (url, server):
+        assert _stream(url)
+        assert summary_cache.get(NUMBERS, SUMMARIZATION_AGENT_ID) is None
+        _stream(url)
+        assert server.requests == 2
+
+
+def test_empty_reply_is_not_cached(summary_cache):
+    with run_stub_server(empty_summary=True) as (url, server):
+        assert _stream(url) == ""
+        assert summary_cache.get(NUMBERS, SUMMARIZATION_AGENT_ID) is None
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_post_backs_off_and_retries(fast_http, monkeypatch, status):
+    delays = []
+    monkeypatch.setattr(http_client.time, "sleep", delays.append)
+    with run_stub_server(fail_requests={1, 2}, fail_status=status) as (url, server):
+        response = post_incident_records(RECORDS, ai_agent_id="stub-enricher", endpoint=url)
+    assert response["success"]
+    assert server.requests == 3
+    # Exponential backoff with jitter: attempt n waits between half and all of base * 2**n.
+    assert len(delays) == 2
+    for attempt, delay in enumerate(delays):
+        assert 0.5 * fast_http.HTTP_BACKOFF_BASE * 2 ** attempt <= delay <= fast_http.HTTP_BACKOFF_BASE * 2 ** attempt
+
+
+def test_post_gives_up_after_max_retries(fast_http, monkeypatch):
+    monkeypatch.setattr(fast_http, "HTTP_MAX_RETRIES", 2)
+    with run_stub_server(fail_requests=range(1, 10), fail_status=503) as (url, server):
+        with pytest.raises(requests.HTTPError):
+            post_incident_records(RECORDS, ai_agent_id="stub-enricher", endpoint=url)
+    assert server.requests == 3
+
+
+def test_stream_yields_summary_in_chunks(summary_cache):
+    with run_stub_server() as (url, _):
+        chunks = list(stream_summarized_output(RECORDS, ai_agent_id=SUMMARIZATION_AGENT_ID, endpoint=url))
+    assert len(chunks) > 1
+    assert json.loads("".join(chunks))["incident_numbers"] == NUMBERS
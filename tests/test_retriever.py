@@ -0,0 +1,19 @@
+def test_distances_follow_rows_missing_from_metadata(data_dir, fake_encoder, monkeypatch):
+    import retriever
+    from faiss_updater import update_faiss_with_new_data
+    from metadata_store import open_metadata_store
+
+    update_faiss_with_new_data([
+        {"Number": f"INC{i:05d}", "Short description": f"disk {i} full", "Description": "", "Resolution notes": "x"}
+        for i in range(20)
+    ])
+    metadata = open_metadata_store()
+    with metadata._conn:
+        metadata._conn.execute("DELETE FROM incidents WHERE number = 'INC00002'")
+    monkeypatch.setattr(retriever, "_retriever", None)
+
+    results, distances = retriever.get_retriever().search("disk 2 full", top_k=5)
+
+    assert len(results) == len(distances) == 4
+    assert "INC00002" not in set(results["Number"])
+    assert distances == sorted(distances)